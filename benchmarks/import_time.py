@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Import time of the modules of the bindings.
+
+Each module is imported in a fresh interpreter several times and the median
+time is compared with its budget::
+
+    python benchmarks/import_time.py --budget-scale 1.5
+
+The run fails (exit status 1) if any module exceeds its budget.
+"""
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse, json, os, subprocess, sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# Milliseconds, measured on top of the start of the interpreter. The imports
+# take about 55, 40 and 100 ms on a loaded test machine: the budgets leave room
+# for slower machines while catching a new eager import of a heavy module.
+BUDGETS = {"marcopolo.bindings.marco": 100,
+           "marcopolo.bindings.polo": 80,
+           "marcopolo.bindings.aiomarco": 150}
+
+# Modules which must not be loaded by the import of the bindings
+DEFERRED = ("ssl", "pwd", "pkg_resources", "msgpack", "cbor2", "marcopolo.marco.conf", "marcopolo.polo.conf")
+
+# Deferred modules loaded anyway by the dependencies of a binding (asyncio imports ssl)
+ALLOWED = {"marcopolo.bindings.aiomarco": ("ssl",)}
+
+_PROBE = """
+import sys, time, json
+start = time.time()
+import %s
+elapsed = time.time() - start
+print(json.dumps({"ms": elapsed * 1000, "loaded": [m for m in %r if m in sys.modules]}))
+"""
+
+def _environment():
+    environment = dict(os.environ)
+    path = environment.get("PYTHONPATH")
+    environment["PYTHONPATH"] = ROOT + (os.pathsep + path if path else "")
+    return environment
+
+def measure(module, runs=5):
+    """
+    :returns: A tuple with the median import time of ``module`` (in milliseconds) and the deferred modules it loaded.
+    """
+    times = []
+    loaded = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", _PROBE % (module, DEFERRED)], env=_environment())
+        result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+        times.append(result["ms"])
+        loaded = result["loaded"]
+    times.sort()
+    return times[len(times) // 2], loaded
+
+def check(modules=None, runs=5, scale=1.0):
+    """
+    :returns: A dictionary with the import time, budget and deferred modules loaded of each module.
+    """
+    results = {}
+    for module in sorted(modules or BUDGETS):
+        if module == "marcopolo.bindings.aiomarco" and sys.version_info < (3, 5):
+            continue
+        ms, loaded = measure(module, runs)
+        loaded = [name for name in loaded if name not in ALLOWED.get(module, ())]
+        budget = BUDGETS.get(module, max(BUDGETS.values())) * scale
+        results[module] = {"ms": ms, "budget_ms": budget, "loaded": loaded,
+                           "ok": ms <= budget and not loaded}
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5, help="Imports of each module (default: 5)")
+    parser.add_argument("--budget-scale", type=float, default=1.0,
+                        help="Factor applied to the budgets, for slower machines (default: 1)")
+    parser.add_argument("--output", help="File where the results are written as JSON")
+    args = parser.parse_args(argv)
+
+    results = check(runs=args.runs, scale=args.budget_scale)
+    for module, result in sorted(results.items()):
+        print("%s: %.1f ms (budget %.1f ms)%s" % (module, result["ms"], result["budget_ms"],
+              ", loads " + ", ".join(result["loaded"]) if result["loaded"] else ""), file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0 if all(result["ok"] for result in results.values()) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""
+Throughput and latency benchmarks of the bindings against the local
+stand-in daemons (see :mod:`marcopolo.bindings.standin`).
+
+Every benchmark is run for each combination of concurrency (number of
+threads) and number of virtual nodes, and reports the operations per
+second, the p50 and p99 latency, the CPU time and the memory allocated.
+The results are written as JSON, and can be compared with the results of
+a previous run::
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --baseline results.json --threshold 0.1
+
+The run fails (exit status 1) if the throughput of any benchmark drops
+by more than ``threshold`` with respect to the baseline.
+"""
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse, json, os, platform, resource, shutil, subprocess, sys, tempfile, threading, time
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from marcopolo.bindings import marco, standin
+
+SERVICE = "benchmark"
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def _percentile(samples, p):
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+
+def measure(operation, concurrency, duration, allocations=False):
+    """
+    Calls ``operation`` from ``concurrency`` threads during ``duration`` seconds.
+
+    :param operation: Callable which receives the index of the thread and performs one operation.
+
+    :returns: A dictionary with the statistics of the run.
+    """
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    end = [None]
+    barrier = threading.Event()
+
+    def worker(index):
+        barrier.wait()
+        samples = latencies[index]
+        while time.time() < end[0]:
+            start = time.time()
+            try:
+                operation(index)
+            except Exception:
+                errors[index] += 1
+                continue
+            samples.append(time.time() - start)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    if allocations and tracemalloc is not None:
+        tracemalloc.start()
+    blocks = sys.getallocatedblocks() if hasattr(sys, "getallocatedblocks") else None
+    cpu = _cpu_time()
+    start = time.time()
+    end[0] = start + duration
+    barrier.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    cpu = _cpu_time() - cpu
+
+    result = {}
+    if blocks is not None:
+        result["allocated_blocks"] = sys.getallocatedblocks() - blocks
+    if allocations and tracemalloc is not None:
+        result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    samples = sorted(sample for thread_samples in latencies for sample in thread_samples)
+    result.update({"operations": len(samples),
+                   "errors": sum(errors),
+                   "seconds": elapsed,
+                   "ops_per_sec": len(samples) / elapsed,
+                   "p50_ms": _percentile(samples, 50) * 1000 if samples else None,
+                   "p99_ms": _percentile(samples, 99) * 1000 if samples else None,
+                   "cpu_seconds": cpu})
+    return result
+
+def _nodes(count):
+    return [standin.VirtualNode("10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                                {SERVICE: {"index": i}}, params={"index": i})
+            for i in range(count)]
+
+def bench_marco(args, concurrency, nodes):
+    with standin.StandInResolver(_nodes(nodes)):
+        client = marco.Marco(timeout=args.timeout, delta=args.delta)
+        try:
+            return measure(lambda index: client.marco(), concurrency, args.duration, args.allocations)
+        finally:
+            client.close()
+
+def bench_request_for(args, concurrency, nodes):
+    with standin.StandInResolver(_nodes(nodes)):
+        client = marco.Marco(timeout=args.timeout, delta=args.delta)
+        try:
+            return measure(lambda index: client.request_for(SERVICE), concurrency, args.duration, args.allocations)
+        finally:
+            client.close()
+
+def bench_services(args, concurrency, nodes):
+    virtual = _nodes(nodes)
+    with standin.StandInResolver(virtual):
+        client = marco.Marco(timeout=args.timeout)
+        try:
+            return measure(lambda index: client.services(virtual[index % len(virtual)].address),
+                           concurrency, args.duration, args.allocations)
+        finally:
+            client.close()
+
+def bench_publish(args, concurrency, nodes):
+    """
+    Publishes and unpublishes a service. ``nodes`` is ignored.
+    """
+    from marcopolo.bindings import polo
+    if args.certfile is None:
+        return None
+    with standin.StandInPolo(args.certfile):
+        clients = [polo.Polo() for _ in range(concurrency)]
+        counters = [0] * concurrency
+        def operation(index):
+            counters[index] += 1
+            service = "%s-%d-%d" % (SERVICE, index, counters[index])
+            clients[index].publish_service(service)
+            clients[index].unpublish_service(service)
+        return measure(operation, concurrency, args.duration, args.allocations)
+
+BENCHMARKS = {"marco": bench_marco,
+              "request_for": bench_request_for,
+              "services": bench_services,
+              "publish_unpublish": bench_publish}
+
+def _certificate(directory):
+    """
+    Creates a self-signed certificate for the stand-in Polo daemon.
+
+    :returns: The path of the certificate, or ``None`` if ``openssl`` is not available.
+    """
+    certfile = os.path.join(directory, "cert.pem")
+    try:
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                                   "-subj", "/CN=localhost", "-keyout", certfile, "-out", certfile],
+                                  stdout=devnull, stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return certfile
+
+def compare(results, baseline, threshold):
+    """
+    :returns: The descriptions of the benchmarks whose throughput dropped by more than ``threshold``.
+    """
+    previous = dict(((r["benchmark"], r["concurrency"], r["nodes"]), r) for r in baseline["results"])
+    regressions = []
+    for result in results:
+        old = previous.get((result["benchmark"], result["concurrency"], result["nodes"]))
+        if old is None or not old["ops_per_sec"]:
+            continue
+        change = result["ops_per_sec"] / old["ops_per_sec"] - 1
+        if change < -threshold:
+            regressions.append("%(benchmark)s (concurrency %(concurrency)d, %(nodes)d nodes)" % result +
+                               ": %.1f%% fewer operations per second" % (-change * 100))
+    return regressions
+
+def _integers(value):
+    return [int(item) for item in value.split(",")]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--benchmarks", default=",".join(sorted(BENCHMARKS)),
+                        help="Comma-separated benchmarks to run (default: all)")
+    parser.add_argument("--concurrency", type=_integers, default=[1, 4, 16],
+                        help="Comma-separated numbers of threads (default: 1,4,16)")
+    parser.add_argument("--nodes", type=_integers, default=[10, 100, 1000],
+                        help="Comma-separated numbers of virtual nodes (default: 10,100,1000)")
+    parser.add_argument("--duration", type=float, default=2.0, help="Seconds each benchmark runs (default: 2)")
+    parser.add_argument("--timeout", type=int, default=20,
+                        help="Discovery timeout in milliseconds (default: 20)")
+    parser.add_argument("--delta", action="store_true", help="Use delta queries in the discovery benchmarks")
+    parser.add_argument("--allocations", action="store_true", help="Trace the peak memory allocated (slower)")
+    parser.add_argument("--output", help="File where the results are written (default: standard output)")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Maximum fraction of throughput lost with respect to the baseline (default: 0.1)")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    args.certfile = _certificate(directory)
+    results = []
+    try:
+        for name in args.benchmarks.split(","):
+            if name not in BENCHMARKS:
+                parser.error("Unknown benchmark %s" % name)
+            # Publishing does not depend on the number of nodes
+            for nodes in (args.nodes if name != "publish_unpublish" else [0]):
+                for concurrency in args.concurrency:
+                    result = BENCHMARKS[name](args, concurrency, nodes)
+                    if result is None:
+                        print("Skipping %s: openssl is required" % name, file=sys.stderr)
+                        break
+                    result.update({"benchmark": name, "concurrency": concurrency, "nodes": nodes})
+                    results.append(result)
+                    print("%(benchmark)s concurrency=%(concurrency)d nodes=%(nodes)d: "
+                          "%(ops_per_sec).1f ops/s, p50 %(p50_ms)s ms, p99 %(p99_ms)s ms, %(errors)d errors" % result, file=sys.stderr)
+    finally:
+        shutil.rmtree(directory)
+
+    report = {"python": platform.python_version(),
+              "platform": platform.platform(),
+              "timestamp": time.time(),
+              "parameters": {"duration": args.duration, "timeout": args.timeout, "delta": args.delta},
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print("Regression: %s" % regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
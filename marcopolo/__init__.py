@@ -1,3 +1,11 @@
 """marcopolo
 """
-__import__('pkg_resources').declare_namespace(__name__)
\ No newline at end of file
+# The namespace is shared with the marcopolo daemons, which may be installed
+# in another directory. This is what pkgutil.extend_path does, without the
+# cost of importing pkgutil (or pkg_resources).
+import os as _os, sys as _sys
+for _entry in _sys.path:
+    _path = _os.path.join(_entry or _os.curdir, __name__)
+    if _os.path.isdir(_path) and _os.path.realpath(_path) not in map(_os.path.realpath, __path__):
+        __path__.append(_path)
+del _entry, _path, _os, _sys
@@ -0,0 +1,272 @@
+"""
+asyncio version of the Marco binding.
+
+Every query runs as a coroutine on the event loop, so a single loop can keep
+hundreds of discovery requests in flight without dedicating a thread to each
+of them. Requires Python 3.5 or later.
+"""
+from __future__ import absolute_import
+import asyncio
+
+from marcopolo.bindings import marco as _marco
+from marcopolo.bindings import codec as _codec
+from marcopolo.bindings.marco import (TIMEOUT, MULTICAST_GROUP,
+                                      MarcoTimeOutException, MarcoInternalError)
+
+def _parse(parse, nodes):
+    """
+    Applies ``parse`` to the nodes of a reply, reporting malformed replies as the synchronous client does.
+    """
+    try:
+        return parse(nodes)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        raise MarcoInternalError("Internal parsing error")
+
+class _ResolverProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram endpoint used for one exchange with the resolver. ``response``
+    is completed with the payload once all the chunks of the reply arrive.
+    """
+    def __init__(self, response, limit=None, codec=_codec.JSON):
+        self.response = response
+        self.codec = codec
+        self.chunks = _marco._Chunks(limit=limit)
+
+    def datagram_received(self, data, addr):
+        if self.response.done():
+            return
+        try:
+            _, seq, more, payload = _marco._unwrap_response(_marco._decode_response(data, self.codec))
+        except MarcoInternalError as e:
+            self.response.set_exception(e)
+            return
+        self.chunks.add(seq, more, payload)
+        if self.chunks.complete():
+            self.response.set_result(self.chunks.payload())
+
+    def error_received(self, exc):
+        if not self.response.done():
+            self.response.set_exception(MarcoInternalError("Error on communication: %s" % exc))
+
+    def connection_lost(self, exc):
+        if exc is not None and not self.response.done():
+            self.response.set_exception(MarcoInternalError("Error on communication: %s" % exc))
+
+
+class _AsyncSubscription(object):
+    """
+    Asynchronous iterator over the events of a watch. The events are
+    delivered by the watcher thread to the event loop.
+    """
+    def __init__(self, service, loop, options):
+        from marcopolo.bindings.watch import get_watcher
+        self._loop = loop
+        self._events = asyncio.Queue()
+        self._subscription = get_watcher(**options).subscribe(service, self._emit)
+
+    def _emit(self, event):
+        self._loop.call_soon_threadsafe(self._events.put_nowait, event)
+
+    def cancel(self):
+        self._subscription.cancel()
+        self._loop.call_soon_threadsafe(self._events.put_nowait, None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self._events.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+
+class AsyncMarco(object):
+    """
+    Coroutine-based counterpart of :class:`marcopolo.bindings.marco.Marco`.
+
+    Each call opens its own datagram endpoint, so concurrent queries never
+    receive each other's replies.
+
+    :param int timeout: Default timeout (in milliseconds) of the discovery process.
+
+    :param str group: Multicast group used by ``marco``.
+
+    :param loop: The event loop to use. Defaults to the running loop.
+
+    :param codecs: If set, the names of the wire codecs to negotiate with the resolver before the first command, in order of preference.
+
+    :param tuple address: Address of the resolver. By default, ``RESOLVER_ADDRESS``.
+    """
+    def __init__(self, timeout=TIMEOUT, group=MULTICAST_GROUP, loop=None, codecs=None, address=None):
+        self.address = address
+        self._timeout = timeout
+        self._group = group
+        self._loop = loop
+        self.codec = _codec.JSON
+        self._codecs = codecs
+        self._negotiated = codecs is None
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        try:
+            self._timeout = int(value)
+        except ValueError:
+            pass
+
+    @property
+    def group(self):
+        return self._group
+
+    @group.setter
+    def group(self, value):
+        self._group = value
+
+    def _get_loop(self):
+        if self._loop is not None:
+            return self._loop
+        return asyncio.get_event_loop()
+
+    async def _query(self, command, timeout, limit=None):
+        """
+        Sends ``command`` to the resolver and waits for its reply.
+
+        :param int limit: If set, the reply is complete once this number of nodes has arrived.
+
+        :returns: The payload of the response.
+        """
+        if not self._negotiated:
+            self._negotiated = True
+            try:
+                self.codec = _codec.negotiated(await self._query(_codec.hello(self._codecs), timeout))
+            except (MarcoTimeOutException, MarcoInternalError):
+                self.codec = _codec.JSON
+
+        loop = self._get_loop()
+        response = loop.create_future()
+        codec = self.codec
+        try:
+            transport, _ = await loop.create_datagram_endpoint(lambda: _ResolverProtocol(response, limit, codec),
+                                                               remote_addr=self.address or _marco.RESOLVER_ADDRESS)
+        except OSError as e:
+            raise MarcoInternalError("Error on communication: %s" % e)
+
+        try:
+            try:
+                message = _marco._encode_command(command, codec)
+            except (ValueError, TypeError):
+                raise _marco.MarcoParameterError("Bad parameters")
+            transport.sendto(message)
+            try:
+                payload = await asyncio.wait_for(response, 2*timeout/1000.0)
+            except asyncio.TimeoutError:
+                raise MarcoTimeOutException("No connection to the resolver")
+        finally:
+            transport.close()
+
+        return _marco._check_error(payload)
+
+    async def marco(self, max_nodes=None, exclude=[], params={}, timeout=None, stream=False):
+        """
+        Coroutine version of :meth:`Marco.marco`.
+
+        :returns: A set of all responding nodes.
+        """
+        timeout = timeout if timeout else self.timeout
+        command = {"Command": "Marco",
+                   "max_nodes": max_nodes,
+                   "exclude": exclude,
+                   "params": params,
+                   "group": self.group,
+                   "timeout": timeout}
+        if stream:
+            command["Stream"] = True
+        nodes = await self._query(command, timeout, max_nodes if stream else None)
+        return _parse(_marco._nodes_from_response, nodes)
+
+    async def request_for(self, service, node=None, max_nodes=None, exclude=[], params={}, timeout=None,
+                          stream=False):
+        """
+        Coroutine version of :meth:`Marco.request_for`.
+
+        :returns: A set of nodes offering the requested service.
+        """
+        timeout = timeout if timeout else self.timeout
+        command = {"Command": "Request-for",
+                   "Params": service,
+                   "node": node,
+                   "max_nodes": max_nodes,
+                   "exclude": exclude,
+                   "params": params,
+                   "timeout": timeout}
+        if stream:
+            command["Stream"] = True
+        nodes = await self._query(command, timeout, max_nodes if stream else None)
+        return _parse(lambda nodes: _marco._nodes_from_response(nodes, (service,)), nodes)
+
+    async def request_one_for(self, service, exclude=[], params={}, timeout=None):
+        """
+        Coroutine version of :meth:`Marco.request_one_for`.
+
+        :returns: The first node replying, or ``None`` if no node offers the service.
+        """
+        nodes = await self.request_for(service, max_nodes=1, exclude=exclude, params=params,
+                                       timeout=timeout, stream=True)
+        return next(iter(nodes), None)
+
+    async def services(self, node, timeout=None):
+        """
+        Coroutine version of :meth:`Marco.services`.
+
+        :returns: A list of the services offered by ``node``.
+        """
+        timeout = timeout if timeout else self.timeout
+        return await self._query({"Command": "Services",
+                                  "node": node,
+                                  "timeout": timeout}, timeout)
+
+    async def request_multi(self, services, max_nodes=None, exclude=[], params={}, timeout=None):
+        """
+        Coroutine version of :meth:`Marco.request_multi`. If the resolver
+        does not support the batched command, the services are looked up
+        concurrently.
+
+        :param list services: The names of the services to look for.
+
+        :returns: A dictionary mapping each service to the set of nodes offering it.
+
+        :rvalue: dict
+        """
+        timeout = timeout if timeout else self.timeout
+        services = list(services)
+        try:
+            nodes = await self._query({"Command": "Request-multi",
+                                       "Services": services,
+                                       "max_nodes": max_nodes,
+                                       "exclude": exclude,
+                                       "params": params,
+                                       "timeout": timeout}, timeout)
+            return _parse(_marco._nodes_by_service(services), nodes)
+        except _marco.MarcoResolverError:
+            pass
+
+        results = await asyncio.gather(*[self.request_for(service,
+                                                          max_nodes=max_nodes,
+                                                          exclude=exclude,
+                                                          params=params,
+                                                          timeout=timeout)
+                                          for service in services])
+        return dict(zip(services, results))
+
+    def watch(self, service):
+        """
+        Asynchronous version of :meth:`Marco.watch`.
+
+        :returns: An asynchronous iterator of :class:`marcopolo.bindings.watch.WatchEvent`. Call its ``cancel`` method to stop watching.
+        """
+        return _AsyncSubscription(service, self._get_loop(), {"timeout": self.timeout, "group": self.group,
+                                                              "codecs": self._codecs, "address": self.address})
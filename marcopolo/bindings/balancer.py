@@ -0,0 +1,258 @@
+"""
+Client-side selection of one node among the nodes offering a service.
+
+A :class:`Balancer` holds the nodes returned by ``request_for`` (or kept up
+to date by a watch) and picks one per call according to a strategy:
+
+- ``ROUND_ROBIN``: each node in turn.
+- ``WEIGHTED``: at random, with a probability proportional to a numeric
+  field of the parameters of the node (for example, its capacity).
+- ``POWER_OF_TWO``: the node with fewer outstanding requests of two
+  picked at random.
+- ``LEAST_OUTSTANDING``: the node with fewer outstanding requests.
+
+Outstanding requests are counted between :meth:`Balancer.acquire` and
+:meth:`Balancer.release` (or during a :meth:`Balancer.lease` block). The
+state is updated incrementally when nodes are added or removed, so picking
+a node does not depend on the number of nodes.
+"""
+from __future__ import division
+from __future__ import absolute_import
+import random, threading, numbers
+from collections import OrderedDict
+from contextlib import contextmanager
+
+ROUND_ROBIN = "round_robin"
+WEIGHTED = "weighted"
+POWER_OF_TWO = "power_of_two"
+LEAST_OUTSTANDING = "least_outstanding"
+
+STRATEGIES = (ROUND_ROBIN, WEIGHTED, POWER_OF_TWO, LEAST_OUTSTANDING)
+
+class Balancer(object):
+    """
+    :param nodes: The initial nodes.
+
+    :param str strategy: One of ``ROUND_ROBIN``, ``WEIGHTED``, ``POWER_OF_TWO`` or ``LEAST_OUTSTANDING``.
+
+    :param str weight: Name of the parameter of the nodes used as weight by the ``WEIGHTED`` strategy. Nodes without a valid (numeric, not negative) value weigh 1.
+    """
+    def __init__(self, nodes=(), strategy=ROUND_ROBIN, weight="weight"):
+        if strategy not in STRATEGIES:
+            raise ValueError("Unknown strategy %s" % strategy)
+        self.strategy = strategy
+        self.weight = weight
+        self._lock = threading.Lock()
+        self._nodes = [] # Dense list, for O(1) random access
+        self._index = {} # Position of each node in _nodes, by address
+        self._outstanding = {} # Outstanding requests of each node, by address
+        self._loads = {} # Addresses of the nodes with each number of outstanding requests
+        self._least = 0 # Lowest number of outstanding requests, if there are nodes
+        self._next = -1
+        self._alias = None # Alias table of the weights, rebuilt when the nodes change
+        self._subscription = None
+        self.update(nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __iter__(self):
+        return iter(list(self._nodes))
+
+    def nodes(self):
+        """
+        :rvalue: set
+        """
+        return set(self._nodes)
+
+    def _add(self, node):
+        position = self._index.get(node.address)
+        if position is not None: # The parameters may have changed
+            self._nodes[position] = node
+            self._alias = None
+            return
+        self._index[node.address] = len(self._nodes)
+        self._nodes.append(node)
+        self._outstanding[node.address] = 0
+        self._loads.setdefault(0, OrderedDict())[node.address] = None
+        self._least = 0
+        self._alias = None
+
+    def _remove(self, address):
+        position = self._index.pop(address, None)
+        if position is None:
+            return
+        last = self._nodes.pop()
+        if position < len(self._nodes): # Fill the gap with the last node
+            self._nodes[position] = last
+            self._index[last.address] = position
+        load = self._outstanding.pop(address)
+        bucket = self._loads[load]
+        del bucket[address]
+        if not bucket:
+            del self._loads[load]
+            if load == self._least:
+                self._least = min(self._loads) if self._loads else 0
+        self._alias = None
+
+    def add(self, node):
+        """
+        Adds ``node``, or replaces the node with the same address.
+        """
+        with self._lock:
+            self._add(node)
+
+    def remove(self, node):
+        """
+        Removes ``node`` (or the node with the same address).
+        """
+        with self._lock:
+            self._remove(getattr(node, "address", node))
+
+    def update(self, nodes):
+        """
+        Replaces the nodes with ``nodes``. Only the differences are applied,
+        so the outstanding requests of the nodes which remain are kept.
+        """
+        nodes = dict((node.address, node) for node in nodes)
+        with self._lock:
+            for address in [address for address in self._index if address not in nodes]:
+                self._remove(address)
+            for node in nodes.values():
+                self._add(node)
+
+    def _weight(self, node):
+        value = node.params.get(self.weight) if node.params else None
+        if isinstance(value, numbers.Real) and not isinstance(value, bool) and value >= 0:
+            return float(value)
+        return 1.0
+
+    def _build_alias(self):
+        """
+        Builds the alias table of the weights (Vose's method), which allows
+        weighted picks in constant time.
+        """
+        weights = [self._weight(node) for node in self._nodes]
+        total = sum(weights)
+        count = len(weights)
+        if total == 0:
+            weights, total = [1.0] * count, float(count)
+        scaled = [w * count / total for w in weights]
+        probability = [1.0] * count
+        alias = list(range(count))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            probability[less] = scaled[less]
+            alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+        self._alias = (probability, alias)
+
+    def _pick(self):
+        count = len(self._nodes)
+        if count == 0:
+            return None
+        if self.strategy == ROUND_ROBIN:
+            self._next = (self._next + 1) % count
+            return self._nodes[self._next]
+        if self.strategy == WEIGHTED:
+            if self._alias is None:
+                self._build_alias()
+            probability, alias = self._alias
+            position = random.randrange(count)
+            return self._nodes[position if random.random() < probability[position] else alias[position]]
+        if self.strategy == POWER_OF_TWO:
+            first = self._nodes[random.randrange(count)]
+            second = self._nodes[random.randrange(count)]
+            return first if self._outstanding[first.address] <= self._outstanding[second.address] else second
+        address = next(iter(self._loads[self._least]))
+        return self._nodes[self._index[address]]
+
+    def pick(self):
+        """
+        Picks a node, without counting a request to it.
+
+        :returns: The node, or ``None`` if there are no nodes.
+        """
+        with self._lock:
+            return self._pick()
+
+    def _move(self, address, delta):
+        load = self._outstanding[address]
+        bucket = self._loads[load]
+        del bucket[address]
+        if not bucket:
+            del self._loads[load]
+        load += delta
+        self._outstanding[address] = load
+        self._loads.setdefault(load, OrderedDict())[address] = None
+        if load < self._least or self._least not in self._loads:
+            self._least = load if load < self._least else self._least + 1
+
+    def acquire(self):
+        """
+        Picks a node and counts an outstanding request to it, until :meth:`release` is called.
+
+        :returns: The node, or ``None`` if there are no nodes.
+        """
+        with self._lock:
+            node = self._pick()
+            if node is not None:
+                self._move(node.address, 1)
+            return node
+
+    def release(self, node):
+        """
+        Ends a request to ``node`` started with :meth:`acquire`.
+        """
+        with self._lock:
+            if self._outstanding.get(node.address, 0) > 0:
+                self._move(node.address, -1)
+
+    def outstanding(self, node):
+        """
+        :returns: The number of outstanding requests to ``node``.
+        """
+        return self._outstanding.get(node.address, 0)
+
+    @contextmanager
+    def lease(self):
+        """
+        Context manager which acquires a node and releases it at the end of the block::
+
+            with balancer.lease() as node:
+                send(node.address)
+        """
+        node = self.acquire()
+        try:
+            yield node
+        finally:
+            if node is not None:
+                self.release(node)
+
+    def watch(self, service, marco=None):
+        """
+        Keeps the nodes up to date with the nodes offering ``service``, using
+        the watcher shared by the process (see :meth:`marcopolo.bindings.marco.Marco.watch`).
+
+        :param marco: If set, the :class:`marcopolo.bindings.marco.Marco` instance whose resolver is watched. Otherwise, the default resolver is.
+
+        :returns: The subscription, which stops the updates when cancelled.
+
+        :rvalue: marcopolo.bindings.watch.Subscription
+        """
+        if marco is not None:
+            self._subscription = marco.watch(service, self._on_event)
+        else:
+            from marcopolo.bindings import watch
+            self._subscription = watch.get_watcher().subscribe(service, self._on_event)
+        return self._subscription
+
+    def _on_event(self, event):
+        from marcopolo.bindings import watch
+        if event.type == watch.REMOVED:
+            self.remove(event.node)
+        else:
+            self.add(event.node)
@@ -0,0 +1,81 @@
+"""
+Pool of reusable receive buffers.
+
+The bindings receive every message with ``recv_into`` into a ``bytearray``
+taken from a :class:`BufferPool` and decode it from a ``memoryview`` of the
+bytes received, so no new ``bytes`` object is allocated per message. The
+buffers are returned to the pool when they are no longer needed and reused
+by the next receiver.
+"""
+from __future__ import absolute_import
+import threading
+from contextlib import contextmanager
+
+BUFFER_SIZE = 65536 # Fits the largest UDP datagram and TLS record
+
+class BufferPool(object):
+    """
+    :param int size: Size of the buffers.
+
+    :param int max_buffers: Maximum number of idle buffers kept. Buffers released beyond it are left to the garbage collector.
+    """
+    def __init__(self, size=BUFFER_SIZE, max_buffers=16):
+        self.size = size
+        self.max_buffers = max_buffers
+        self.allocated = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        :returns: An idle buffer, or a new one if there are none.
+
+        :rvalue: bytearray
+        """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            self.allocated += 1
+        return bytearray(self.size)
+
+    def release(self, buffer):
+        """
+        Returns ``buffer`` to the pool. Buffers of another size are not kept.
+        """
+        if len(buffer) != self.size:
+            return
+        with self._lock:
+            if len(self._idle) < self.max_buffers:
+                self._idle.append(buffer)
+
+    @contextmanager
+    def borrow(self):
+        """
+        Context manager which acquires a buffer and releases it at the end of the block.
+        """
+        buffer = self.acquire()
+        try:
+            yield buffer
+        finally:
+            self.release(buffer)
+
+    def __len__(self):
+        """
+        :returns: The number of idle buffers.
+        """
+        return len(self._idle)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    :returns: The buffer pool shared by the process.
+
+    :rvalue: BufferPool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BufferPool()
+        return _pool
@@ -0,0 +1,139 @@
+from __future__ import absolute_import
+import json, time, threading
+from collections import OrderedDict
+
+FRESH, STALE, MISS = "fresh", "stale", "miss"
+
+class ResultCache(object):
+    """
+    Bounded LRU cache of discovery results with a per-entry TTL.
+
+    An entry is fresh during ``ttl`` seconds after being stored. If
+    ``stale_ttl`` is greater than 0, the entry is served as stale during the
+    following ``stale_ttl`` seconds while the owner refreshes it in the
+    background (stale-while-revalidate).
+
+    :param float ttl: Seconds an entry is considered fresh.
+
+    :param int max_size: Maximum number of entries. The least recently used entry is evicted when the limit is reached.
+
+    :param float stale_ttl: Seconds an expired entry can still be served while it is refreshed.
+    """
+    def __init__(self, ttl=5.0, max_size=1024, stale_ttl=0):
+        if max_size < 1:
+            raise ValueError("max_size must be greater than 0")
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*args):
+        """
+        Builds a hashable key from the arguments of a query. Dictionaries and
+        lists are serialized so that equal values produce the same key.
+        """
+        return json.dumps(args, sort_keys=True, default=repr)
+
+    def lookup(self, key, count=True):
+        """
+        Looks ``key`` up and updates the counters.
+
+        :param bool count: If not set, the counters are left to the caller (see :meth:`record`), for lookups which try several keys.
+
+        :returns: A tuple ``(value, state)`` where ``state`` is one of ``FRESH``, ``STALE`` or ``MISS``.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored = entry
+                age = now - stored
+                if age < self.ttl:
+                    del self._entries[key] # Most recently used goes last
+                    self._entries[key] = entry
+                    state = FRESH
+                elif age < self.ttl + self.stale_ttl:
+                    state = STALE
+                else:
+                    del self._entries[key]
+                    value, state = None, MISS
+            else:
+                value, state = None, MISS
+            if count:
+                self._count(state)
+            return value, state
+
+    def _count(self, state):
+        if state == FRESH:
+            self.hits += 1
+        elif state == STALE:
+            self.stale_hits += 1
+        else:
+            self.misses += 1
+
+    def record(self, state):
+        """
+        Counts the outcome ``state`` of a lookup made with ``count=False``.
+        """
+        with self._lock:
+            self._count(state)
+
+    def store(self, key, value):
+        """
+        Stores ``value`` under ``key``, evicting the least recently used entry if needed.
+        """
+        with self._lock:
+            self._refreshing.discard(key)
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def start_refresh(self, key):
+        """
+        Marks ``key`` as being refreshed.
+
+        :returns: ``False`` if a refresh of ``key`` is already in progress.
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def end_refresh(self, key):
+        """
+        Clears the refresh mark of ``key`` without storing a value (e.g. the refresh failed).
+        """
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def invalidate(self, key=None):
+        """
+        Removes ``key`` from the cache, or every entry if ``key`` is ``None``.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        :returns: The hit, stale hit and miss counters and the number of entries.
+
+        :rvalue: dict
+        """
+        return {"hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "size": len(self._entries)}
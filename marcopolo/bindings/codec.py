@@ -0,0 +1,160 @@
+"""
+Wire codecs shared by the Marco and Polo bindings.
+
+JSON is always available and is what the daemons understand by default. If
+the optional ``msgpack`` or ``cbor2`` packages are installed, a binary
+encoding can be negotiated with a ``Hello`` command listing the codecs
+supported by the client, in order of preference. The daemon replies with the
+name of the codec it picked, and daemons which do not know the command reply
+with an error, in which case JSON is kept.
+
+JSON messages are always recognised on reception, so replies sent before
+or during the negotiation are decoded correctly. The optional packages are
+only imported when a negotiation starts or a codec is looked up by name.
+"""
+from __future__ import absolute_import
+import json, threading
+
+import six
+
+class JSONCodec(object):
+    name = "json"
+
+    def __init__(self, allow_nan=True):
+        self._encoder = json.JSONEncoder(allow_nan=allow_nan)
+
+    def encode(self, message):
+        """
+        :raise:
+            :ValueError: If the message cannot be encoded.
+        """
+        try:
+            return self._encoder.encode(message).encode('utf-8')
+        except TypeError as e:
+            raise ValueError(str(e))
+
+    def decode(self, data):
+        """
+        :raise:
+            :ValueError: If the data is not a valid message.
+        """
+        if not isinstance(data, six.text_type):
+            try:
+                # Decoded straight from buffers (bytearray, memoryview) without copying them to bytes first
+                data = six.text_type(data, 'utf-8') if six.PY3 else bytes(data).decode('utf-8')
+            except (TypeError, UnicodeError) as e:
+                raise ValueError(str(e))
+        return json.loads(data)
+
+class MsgPackCodec(object):
+    name = "msgpack"
+
+    def __init__(self):
+        import msgpack # ImportError if it is not installed
+        self._msgpack = msgpack
+
+    def encode(self, message):
+        try:
+            return self._msgpack.packb(message, use_bin_type=True)
+        except TypeError as e:
+            raise ValueError(str(e))
+
+    def decode(self, data):
+        try:
+            return self._msgpack.unpackb(data, raw=False)
+        except Exception as e:
+            raise ValueError(str(e))
+
+class CBORCodec(object):
+    name = "cbor"
+
+    def __init__(self):
+        import cbor2 # ImportError if it is not installed
+        self._cbor2 = cbor2
+
+    def encode(self, message):
+        try:
+            return self._cbor2.dumps(message)
+        except Exception as e:
+            raise ValueError(str(e))
+
+    def decode(self, data):
+        try:
+            return self._cbor2.loads(bytes(data))
+        except Exception as e:
+            raise ValueError(str(e))
+
+JSON = JSONCodec()
+
+_codecs = None
+_codecs_lock = threading.Lock()
+
+def _available():
+    """
+    :returns: The installed codecs by name. The optional packages are imported on the first call.
+    """
+    global _codecs
+    with _codecs_lock:
+        if _codecs is None:
+            codecs = {JSON.name: JSON}
+            for codec_class in (MsgPackCodec, CBORCodec):
+                try:
+                    codecs[codec_class.name] = codec_class()
+                except ImportError:
+                    pass
+            _codecs = codecs
+        return _codecs
+
+PREFERENCES = ("msgpack", "cbor", "json")
+
+def available_codecs(preferences=PREFERENCES):
+    """
+    :returns: The names of the installed codecs among ``preferences``, keeping their order. JSON is always included.
+
+    :rvalue: list
+    """
+    codecs = _available()
+    names = [name for name in preferences if name in codecs]
+    if JSON.name not in names:
+        names.append(JSON.name)
+    return names
+
+def get_codec(name):
+    """
+    :returns: The codec called ``name``, or the JSON codec if it is not available.
+    """
+    if name == JSON.name:
+        return JSON
+    return _available().get(name, JSON)
+
+def hello(preferences=PREFERENCES):
+    """
+    :returns: The command which starts the negotiation of the codec.
+
+    :rvalue: dict
+    """
+    return {"Command": "Hello", "Codecs": available_codecs(preferences)}
+
+def negotiated(response):
+    """
+    :param response: The payload of the reply to :func:`hello`.
+
+    :returns: The codec picked by the daemon, or JSON if the reply does not name an available codec.
+    """
+    if isinstance(response, dict):
+        return get_codec(response.get("Codec"))
+    return JSON
+
+_JSON_START = frozenset(b'{[ \t\r\n') if six.PY3 else frozenset('{[ \t\r\n')
+
+def decode(data, codec=JSON):
+    """
+    Decodes ``data`` with ``codec``, unless ``data`` is a JSON document.
+    Binary encodings never start a map or an array with those bytes.
+
+    :raise:
+        :ValueError: If the data is not a valid message.
+    """
+    if codec.name != JSON.name and len(data) > 0 and (isinstance(data, six.text_type) or data[0] in _JSON_START):
+        return JSON.decode(data)
+    return codec.decode(data)
@@ -0,0 +1,294 @@
+"""
+Filter expressions over the parameters of the nodes.
+
+A filter is written as a small expression::
+
+    zone == "eu-west" and cpus >= 4 and (role in ("web", "api") or exists(canary))
+
+Supported are the comparisons ``==``, ``!=``, ``<``, ``<=``, ``>``, ``>=``,
+``in (...)``, ``exists(...)``, ``not``, ``and``, ``or`` and parentheses.
+Fields are names of parameters (``a.b`` refers to the field ``b`` of the
+parameter ``a``) and values are strings (single or double quoted),
+numbers, ``true``, ``false`` and ``null``. Comparisons on a missing field,
+or between values of different types, are false.
+
+:func:`compile` validates an expression and returns a :class:`Filter`,
+whose ``tree`` is sent to the resolver so that only the matching nodes are
+returned, and which evaluates the expression on the nodes in the client
+(for resolvers which ignore filters and for cached results).
+"""
+from __future__ import absolute_import
+import re, numbers, threading
+from collections import OrderedDict
+
+import six
+
+from marcopolo.bindings.types import NodeSet
+
+COMPARISONS = {"==": "eq", "!=": "ne", "<": "lt", "<=": "le", ">": "gt", ">=": "ge"}
+
+_TOKEN = re.compile(r"""
+    \s*(?:
+      (?P<number>-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?) |
+      (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*') |
+      (?P<op>==|!=|<=|>=|<|>|\(|\)|,) |
+      (?P<name>[A-Za-z_][\w.-]*)
+    )""", re.VERBOSE)
+
+_KEYWORDS = {"and", "or", "not", "in", "exists", "true", "false", "null"}
+
+_MISSING = object()
+
+class FilterError(ValueError):
+    """
+    The filter expression is not valid.
+    """
+    pass
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None or match.end() == position:
+            raise FilterError("Unexpected character at position %d: %r" % (position, text[position:position + 10]))
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "number":
+            value = float(value) if any(c in value for c in ".eE") else int(value)
+        elif kind == "string":
+            value = re.sub(r"\\(.)", r"\1", value[1:-1])
+        elif kind == "name" and value in _KEYWORDS:
+            kind = "keyword"
+        tokens.append((kind, value))
+    return tokens
+
+class _Parser(object):
+    def __init__(self, text):
+        self.tokens = _tokenize(text)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, kind=None, value=None):
+        token = self.peek()
+        if token[0] is None or (kind is not None and token[0] != kind) or (value is not None and token[1] != value):
+            expected = value or kind or "more input"
+            found = "end of the expression" if token[0] is None else repr(token[1])
+            raise FilterError("Expected %s, found %s" % (expected, found))
+        self.position += 1
+        return token[1]
+
+    def parse(self):
+        tree = self.disjunction()
+        if self.position < len(self.tokens):
+            raise FilterError("Unexpected %r" % (self.tokens[self.position][1],))
+        return tree
+
+    def disjunction(self):
+        terms = [self.conjunction()]
+        while self.peek() == ("keyword", "or"):
+            self.take()
+            terms.append(self.conjunction())
+        return terms[0] if len(terms) == 1 else ["or"] + terms
+
+    def conjunction(self):
+        terms = [self.unary()]
+        while self.peek() == ("keyword", "and"):
+            self.take()
+            terms.append(self.unary())
+        return terms[0] if len(terms) == 1 else ["and"] + terms
+
+    def unary(self):
+        token = self.peek()
+        if token == ("keyword", "not"):
+            self.take()
+            return ["not", self.unary()]
+        if token == ("op", "("):
+            self.take()
+            tree = self.disjunction()
+            self.take("op", ")")
+            return tree
+        if token == ("keyword", "exists"):
+            self.take()
+            self.take("op", "(")
+            field = self.take("name")
+            self.take("op", ")")
+            return ["exists", field]
+        field = self.take("name")
+        token = self.peek()
+        if token == ("keyword", "in"):
+            self.take()
+            self.take("op", "(")
+            values = [self.value()]
+            while self.peek() == ("op", ","):
+                self.take()
+                values.append(self.value())
+            self.take("op", ")")
+            return ["in", field, values]
+        if token[0] == "op" and token[1] in COMPARISONS:
+            self.take()
+            return [COMPARISONS[token[1]], field, self.value()]
+        raise FilterError("Expected a comparison after %s" % field)
+
+    def value(self):
+        kind, value = self.peek()
+        if kind in ("number", "string"):
+            self.take()
+            return value
+        if kind == "keyword" and value in ("true", "false", "null"):
+            self.take()
+            return {"true": True, "false": False, "null": None}[value]
+        raise FilterError("Expected a value, found %s" % ("end of the expression" if kind is None else repr(value)))
+
+def _lookup(params, field):
+    value = params
+    for part in field.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+def _comparable(a, b):
+    """
+    Tells whether ``a`` and ``b`` can be ordered (booleans are not numbers here).
+    """
+    if isinstance(a, bool) or isinstance(b, bool):
+        return False
+    if isinstance(a, numbers.Real) and isinstance(b, numbers.Real):
+        return True
+    return isinstance(a, six.string_types) and isinstance(b, six.string_types)
+
+def _equal(a, b):
+    return a == b and isinstance(a, bool) == isinstance(b, bool)
+
+def _evaluate(tree, params):
+    operator = tree[0]
+    if operator == "and":
+        return all(_evaluate(term, params) for term in tree[1:])
+    if operator == "or":
+        return any(_evaluate(term, params) for term in tree[1:])
+    if operator == "not":
+        return not _evaluate(tree[1], params)
+    value = _lookup(params, tree[1])
+    if operator == "exists":
+        return value is not _MISSING
+    if value is _MISSING:
+        return False
+    if operator == "eq":
+        return _equal(value, tree[2])
+    if operator == "ne":
+        return not _equal(value, tree[2])
+    if operator == "in":
+        return any(_equal(value, candidate) for candidate in tree[2])
+    if not _comparable(value, tree[2]):
+        return False
+    if operator == "lt":
+        return value < tree[2]
+    if operator == "le":
+        return value <= tree[2]
+    if operator == "gt":
+        return value > tree[2]
+    return value >= tree[2]
+
+_OPERATORS = {"and": None, "or": None, "not": 1, "exists": 1, "eq": 2, "ne": 2, "lt": 2, "le": 2, "gt": 2, "ge": 2,
+              "in": 2}
+
+def _validate(tree):
+    """
+    Checks a tree received in its wire form.
+    """
+    if not isinstance(tree, list) or not tree or tree[0] not in _OPERATORS:
+        raise FilterError("Invalid filter %r" % (tree,))
+    operator, arguments = tree[0], tree[1:]
+    if operator in ("and", "or"):
+        if not arguments:
+            raise FilterError("Empty %s" % operator)
+        for term in arguments:
+            _validate(term)
+    elif len(arguments) != _OPERATORS[operator]:
+        raise FilterError("Wrong number of arguments of %s" % operator)
+    elif operator == "not":
+        _validate(arguments[0])
+    elif not isinstance(arguments[0], six.string_types):
+        raise FilterError("Invalid field %r" % (arguments[0],))
+    elif operator == "in" and not isinstance(arguments[1], list):
+        raise FilterError("The values of in must be a list")
+
+class Filter(object):
+    """
+    A validated filter expression.
+
+    :param tree: The expression in its wire form, as nested lists (``["and", ["eq", "zone", "eu"], ...]``).
+
+    :param str text: The source of the expression, if any.
+    """
+    def __init__(self, tree, text=None):
+        _validate(tree)
+        self.tree = tree
+        self.text = text
+
+    def matches(self, params):
+        """
+        :param dict params: The parameters of a node.
+
+        :rvalue: bool
+        """
+        return _evaluate(self.tree, params if params is not None else {})
+
+    def __call__(self, node):
+        return self.matches(node.params)
+
+    def filter(self, nodes):
+        """
+        :returns: The nodes whose parameters match the filter.
+
+        :rvalue: marcopolo.bindings.types.NodeSet
+        """
+        return NodeSet(node for node in nodes if self.matches(node.params))
+
+    def __eq__(self, other):
+        return isinstance(other, Filter) and self.tree == other.tree
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(repr(self.tree))
+
+    def __repr__(self):
+        return "Filter(%r)" % (self.text if self.text is not None else self.tree,)
+
+_compiled = OrderedDict()
+_lock = threading.Lock()
+
+def compile(expression):
+    """
+    Validates and compiles a filter. The compiled filters of the last
+    expressions are reused.
+
+    :param expression: The expression, a :class:`Filter` (returned as is) or its wire form.
+
+    :rvalue: Filter
+
+    :raise:
+        :FilterError: If the expression is not valid.
+    """
+    if isinstance(expression, Filter):
+        return expression
+    if isinstance(expression, list):
+        return Filter(expression)
+    if not isinstance(expression, six.string_types):
+        raise FilterError("Invalid filter %r" % (expression,))
+    with _lock:
+        compiled = _compiled.get(expression)
+    if compiled is None:
+        compiled = Filter(_Parser(expression).parse(), expression)
+        with _lock:
+            _compiled[expression] = compiled
+            while len(_compiled) > 256:
+                _compiled.popitem(last=False)
+    return compiled
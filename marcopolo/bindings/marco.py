@@ -1,21 +1,609 @@
 from __future__ import division
 from __future__ import absolute_import
-import json, socket, sys
+import socket, select, sys, os, time, threading, itertools, struct, logging
+from collections import OrderedDict
+from concurrent import futures
+from concurrent.futures import Future
+from six.moves import queue
 
-from marcopolo.bindings.utils import Node
-from marcopolo.marco import conf
+from marcopolo.bindings.types import Node, NodeSet
+from marcopolo.bindings import codec as _codec
+from marcopolo.bindings import buffers as _buffers
+from marcopolo.bindings import retry as _retry
+from marcopolo.bindings import timeouts as _timeouts
+from marcopolo.bindings import metrics as _metrics
+from marcopolo.bindings import cache as _cache
+from marcopolo.bindings.cache import FRESH, STALE
 TIMEOUT = 1000
 MULTICAST_GROUP = '224.0.0.112'
+RESOLVER_ADDRESS = ('127.0.1.1', 1338)
+RESOLVER_SOCKET = '/var/run/marcopolo/marco.sock'
+FRAME_SIZE = 65535 # Largest UDP datagram. Bigger responses are split in chunks
+MAX_DISCOVERED = 4096 # Queries remembered as answered by the resolver, which the snapshot no longer serves
+_LENGTH = struct.Struct("!I") # Prefix of the messages sent over a Unix socket
+
+def _encode_command(command, codec=_codec.JSON):
+    """
+    Serializes a resolver command into the bytes sent over the wire.
+
+    :param dict command: The command, including the ``Command`` key.
+
+    :param codec: The codec negotiated with the resolver.
+
+    :raise:
+        :ValueError: If the command cannot be encoded.
+    """
+    return codec.encode(command)
+
+def _decode_response(data, codec=_codec.JSON):
+    """
+    Parses a resolver response.
+
+    :raise:
+        :MarcoInternalError: If the response is not a valid message.
+    """
+    error_parse = None
+    try:
+        response = _codec.decode(data, codec)
+    except ValueError:
+        error_parse = True
+
+    if error_parse:
+        raise MarcoInternalError("Internal parsing error")
+
+    return response
+
+def _forward(source, target):
+    """
+    Resolves the future ``target`` with the outcome of ``source`` once it is done.
+    """
+    def forward(future):
+        if future.exception() is not None:
+            target.set_exception(future.exception())
+        else:
+            target.set_result(future.result())
+    source.add_done_callback(forward)
+
+_TICK = 0.05 # Seconds between two checks of the deadlines, if the receiver cannot be woken up
+
+def _waker():
+    """
+    :returns: A pair of connected sockets, the first one read by the receiver and the second one written to wake it up, or ``None`` if they are not available.
+    """
+    if not hasattr(socket, "socketpair"):
+        return None
+    error = None
+    try:
+        pair = socket.socketpair()
+    except (socket.error, OSError) as e:
+        error = e
+    if error:
+        logging.debug("Cannot create the wake-up sockets of the receiver: %s", error)
+        return None
+    for waker in pair:
+        waker.setblocking(False)
+    return pair
+
+def _unwrap_response(response):
+    """
+    Splits a resolver response into the request identifier it answers, its
+    position in the response and its payload.
+
+    A response is sent as an envelope ``{"Id": id, "Response": payload}``.
+    Responses which do not fit in a datagram are split into several
+    envelopes, each with the sequence number of the chunk (``Seq``, starting
+    at 0) and a ``More`` flag which is false in the last chunk. The payload
+    of the whole response is the concatenation of the payloads of the chunks.
+
+    Resolvers which do not support request identifiers reply with the bare
+    payload, in which case the identifier is ``None``.
+
+    :returns: A tuple ``(request_id, seq, more, payload)``
+    """
+    if isinstance(response, dict) and "Id" in response:
+        if response.get("Error") is not None:
+            return response["Id"], 0, False, {"Error": response["Error"]}
+        return (response["Id"], response.get("Seq", 0), response.get("More", False),
+                response.get("Response"))
+    return None, 0, False, response
+
+def _versioned(payload):
+    """
+    Tells whether ``payload`` is a versioned response (see :class:`_Versions`).
+    """
+    return isinstance(payload, dict) and "Version" in payload
+
+class _Chunks(object):
+    """
+    Reassembles the chunks of a response, which may arrive out of order or duplicated.
+
+    :param bool keep: If false, only the sequence numbers of the chunks are
+        stored (the payloads are consumed as they arrive).
+
+    :param int limit: If set, the response is complete as soon as this number of nodes has arrived.
+    """
+    def __init__(self, keep=True, limit=None):
+        self.keep = keep
+        self.limit = limit
+        self.count = 0
+        self.chunks = {}
+        self.last = None
+
+    def add(self, seq, more, payload):
+        """
+        Stores a chunk.
+
+        :returns: ``False`` if the chunk was already received.
+        """
+        if seq in self.chunks:
+            return False
+        self.chunks[seq] = payload if self.keep or not isinstance(payload, list) else None
+        if not more or not (isinstance(payload, list) or _versioned(payload)):
+            self.last = seq
+        if isinstance(payload, list):
+            self.count += len(payload)
+        return True
+
+    def complete(self):
+        if self.limit is not None and self.count >= self.limit:
+            return True
+        return self.last is not None and all(seq in self.chunks for seq in range(self.last + 1))
+
+    def payload(self):
+        if len(self.chunks) == 1:
+            payload = next(iter(self.chunks.values()))
+        elif _versioned(self.chunks[0]):
+            payload = {}
+            for seq in sorted(self.chunks):
+                for field, value in self.chunks[seq].items():
+                    if isinstance(value, list):
+                        payload.setdefault(field, []).extend(value)
+                    else:
+                        payload[field] = value
+        else:
+            payload = []
+            for seq in sorted(self.chunks):
+                if self.chunks[seq] is not None:
+                    payload.extend(self.chunks[seq])
+        if self.limit is not None and isinstance(payload, list):
+            return payload[:self.limit]
+        return payload
+
+class _PendingRequest(object):
+    """
+    State of a request waiting for its response.
+
+    :param on_chunk: If set, called with the payload of every chunk as it arrives.
+
+    :param int limit: If set, the request completes once this number of nodes has arrived.
+
+    :param float expected: Seconds the resolver is expected to spend on the command (its discovery timeout).
+    """
+    def __init__(self, command, future, deadline, transform, on_chunk=None, limit=None, expected=0):
+        self.command = command
+        self.sent = time.time()
+        self.expected = expected
+        self.decode = 0.0 # Seconds spent decoding the chunks
+        self.future = future
+        self.deadline = deadline
+        self.transform = transform
+        self.on_chunk = on_chunk
+        self.chunks = _Chunks(keep=on_chunk is None, limit=limit)
+
+class _RetryingRequest(object):
+    """
+    A request sent according to a :class:`marcopolo.bindings.retry.RetryPolicy`.
+    Each attempt is an independent request to the resolver, and ``future``
+    holds the result of the first successful one.
+    """
+    def __init__(self, marco, policy, command, timeout, transform, limit):
+        self.marco = marco
+        self.policy = policy
+        self.command = command
+        self.timeout = timeout
+        self.transform = transform
+        self.limit = limit
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+        self.deadline = time.time() + policy.deadline/1000.0 if policy.deadline is not None else None
+        self.attempts = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._attempt()
+        if self.policy.hedge and self.policy.max_attempts > 1:
+            rtt = self.marco.rtt
+            command = self.command["Command"]
+            if rtt.samples(command) >= self.policy.hedge_min_samples:
+                _retry.schedule(self.timeout/1000.0 + rtt.percentile(command, self.policy.hedge_percentile),
+                                self._hedge)
+        return self.future
+
+    def _attempt(self):
+        with self._lock:
+            if self.future.done():
+                return
+            self.attempts += 1
+            self.in_flight += 1
+        deadline = self.marco._deadline(self.command["Command"], self.timeout)
+        if self.deadline is not None:
+            deadline = min(deadline, self.deadline)
+        attempt = self.marco._send(dict(self.command), self.timeout, self.transform,
+                                   limit=self.limit, deadline=deadline)
+        attempt.add_done_callback(self._done)
+
+    def _hedge(self):
+        with self._lock:
+            if self.future.done() or self.attempts > 1:
+                return
+        self._attempt()
+
+    def _done(self, attempt):
+        exception = attempt.exception()
+        with self._lock:
+            self.in_flight -= 1
+            if self.future.done():
+                return
+            if exception is None:
+                self.future.set_result(attempt.result())
+                return
+            if self.in_flight > 0: # A hedged attempt may still succeed
+                return
+            retry = None
+            if (isinstance(exception, MarcoTimeOutException) and not isinstance(exception, MarcoParameterError)
+                    and self.attempts < self.policy.max_attempts):
+                retry = self.policy.delay(self.attempts)
+                if self.deadline is not None and time.time() + retry >= self.deadline:
+                    retry = None
+            if retry is None:
+                self.future.set_exception(exception)
+                return
+        _retry.schedule(retry, self._attempt)
+
+def _check_error(payload):
+    """
+    Raises :class:`MarcoInternalError` if the resolver replied with an error.
+    """
+    if isinstance(payload, dict) and payload.get("Error") is not None:
+        raise MarcoResolverError("Error in the resolver: %s" % payload.get("Error"))
+    return payload
+
+def _node_from_dict(node_arr, services=()):
+    if "Service" in node_arr:
+        services = (node_arr["Service"],)
+    return Node(node_arr["Address"], services, multicast_group=node_arr.get("Group"),
+                params=node_arr.get("Params", {}))
+
+def _nodes_from_response(nodes_arr, services=()):
+    """
+    Builds a :class:`NodeSet` from the list of nodes returned by the resolver.
+
+    :param tuple services: The services offered by the nodes, unless they are tagged with the ``Service`` they offer.
+    """
+    return NodeSet(_node_from_dict(node_arr, services) for node_arr in nodes_arr)
+
+def _command_services(command):
+    """
+    :returns: The services offered by the nodes of the response to ``command``.
+    """
+    return (command["Params"],) if command.get("Command") == "Request-for" else ()
+
+def _nodes_by_service(services):
+    """
+    Returns a function which groups the nodes of a ``Request-multi`` response
+    (each one tagged with the ``Service`` it offers) by service.
+    """
+    def transform(nodes_arr):
+        result = dict((service, NodeSet()) for service in services)
+        for node_arr in nodes_arr:
+            result.setdefault(node_arr["Service"], NodeSet()).add(_node_from_dict(node_arr))
+        return result
+    return transform
+
+def _compile_filter(where):
+    """
+    Validates a filter expression, if any.
+
+    :rvalue: marcopolo.bindings.filters.Filter
+    """
+    if where is None:
+        return None
+    from marcopolo.bindings import filters
+    return filters.compile(where)
+
+class _Versions(object):
+    """
+    Last version of the result of each query, which lets the resolver reply
+    with the changes since then instead of every node (delta queries).
+
+    The commands carry the version of the result the client has in
+    ``Since`` (``None`` if it has none). A resolver which supports versions
+    replies with a dictionary with the ``Version`` of the new result and
+    either ``Nodes`` (all the nodes), ``NotModified`` (the result has not
+    changed) or the changes: ``Added`` and ``Changed`` (nodes) and
+    ``Removed`` (addresses). The lists may be split in several chunks.
+    Resolvers without versions ignore ``Since`` and reply with the nodes.
+
+    :param int size: Maximum number of queries whose result is kept.
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self._entries = OrderedDict() # Query -> (version, nodes by address)
+        self._lock = threading.Lock()
+
+    def prepare(self, command):
+        """
+        Adds the version of the last result of ``command`` to it.
+
+        :returns: The function which builds the set of nodes from the response.
+        """
+        key = _cache.ResultCache.key(dict((name, value) for name, value in command.items() if name != "timeout"))
+        with self._lock:
+            since, base = self._entries.get(key, (None, None))
+        command["Since"] = since
+        services = _command_services(command)
+        return lambda payload: self._apply(key, since, base, payload, services)
+
+    def _apply(self, key, since, base, payload, services):
+        if not _versioned(payload): # Resolver without versions
+            with self._lock:
+                self._entries.pop(key, None)
+            return _nodes_from_response(payload, services)
+
+        if "Nodes" in payload:
+            nodes = dict((node.address, node) for node in _nodes_from_response(payload["Nodes"], services))
+        elif base is None or (payload.get("NotModified") and payload["Version"] != since):
+            raise MarcoInternalError("Delta response to a query without a known version")
+        elif payload.get("NotModified"):
+            nodes = base
+        else:
+            nodes = dict(base) # The base may be shared with other requests
+            for address in payload.get("Removed", []):
+                nodes.pop(address, None)
+            for node_arr in payload.get("Added", []) + payload.get("Changed", []):
+                node = _node_from_dict(node_arr, services)
+                nodes[node.address] = node
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (payload["Version"], nodes)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return NodeSet(nodes.values())
 
 class Marco(object):
-    def __init__(self, timeout=TIMEOUT, group=MULTICAST_GROUP):
-        self.marco_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-        self.marco_socket.settimeout(2*timeout/1000.0)
+    """
+    Client for the local Marco resolver.
+
+    Every command carries a request identifier which the resolver echoes in
+    its reply, and a background thread routes each reply to the caller which
+    issued it. Therefore, a single instance (and socket) can be shared by
+    several threads and carry many overlapping queries. The ``submit_*``
+    methods return a :class:`concurrent.futures.Future` while the rest block
+    until the response arrives.
+
+    :param int timeout: Default timeout (in milliseconds) of the discovery process.
+
+    :param str group: Multicast group used by ``marco``.
+
+    :param cache: If set, a :class:`marcopolo.bindings.cache.ResultCache` used to store the results of ``request_for``.
+
+    :param codecs: If set, the names of the wire codecs to negotiate with the resolver before the first command, in order of preference (see :mod:`marcopolo.bindings.codec`). Otherwise, JSON is used.
+
+    :param retry: If set, a :class:`marcopolo.bindings.retry.RetryPolicy` applied to every request which times out.
+
+    :param timeouts: If set, a :class:`marcopolo.bindings.timeouts.RTTEstimator`. Replies are then awaited for the discovery timeout plus a margin derived from the observed round-trip times of the command, instead of twice the discovery timeout.
+
+    :param metrics: If set, a :class:`marcopolo.bindings.metrics.Metrics` where the duration of every phase of the commands and their errors are recorded.
+
+    :param tuple address: Address of the resolver. By default, ``RESOLVER_ADDRESS``.
+
+    :param str unix_socket: If set, path of the Unix socket of the resolver (``RESOLVER_SOCKET`` is the usual one). Every message is then prefixed with its length (4 bytes, big endian) and is not limited by the size of a datagram. If the socket does not exist or refuses the connection, UDP is used.
+
+    :param snapshot: If set, a :class:`marcopolo.bindings.snapshot.Snapshot` where the results of ``request_for`` are persisted. Until the resolver answers a query for the first time, the nodes stored in the snapshot are returned immediately while the discovery runs in the background.
+
+    :param bool delta: If set, ``marco`` and ``request_for`` send the version of the last result of the same query, so that a resolver which supports versions replies only with the changes (or that nothing changed). The complete set of nodes is returned anyway.
+    """
+    def __init__(self, timeout=TIMEOUT, group=MULTICAST_GROUP, cache=None, codecs=None, retry=None, timeouts=None,
+                 metrics=None, address=None, unix_socket=None, snapshot=None, delta=False):
+        self.address = address
+        self._unix_path = unix_socket
+        self.unix_socket = None
+        self.marco_socket = None
+        if unix_socket is not None and hasattr(socket, "AF_UNIX") and os.path.exists(unix_socket):
+            self._connect(unix_socket)
+        if self.marco_socket is None:
+            self.marco_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self._closed = False
+        self._waker = _waker() # Interrupts the wait of the receiver when a request with an earlier deadline is sent
+        self._sleeping_until = None # Time until which the receiver waits for a reply
+        self._reading = None # Socket whose partial message is kept below
+        self._header = bytearray(_LENGTH.size) # Partial message of the Unix socket: its length,
+        self._stream = bytearray() # its content,
+        self._length = None # the length once the header is complete,
+        self._received = 0 # and the bytes of the header or the content received
+        self._send_lock = threading.Lock()
         self._timeout = timeout
         self._group = group
+        self._ids = itertools.count(1)
+        self._pending = OrderedDict()
+        self._echoes_ids = False # Whether the resolver has been seen tagging its replies with the request identifier
+        self._lock = threading.Lock()
+        self._receiver = None
+        self.cache = cache
+        self.codec = _codec.JSON
+        self._codecs = codecs
+        self._negotiated = codecs is None
+        self._negotiation = None # Future of the negotiation of the codec, while it runs
+        self.retry = retry
+        self.rtt = timeouts if timeouts is not None else _timeouts.RTTEstimator()
+        self._adaptive = timeouts is not None
+        self.metrics = metrics
+        self._prober = None
+        self.snapshot = snapshot
+        self._discovered = OrderedDict() # Last queries answered by the resolver, no longer served from the snapshot
+        self._versions = _Versions() if delta else None
+
+    def _connect(self, path):
+        """
+        Connects to the Unix socket of the resolver.
+        """
+        unix = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        error = None
+        try:
+            unix.connect(path)
+        except socket.error as e:
+            error = e
+        if error:
+            unix.close()
+            logging.debug("Cannot connect to the resolver at %s (%s), using UDP", path, error)
+            return
+        self.marco_socket = unix
+        self.unix_socket = path
+
+    def _reconnect(self, broken):
+        """
+        Replaces the connection ``broken`` to the Unix socket of the resolver
+        with a new one, or with a UDP socket if the resolver cannot be reached
+        anymore. Must be called with the send lock held.
+
+        :returns: ``False`` if the connection had already been replaced or the instance is closed.
+        """
+        if self._closed or self.marco_socket is not broken or self.unix_socket is None:
+            return False
+        path = self.unix_socket
+        if os.path.exists(path):
+            self._connect(path)
+        if self.marco_socket is broken: # The receiver must not see a UDP socket as a Unix one
+            logging.warning("Lost the connection to the resolver at %s, using UDP", path)
+            self.unix_socket = None
+            self.marco_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        broken.close()
+        return True
+
+    def _transmit(self, message):
+        """
+        Sends an encoded command to the resolver. If the connection to the
+        Unix socket is broken, it is opened again (or UDP is used) and the
+        command is sent once more.
+
+        :returns: The number of bytes sent.
+        """
+        if self.unix_socket is None:
+            return self.marco_socket.sendto(message, self.address or RESOLVER_ADDRESS)
+        with self._send_lock: # The frames of several threads must not interleave
+            unix = self.marco_socket
+            try:
+                unix.sendall(_LENGTH.pack(len(message)) + message)
+                return len(message)
+            except socket.error as e:
+                if not self._reconnect(unix):
+                    raise
+                logging.debug("Error on sending to the resolver (%s), reconnected", e)
+            if self.unix_socket is not None:
+                self.marco_socket.sendall(_LENGTH.pack(len(message)) + message)
+                return len(message)
+        return self.marco_socket.sendto(message, self.address or RESOLVER_ADDRESS)
+
+    def _wait(self, sock, end):
+        """
+        Waits until ``sock`` can be read. The timeout of the socket is not
+        changed, since other threads may be sending through it.
+
+        :raise:
+            :socket.timeout: If nothing arrives before ``end``.
+
+            :socket.error: If the socket is closed.
+        """
+        error = None
+        wait = max(end - time.time(), 0)
+        readers = [sock]
+        if self._waker is not None:
+            readers.append(self._waker[0])
+        else: # The deadlines of new requests are checked at least every tick
+            wait = min(wait, _TICK)
+        try:
+            ready = select.select(readers, [], [], wait)[0]
+        except (select.error, ValueError) as e: # ValueError: closed socket
+            error = e
+        if error:
+            raise socket.error("Error on waiting for the resolver: %s" % (error,))
+        if self._waker is not None and self._waker[0] in ready:
+            try:
+                self._waker[0].recv(64)
+            except socket.error:
+                pass
+        if sock not in ready:
+            raise socket.timeout("timed out")
+
+    def _wake(self):
+        """
+        Interrupts the wait of the receiver, so that it takes the deadline of a new request into account.
+        """
+        if self._waker is None:
+            return
+        try:
+            self._waker[1].send(b"\0")
+        except socket.error: # Full: the receiver is woken up anyway
+            pass
+
+    def _read(self, timeout, frame):
+        """
+        Receives a message from the resolver. Datagrams are received into
+        ``frame`` and the messages of the Unix socket into a buffer of the
+        instance, which only grows when a message does not fit.
+
+        :returns: A memoryview of the message, valid until the next read.
+
+        :raise:
+            :socket.timeout: If no complete message arrives in ``timeout`` seconds. The part of a message already received is kept for the next read.
+
+            :socket.error: If the connection is closed.
+        """
+        sock, unix = self.marco_socket, self.unix_socket is not None
+        end = time.time() + timeout
+        if not unix:
+            self._wait(sock, end)
+            return memoryview(frame)[:sock.recv_into(frame)]
+
+        if sock is not self._reading: # New connection: the partial message of the previous one is lost
+            self._reading = sock
+            self._length, self._received = None, 0
+        while True:
+            if self._length is None and self._received == _LENGTH.size:
+                self._length = _LENGTH.unpack_from(self._header)[0]
+                self._received = 0
+                if self._length > len(self._stream):
+                    self._stream = bytearray(max(self._length, FRAME_SIZE))
+            if self._length is not None and self._received == self._length:
+                message = memoryview(self._stream)[:self._length]
+                self._length, self._received = None, 0
+                return message
+            if self._length is None:
+                target = memoryview(self._header)[self._received:]
+            else:
+                target = memoryview(self._stream)[self._received:self._length]
+            self._wait(sock, end)
+            received = sock.recv_into(target)
+            if not received:
+                raise socket.error("Connection closed by the resolver")
+            self._received += received
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Closes the socket and writes the pending changes of the snapshot. Queries still in flight fail with :class:`MarcoInternalError`.
+        """
+        self._closed = True
         self.marco_socket.close()
+        if self._waker is not None:
+            for waker in self._waker:
+                waker.close()
+        if self.snapshot is not None:
+            self.snapshot.flush()
 
     @property
     def timeout(self):
@@ -25,7 +613,6 @@ class Marco(object):
     def timeout(self, value):
         try:
             self._timeout=int(value)
-            self.marco_socket.settimeout(2*self.timeout/1000.0)
         except ValueError:
             pass
 
@@ -36,8 +623,526 @@ class Marco(object):
     @group.setter
     def group(self, value):
         self._group = value
-    
-    def marco(self, max_nodes=None, exclude=[], params={}, timeout=None, retries=0):
+
+    def _submit(self, command, timeout, transform, on_chunk=None, limit=None, retry=None, deadline=None):
+        """
+        Sends ``command`` to the resolver, retrying it if it times out
+        according to ``retry`` (or the policy of the instance). Streamed
+        requests (with ``on_chunk``) are sent only once, as the chunks of
+        several attempts cannot be told apart. See :meth:`_send` for the
+        rest of the parameters.
+
+        :param int deadline: If set, overall time budget (in milliseconds) of the request, including all the attempts. Overrides the deadline of the retry policy.
+
+        :rvalue: concurrent.futures.Future
+        """
+        if not self._negotiated:
+            self._negotiate(timeout)
+        negotiation = self._negotiation
+        if negotiation is not None and not negotiation.done(): # Sent once the codec is known, without blocking
+            future = Future()
+            future.set_running_or_notify_cancel()
+            start = time.time()
+            def send(_):
+                remaining = max(0, deadline - (time.time() - start)*1000) if deadline is not None else None
+                _forward(self._submit(command, timeout, transform, on_chunk, limit, retry, remaining), future)
+            negotiation.add_done_callback(send)
+            return future
+
+        retry = retry if retry is not None else self.retry
+        if retry is not None and deadline is not None:
+            retry = retry.copy(deadline=deadline)
+        if retry is None or on_chunk is not None or (retry.max_attempts == 1 and retry.deadline is None):
+            attempt_deadline = None
+            if deadline is not None:
+                attempt_deadline = min(self._deadline(command["Command"], timeout), time.time() + deadline/1000.0)
+            future = self._send(command, timeout, transform, on_chunk, limit, attempt_deadline)
+        else:
+            future = _RetryingRequest(self, retry, command, timeout, transform, limit).start()
+
+        if self.metrics is not None:
+            future.add_done_callback(lambda f: self._count_error(command["Command"], f))
+        return future
+
+    def _count_error(self, command, future):
+        if future.exception() is not None:
+            self.metrics.error(command, future.exception())
+
+    def _observe(self, command, phase, start):
+        """
+        Records the time since ``start`` as the duration of ``phase`` of ``command``, if the instance has metrics.
+        """
+        if self.metrics is not None:
+            self.metrics.record(command, phase, time.time() - start)
+
+    def _deadline(self, command, timeout):
+        """
+        :returns: The time at which a request of ``command`` sent now fails.
+            The resolver replies after (at most) ``timeout`` milliseconds,
+            and the margin for the round trip is derived from the observed
+            round-trip times if the instance has an estimator, or is
+            ``timeout`` otherwise.
+        """
+        expected = timeout/1000.0
+        if self._adaptive:
+            return time.time() + expected + self.rtt.timeout(command, expected)
+        return time.time() + 2*expected
+
+    def _send(self, command, timeout, transform, on_chunk=None, limit=None, deadline=None):
+        """
+        Sends ``command`` to the resolver tagged with a new request identifier.
+
+        :param dict command: The command to send.
+
+        :param int timeout: Timeout of the command in milliseconds. The reply is awaited for twice this time.
+
+        :param transform: Callable applied to the payload of the reply to build the result of the future.
+
+        :param on_chunk: If set, called from the receiver thread with the payload of each chunk of the reply.
+
+        :param int limit: If set, the future is resolved as soon as this number of nodes has arrived, even if the resolver keeps sending chunks.
+
+        :param float deadline: If set, the time at which the request fails. By default, see :meth:`_deadline`.
+
+        :returns: A future which holds the result of ``transform`` or the exception raised by the request.
+
+        :rvalue: concurrent.futures.Future
+        """
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        if deadline is None:
+            deadline = self._deadline(command["Command"], timeout)
+        with self._lock:
+            request_id = next(self._ids)
+            command["Id"] = request_id
+
+            error = None
+            start = time.time()
+            try:
+                message = _encode_command(command, self.codec)
+            except (ValueError, TypeError):
+                error = True
+            self._observe(command["Command"], _metrics.ENCODE, start)
+            if error:
+                future.set_exception(MarcoParameterError("Bad parameters"))
+                return future
+
+            request = self._pending[request_id] = _PendingRequest(command["Command"], future, deadline, transform,
+                                                                  on_chunk, limit, timeout/1000.0)
+            wake = self._receiver is not None and self._sleeping_until is not None and deadline < self._sleeping_until
+            if self._receiver is None:
+                self._receiver = threading.Thread(target=self._receive, name="marco-receiver")
+                self._receiver.daemon = True
+                self._receiver.start()
+        if wake:
+            self._wake()
+
+        error = None
+        start = time.time()
+        try:
+            if self._transmit(message) < 1:
+                error = "Error on sending"
+        except socket.error as e:
+            error = "Error on sending: %s" % e
+        request.sent = time.time() # The wait starts once the command is out, not when it was encoded
+        self._observe(command["Command"], _metrics.SEND, start)
+
+        if error:
+            self._fail(request_id, MarcoInternalError(error))
+
+        return future
+
+    def _negotiate(self, timeout):
+        """
+        Starts agreeing on a wire codec with the resolver. Only one attempt
+        is made: if the resolver does not support the negotiation (or does
+        not answer), JSON is kept. The commands submitted meanwhile are sent
+        once it ends (see :meth:`_submit`).
+        """
+        with self._lock:
+            if self._negotiated:
+                return
+            self._negotiated = True
+            self._negotiation = Future()
+            self._negotiation.set_running_or_notify_cancel()
+
+        self._send(_codec.hello(self._codecs), timeout, _codec.negotiated).add_done_callback(self._end_negotiation)
+
+    def _end_negotiation(self, hello):
+        self.codec = hello.result() if hello.exception() is None else _codec.JSON
+        self._negotiation.set_result(self.codec)
+
+    def _unmatched(self):
+        """
+        :returns: The request an untagged datagram belongs to, or ``None`` if it cannot be told. Legacy resolvers do not echo identifiers, so their replies are only routed when a single request is in flight. Must be called with the lock held.
+        """
+        if self._echoes_ids or len(self._pending) != 1:
+            return None
+        return next(iter(self._pending))
+
+    def _fail(self, request_id, exception):
+        """
+        Fails the request ``request_id`` with ``exception``. If it is ``None``
+        (a datagram which cannot be decoded), the only request in flight of a
+        legacy resolver is failed, and the error is dropped otherwise.
+        """
+        with self._lock:
+            if request_id is None:
+                request_id = self._unmatched()
+                if request_id is None:
+                    logging.debug("Dropped a datagram from the resolver: %s", exception)
+                    return
+            request = self._pending.pop(request_id, None)
+
+        if request is not None:
+            request.future.set_exception(exception)
+
+    def _dispatch(self, request_id, seq, more, payload, decode=0.0):
+        """
+        Stores a chunk of the response to ``request_id`` and resolves its future
+        once all the chunks have arrived. If ``request_id`` is ``None``, the
+        reply is routed as described in :meth:`_unmatched`, or dropped, so
+        that it never reaches a query it does not answer.
+
+        :param float decode: Seconds spent decoding the chunk.
+        """
+        with self._lock:
+            if request_id is None:
+                request_id = self._unmatched()
+                if request_id is None:
+                    logging.debug("Dropped an untagged reply of the resolver")
+                    return
+            else:
+                self._echoes_ids = True
+            request = self._pending.get(request_id)
+            if request is None: # Late reply of an expired request
+                return
+            if not request.chunks.add(seq, more, payload):
+                return
+            request.decode += decode
+            complete = request.chunks.complete()
+            if complete:
+                del self._pending[request_id]
+
+        if complete:
+            # Only the time beyond the discovery timeout is due to the round trip. Replies which end before
+            # it (streamed or early completed requests, commands which do not wait for the discovery) say
+            # nothing about the margin and are not observed.
+            elapsed = time.time() - request.sent
+            if request.on_chunk is None and elapsed >= request.expected:
+                self.rtt.observe(request.command, elapsed - request.expected)
+            self._observe(request.command, _metrics.WAIT, request.sent)
+        start = time.time()
+
+        try:
+            if request.on_chunk is not None and isinstance(payload, list):
+                request.on_chunk(payload)
+
+            if complete:
+                result = request.transform(_check_error(request.chunks.payload()))
+                if self.metrics is not None:
+                    self.metrics.record(request.command, _metrics.DECODE, request.decode + time.time() - start)
+                request.future.set_result(result)
+        except MarcoInternalError as e:
+            request.future.set_exception(e)
+        except (KeyError, TypeError, AttributeError):
+            request.future.set_exception(MarcoInternalError("Internal parsing error"))
+        if not complete and request.future.done():
+            with self._lock:
+                self._pending.pop(request_id, None)
+
+    def _expire(self, now):
+        """
+        Fails the pending requests whose deadline is over.
+
+        :returns: Seconds until the next deadline, or ``None`` if no requests remain.
+        """
+        expired = []
+        with self._lock:
+            for request_id, request in list(self._pending.items()):
+                if request.deadline <= now:
+                    expired.append(self._pending.pop(request_id))
+            if not self._pending:
+                self._receiver = None
+                self._sleeping_until = next_deadline = None
+            else:
+                self._sleeping_until = min(request.deadline for request in self._pending.values())
+                next_deadline = self._sleeping_until - now
+
+        for request in expired:
+            request.future.set_exception(MarcoTimeOutException("No connection to the resolver"))
+
+        return next_deadline
+
+    def _receive(self):
+        """
+        Receiver loop. Runs while there are pending requests and routes every datagram to its request.
+        """
+        pool = _buffers.get_pool()
+        frame = pool.acquire()
+        try:
+            self._receive_into(frame)
+        finally:
+            pool.release(frame)
+
+    def _receive_into(self, frame):
+        """
+        Body of the receiver loop, which reads the datagrams into ``frame``.
+        """
+        while True:
+            wait = self._expire(time.time())
+            if wait is None:
+                return
+
+            try:
+                data = self._read(max(wait, 0.001), frame)
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                with self._send_lock:
+                    with self._lock:
+                        failed = list(self._pending.keys())
+                    if self._reading is not None and self._reconnect(self._reading):
+                        logging.debug("Error on receiving from the resolver (%s), reconnected", e)
+                for request_id in failed:
+                    self._fail(request_id, MarcoInternalError("Error on communication: %s" % e))
+                continue
+
+            start = time.time()
+            try:
+                request_id, seq, more, payload = _unwrap_response(_decode_response(data, self.codec))
+            except MarcoInternalError as e:
+                self._fail(None, e)
+                continue
+            finally:
+                data = None # The frame is reused by the next read
+
+            self._dispatch(request_id, seq, more, payload, time.time() - start)
+
+    def _iter(self, command, timeout, limit=None):
+        """
+        Sends ``command`` and yields the nodes of the response as its chunks
+        arrive. Chunks are not kept once they have been consumed.
+        """
+        chunks = queue.Queue()
+        future = self._submit(command, timeout, lambda payload: None, chunks.put, limit)
+        future.add_done_callback(lambda f: chunks.put(None))
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            error = None
+            try:
+                nodes = _nodes_from_response(chunk, _command_services(command))
+            except (KeyError, TypeError, AttributeError):
+                error = True
+            if error:
+                raise MarcoInternalError("Internal parsing error")
+            for node in nodes:
+                if limit is not None:
+                    if limit == 0:
+                        break
+                    limit -= 1
+                yield node
+
+        future.result() # Raises the error of the request, if any
+
+    def _marco_command(self, max_nodes, exclude, params, timeout, stream=False, where=None):
+        command = {"Command": "Marco",
+                   "max_nodes": max_nodes,
+                   "exclude":exclude,
+                   "params":params,
+                   "group":self.group,
+                   "timeout":timeout}
+        if stream:
+            command["Stream"] = True
+        if where is not None:
+            command["Filter"] = where.tree
+        return command
+
+    def _request_for_command(self, service, node, max_nodes, exclude, params, timeout, stream=False, where=None):
+        command = {"Command": "Request-for",
+                   "Params":service,
+                   "node":node,
+                   "max_nodes":max_nodes,
+                   "exclude":exclude,
+                   "params":params,
+                   "timeout":timeout}
+        if stream:
+            command["Stream"] = True
+        if where is not None:
+            command["Filter"] = where.tree
+        return command
+
+    def submit_marco(self, max_nodes=None, exclude=[], params={}, timeout=None, stream=False, retries=None,
+                     deadline=None, where=None):
+        """
+        Non-blocking version of :meth:`marco`.
+
+        :returns: A future holding the set of responding nodes.
+
+        :rvalue: concurrent.futures.Future
+        """
+        timeout = timeout if timeout else self.timeout
+        retry = None
+        if retries:
+            retry = (self.retry or _retry.RetryPolicy()).copy(max_attempts=retries + 1)
+        where = _compile_filter(where)
+        command = self._marco_command(max_nodes, exclude, params, timeout, stream, where)
+        return self._submit(command, timeout, self._transform(command, where), limit=max_nodes if stream else None,
+                            retry=retry, deadline=deadline)
+
+    def _transform(self, command, where=None):
+        """
+        :returns: The function which builds the set of nodes from the response to ``command``, which is made a delta query if the instance uses them. If there is a filter, it is applied to the nodes as well, since not every resolver evaluates them.
+        """
+        if self._versions is None or command.get("Stream"):
+            services = _command_services(command)
+            transform = lambda payload: _nodes_from_response(payload, services)
+        else:
+            transform = self._versions.prepare(command)
+        if where is None:
+            return transform
+        return lambda payload: where.filter(transform(payload))
+
+    def submit_request_for(self, service, node=None, max_nodes=None, exclude=[], params={}, timeout=None, stream=False,
+                           deadline=None, where=None):
+        """
+        Non-blocking version of :meth:`request_for`.
+
+        If the instance has a cache, fresh results are returned from it
+        without contacting the resolver. Stale results are returned as well
+        while a refresh is sent in the background. A filtered query is also
+        answered by filtering the fresh result of the same query without
+        filter, if it is cached. If the instance has a snapshot, the nodes
+        stored in it are returned until the resolver answers the query for
+        the first time.
+
+        :returns: A future holding the set of nodes offering the requested service.
+
+        :rvalue: concurrent.futures.Future
+        """
+        timeout = timeout if timeout else self.timeout
+        where = _compile_filter(where)
+        command = self._request_for_command(service, node, max_nodes, exclude, params, timeout, stream, where)
+        limit = max_nodes if stream else None
+        transform = self._transform(command, where)
+        if self.cache is None and self.snapshot is None:
+            return self._submit(command, timeout, transform, limit=limit, deadline=deadline)
+
+        key = _cache.ResultCache.key(service, node, max_nodes, exclude, params,
+                                     *([where.tree] if where is not None else []))
+        if self.cache is not None:
+            nodes, state = self.cache.lookup(key, count=False) # One outcome is counted per query
+            if state != FRESH and where is not None and max_nodes is None:
+                unfiltered, fresh = self.cache.lookup(_cache.ResultCache.key(service, node, max_nodes, exclude, params),
+                                                      count=False)
+                if fresh == FRESH:
+                    nodes, state = where.filter(unfiltered), FRESH
+            self.cache.record(state)
+            if state == FRESH or state == STALE:
+                if state == STALE and self.cache.start_refresh(key):
+                    self._submit(command, timeout, transform, limit=limit,
+                                 deadline=deadline).add_done_callback(lambda f: self._store(key, f))
+                future = Future()
+                future.set_result(NodeSet(nodes))
+                return future
+
+        future = self._submit(command, timeout, transform, limit=limit, deadline=deadline)
+        if self.cache is not None:
+            future.add_done_callback(lambda f: self._store(key, f))
+        if self.snapshot is not None:
+            discovery, future = future, Future()
+            nodes = self._warm_start(key)
+            if nodes is not None:
+                future.set_result(NodeSet(nodes))
+                discovery.add_done_callback(lambda f: self._save(key, f))
+            else: # The result is stored in the snapshot before the caller gets it
+                discovery.add_done_callback(lambda f: self._save(key, f, future))
+        return future
+
+    def _store(self, key, future):
+        if future.exception() is None:
+            self.cache.store(key, frozenset(future.result()))
+        else:
+            self.cache.end_refresh(key)
+
+    def _warm_start(self, key):
+        """
+        :returns: The nodes of the snapshot under ``key``, until the discovery of the query succeeds once.
+        """
+        if key in self._discovered:
+            return None
+        return self.snapshot.get(key)[0]
+
+    def _save(self, key, discovery, future=None):
+        try:
+            error = discovery.exception()
+            if error is None:
+                with self._lock:
+                    self._discovered.pop(key, None)
+                    self._discovered[key] = None
+                    while len(self._discovered) > MAX_DISCOVERED:
+                        self._discovered.popitem(last=False)
+                self.snapshot.put(key, discovery.result())
+            if future is not None:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(discovery.result())
+        except Exception as e: # The caller waiting for the nodes must get an answer anyway
+            if future is not None and not future.done():
+                future.set_exception(e)
+            else:
+                logging.exception("Cannot store the nodes of %s in the discovery snapshot", key)
+
+    def submit_services(self, node, timeout=None, deadline=None):
+        """
+        Non-blocking version of :meth:`services`.
+
+        :returns: A future holding the list of services offered by the node.
+
+        :rvalue: concurrent.futures.Future
+        """
+        return self._submit({"Command": "Services",
+                             "node": node,
+                             "timeout":timeout}, timeout if timeout else self.timeout, lambda services: services,
+                            deadline=deadline)
+
+    def iter_marco(self, max_nodes=None, exclude=[], params={}, timeout=None, stream=False):
+        """
+        Generator version of :meth:`marco`. Nodes are yielded as the chunks of
+        the response arrive, so processing can start before the discovery is
+        over and the complete response is never held in memory.
+
+        With ``stream`` set, the resolver forwards every reply as soon as it
+        arrives instead of waiting for the end of the discovery.
+
+        :raise:
+            :MarcoTimeOutException: If the response is not complete before the timeout.
+        """
+        timeout = timeout if timeout else self.timeout
+        return self._iter(self._marco_command(max_nodes, exclude, params, timeout, stream), timeout,
+                          max_nodes if stream else None)
+
+    def iter_request_for(self, service, node=None, max_nodes=None, exclude=[], params={}, timeout=None, stream=False):
+        """
+        Generator version of :meth:`request_for`. Nodes are yielded as the
+        chunks of the response arrive. The cache is not used.
+
+        With ``stream`` set, the resolver forwards every reply as soon as it
+        arrives instead of waiting for the end of the discovery.
+
+        :raise:
+            :MarcoTimeOutException: If the response is not complete before the timeout.
+        """
+        timeout = timeout if timeout else self.timeout
+        return self._iter(self._request_for_command(service, node, max_nodes, exclude, params, timeout, stream),
+                          timeout, max_nodes if stream else None)
+
+    def marco(self, max_nodes=None, exclude=[], params={}, timeout=None, retries=0, stream=False, deadline=None,
+              where=None):
         """
         **C struct node * marco(int timeout)**
 
@@ -53,63 +1158,24 @@ class Marco(object):
 
         :param int timeout: If set, overrides the default timeout value.
 
-        :param int retries: If set to a value greater than 0, retries the *retries* times if the first attempt is unsuccessful
+        :param int retries: If set to a value greater than 0, retries the *retries* times if the first attempt is unsuccessful. The backoff of the retry policy of the instance (or the default one) is used.
 
-        :returns: A list of all responding nodes.
-        """
+        :param bool stream: If set, the resolver forwards the replies as they arrive and the call returns as soon as `max_nodes` nodes have replied, instead of waiting for the whole timeout.
 
-        timeout = timeout if timeout else self.timeout
-        #if sys.version_info[0] < 3:
-        sendvalue =  self.marco_socket.sendto(bytes(json.dumps({"Command": "Marco", 
-                                                       "max_nodes": max_nodes,
-                                                       "exclude":exclude,
-                                                       "params":params,
-                                                       "timeout":timeout,
-                                                       "group":self.group,
-                                                       "timeout":timeout}).encode('utf-8')), 
-                                                       ('127.0.1.1', 1338))
-
-        if sendvalue < 1:
-            raise MarcoInternalError("Error on sending")
-
-        #else:
-        #    self.marco_socket.sendto(bytes(json.dumps({"Command": "Marco", 
-                                                       # "max_nodes": max_nodes,
-                                                       # "exclude":exclude,
-                                                       # "params":params,
-                                                       # "timeout":timeout,
-                                                       # "group":self.group,
-                                                       # "timeout":self.timeout}), 'utf-8'), 
-                                                       # ('127.0.1.1', 1338))
-        
-        
-        error = None
-        try:
-            data = self.marco_socket.recv(4096)
-        except socket.timeout:
-            error = True
-        if error:
-            raise MarcoTimeOutException("No connection to the resolver")
+        :param int deadline: If set, overall time budget (in milliseconds) of the call, including the retries.
 
-        error_parse = None
-        try:
-            nodes = json.loads(data.decode('utf-8'))
-        except ValueError:
-            error_parse = True
-        
-        if error_parse:
-            raise MarcoInternalError("Internal parsing error")
-        
-        nodes_set = set()
-        for node in nodes:
-            n = Node()
-            n.address = node["Address"]
-            n.params = node.get("Params", {})
-            nodes_set.add(n)
+        :param where: If set, a filter expression (see :mod:`marcopolo.bindings.filters`) on the parameters of the nodes. The resolver only returns the matching nodes.
 
-        return nodes_set
+        :returns: A list of all responding nodes.
 
-    def request_for(self, service, node=None, max_nodes=None, exclude=[], params={}, timeout=None):
+        :raise:
+            :FilterError: If ``where`` is not a valid filter expression.
+        """
+
+        return self.submit_marco(max_nodes, exclude, params, timeout, stream, retries, deadline, where).result()
+
+    def request_for(self, service, node=None, max_nodes=None, exclude=[], params={}, timeout=None, stream=False,
+                    deadline=None, probe=None, where=None):
         """
         **C: struct node * request_for(const char * service)**
 
@@ -127,74 +1193,72 @@ class Marco(object):
 
         Please note that the function will block the execution of the thread until the timeout in the Marco configuration file is triggered. Though this should not be a problem for most application, it is worth knowing.
         
+        :param bool stream: If set, the resolver forwards the replies as they arrive and the call returns as soon as `max_nodes` nodes have replied.
+
+        :param int deadline: If set, overall time budget (in milliseconds) of the call, including the retries.
+
+        :param probe: If ``True`` (or a :class:`marcopolo.bindings.probe.Prober`), the latency of every node is measured and a list of the reachable nodes, the fastest first, is returned instead. ``True`` probes the port in the ``port`` parameter of each node.
+
+        :param where: If set, a filter expression (see :mod:`marcopolo.bindings.filters`) on the parameters of the service in each node, for example ``'zone == "eu" and cpus >= 4'``. The resolver only returns the matching nodes.
+
+        If the instance was created with a ``cache``, the result may be served from it.
+
         :returns: A list of nodes offering the requested service.
 
-        :rvalue: set()
+        :rvalue: marcopolo.bindings.types.NodeSet
 
         :raise:
             :MarcoTimeOutException: If no connection can be made to the local resolver (probably due a failure start of the daemon).
 
+            :FilterError: If ``where`` is not a valid filter expression.
+
         """
-        timeout = timeout if timeout else self.timeout
-        error = None
-        rvalue = None
-        try:
-            
-            rvalue = self.marco_socket.sendto(bytes(json.dumps({"Command": "Request-for", 
-                                                           "Params":service, 
-                                                           "node":node, 
-                                                           "max_nodes":max_nodes, 
-                                                           "exclude":exclude, 
-                                                           "params":params, 
-                                                           "timeout":timeout}).encode('utf-8')), ('127.0.1.1', 1338))
-        except ValueError as e:
-            error = True
-        if error:
-            raise MarcoTimeOutException("Bad parameters")
+        nodes = self.submit_request_for(service, node, max_nodes, exclude, params, timeout, stream, deadline,
+                                        where).result()
+        if probe:
+            return self.probe(nodes, probe if probe is not True else None)
+        return nodes
 
-        if rvalue < 1:
-            raise MarcoInternalError("Error on communication")
+    def probe(self, nodes, prober=None):
+        """
+        Measures the latency of ``nodes`` concurrently and ranks them. The
+        results are cached for a few seconds by the prober.
 
-        error = None
-        try:
-            data, address = self.marco_socket.recvfrom(4096)
-        except socket.timeout:
-            error = True
-        if error:
-            raise MarcoTimeOutException('No connection to the resolver')
+        :param nodes: The nodes to probe.
 
-        error_parse = None
-        try:
-            nodes_arr = json.loads(data.decode('utf-8'))
-        except ValueError:
-            error_parse = True
-        
-        if error_parse:
-            raise MarcoInternalError("Internal parsing error")
-        
-        nodes = set()
-        for node_arr in nodes_arr:
-            node = Node()
-            node.address = node_arr["Address"]
-            node.params = node_arr["Params"]
+        :param prober: The :class:`marcopolo.bindings.probe.Prober` used. By default, one shared by the instance, which probes the port in the ``port`` parameter of each node.
 
-            nodes.add(node)
-        return nodes
+        :returns: The reachable nodes, the fastest first. Nodes without a port to probe go last.
+
+        :rvalue: list
+        """
+        if prober is None:
+            if self._prober is None:
+                from marcopolo.bindings.probe import Prober
+                self._prober = Prober()
+            prober = self._prober
+        return prober.rank(nodes)
 
-    def request_one_for(self, exclude=[], timeout=None):
+    def request_one_for(self, service, exclude=[], params={}, timeout=None):
         """
         Returns one node picked at random from the responses (more precisely, the first replying node) or the one which first satisfies the given exclusion criteria. This function is equivalent to ``request_for`` with max_nodes=1
 
+        The resolver forwards the replies as they arrive, so the call returns as soon as the first node answers instead of waiting for the whole timeout.
+
+        :param string service: The name of the service to look for
+
         :param list exclude: List of nodes not to be included in the response.
 
         :param int timeout: If set, overrides the default timeout value.
 
-        :returns: The picked node
+        :returns: The picked node, or ``None`` if no node offers the service
 
         :rvalue: Node
         """
+        nodes = self.request_for(service, max_nodes=1, exclude=exclude, params=params, timeout=timeout, stream=True)
+        return next(iter(nodes), None)
 
-    def services(self, node, timeout=None):
+    def services(self, node, timeout=None, deadline=None):
         """
         Returns all the services available in the node identified by the given ``node``. In the event that the node does not reply to the response, a exception will be raised.
         
@@ -208,43 +1272,155 @@ class Marco(object):
 
         :param int timeout: If set, overrides the default timeout value.
 
+        :param int deadline: If set, overall time budget (in milliseconds) of the call, including the retries.
+
         :returns: A list of the services offered by a node.
 
         :rvalue: set()
 
         """
 
-        #if sys.version_info[0] < 3:
-        self.marco_socket.sendto(bytes(json.dumps({"Command": "Services",
-             "node": node,
-             "timeout":timeout}).encode('utf-8')), ('127.0.1.1', 1338))
-        #else:
-        #     self.marco_socket.sendto(bytes(json.dumps({"Command": "Services",
-        #     "node": node,
-        #     "timeout":timeout}), 'utf-8'), ('127.0.1.1', conf.POLOPORT))
+        return self.submit_services(node, timeout, deadline).result()
 
-        error = None
-        try:
-            data = self.marco_socket.recv(4096)
-        except socket.timeout:
-            error = True
-        
-        if error:
-            raise MarcoTimeOutException("No connection to the resolver")
+    def services_many(self, nodes, concurrency=32, timeout=None, deadline=None):
+        """
+        Returns the services available in each of ``nodes``. The queries are
+        pipelined over the socket of the instance, with at most
+        ``concurrency`` of them in flight, so a slow node only delays its
+        own result.
+
+        :param nodes: The nodes (or their addresses) to ask.
+
+        :param int concurrency: Maximum number of queries waiting for a reply at the same time.
+
+        :param int timeout: If set, overrides the default timeout value of each query.
+
+        :param int deadline: If set, overall time budget (in milliseconds) of each query, including the retries.
+
+        :returns: A tuple ``(services, errors)`` of dictionaries by node: the services of the nodes which replied and the exception raised by the query of the others.
+
+        :rvalue: tuple
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be greater than 0")
+        waiting = list(nodes)
+        waiting.reverse()
+        in_flight = {} # Future -> node
+        services, errors = {}, {}
+        while waiting or in_flight:
+            while waiting and len(in_flight) < concurrency:
+                node = waiting.pop()
+                in_flight[self.submit_services(getattr(node, "address", node), timeout, deadline)] = node
+            done, _ = futures.wait(list(in_flight), return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                node = in_flight.pop(future)
+                error = future.exception()
+                if error is not None:
+                    errors[node] = error
+                else:
+                    services[node] = future.result()
+        return services, errors
+
+    def watch(self, service, callback=None):
+        """
+        Watches the nodes offering ``service``. The discovery runs in the
+        background and only the changes (``added``, ``removed`` and
+        ``params_changed`` events) are notified. The watcher is shared by the
+        instances with the same resolver, group, timeout and codecs, so every
+        service is polled once per interval no matter how many subscribers
+        it has.
 
-        error_parse = None
+        :param string service: The name of the service.
+
+        :param callback: If set, called with each :class:`marcopolo.bindings.watch.WatchEvent`. Otherwise, the events can be consumed by iterating over the returned subscription.
+
+        :returns: The subscription, which must be cancelled when the events are no longer needed.
+
+        :rvalue: marcopolo.bindings.watch.Subscription
+        """
+        from marcopolo.bindings.watch import get_watcher
+        return get_watcher(**self._watch_options()).subscribe(service, callback)
+
+    def _watch_options(self):
+        """
+        :returns: The options of the watcher which reaches the resolver as this instance does.
+        """
+        return {"timeout": self.timeout, "group": self.group, "codecs": self._codecs, "address": self.address,
+                "unix_socket": self._unix_path}
+
+    def balancer(self, service, strategy="round_robin", weight="weight", watch=False, **kwargs):
+        """
+        Builds a :class:`marcopolo.bindings.balancer.Balancer` over the nodes offering ``service``.
+
+        :param str strategy: The selection strategy (see :mod:`marcopolo.bindings.balancer`).
+
+        :param str weight: Name of the parameter of the nodes used as weight by the ``weighted`` strategy.
+
+        :param bool watch: If set, the nodes of the balancer are kept up to date in the background.
+
+        :param kwargs: Other arguments of :meth:`request_for`.
+
+        :rvalue: marcopolo.bindings.balancer.Balancer
+        """
+        from marcopolo.bindings.balancer import Balancer
+        balancer = Balancer(self.request_for(service, **kwargs), strategy, weight)
+        if watch:
+            balancer.watch(service, self)
+        return balancer
+
+    def submit_request_multi(self, services, max_nodes=None, exclude=[], params={}, timeout=None, deadline=None):
+        """
+        Non-blocking version of :meth:`request_multi`. The fallback for
+        resolvers without ``Request-multi`` support is not applied.
+
+        :rvalue: concurrent.futures.Future
+        """
+        timeout = timeout if timeout else self.timeout
+        services = list(services)
+        return self._submit({"Command": "Request-multi",
+                             "Services": services,
+                             "max_nodes": max_nodes,
+                             "exclude": exclude,
+                             "params": params,
+                             "timeout": timeout}, timeout, _nodes_by_service(services), deadline=deadline)
+
+    def request_multi(self, services, max_nodes=None, exclude=[], params={}, timeout=None, deadline=None):
+        """
+        Requests the nodes offering each of the given services in a single
+        round trip to the resolver, so the lookup costs one timeout instead
+        of one per service.
+
+        If the resolver does not understand the ``Request-multi`` command, one
+        ``request_for`` per service is sent instead. All of them are in flight
+        at the same time.
+
+        :param list services: The names of the services to look for.
+
+        :param int max_nodes: Maximum number of nodes returned for each service.
+
+        :param list exclude: List of nodes to be excluded from the response.
+
+        :param int timeout: If set, overrides the default timeout value.
+
+        :param int deadline: If set, overall time budget (in milliseconds) of the call, including the fallback.
+
+        :returns: A dictionary with the set of nodes offering each service.
+
+        :rvalue: dict
+        """
+        services = list(services)
+        start = time.time()
         try:
-            services_list = json.loads(data.decode('utf-8'))
-        except ValueError:
-            error_parse = True
-        
-        if error_parse:
-            raise MarcoInternalError("Internal parsing error")
-        
-        return services_list
+            return self.submit_request_multi(services, max_nodes, exclude, params, timeout, deadline).result()
+        except MarcoResolverError:
+            pass
 
-    def request_multi(self, services, max_nodes=None, exclude=[], params={}, timeout=None):
-        pass
+        if deadline is not None:
+            deadline = max(0, deadline - (time.time() - start)*1000)
+        pending = [self.submit_request_for(service, max_nodes=max_nodes, exclude=exclude,
+                                           params=params, timeout=timeout, deadline=deadline)
+                   for service in services]
+        return dict((service, future.result()) for service, future in zip(services, pending))
 
 class MarcoTimeOutException(Exception):
     """
@@ -252,8 +1428,20 @@ class MarcoTimeOutException(Exception):
     """
     pass
 
+class MarcoParameterError(MarcoTimeOutException):
+    """
+    Raised if the command cannot be encoded. It is never retried.
+    """
+    pass
+
 class MarcoInternalError(Exception):
     """
     Raised if an internal exception occurs
     """
     pass
+
+class MarcoResolverError(MarcoInternalError):
+    """
+    Raised if the resolver replies with an error (for example, an unsupported command)
+    """
+    pass
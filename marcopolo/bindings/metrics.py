@@ -0,0 +1,209 @@
+"""
+Latency histograms and error counters of the commands sent by the Marco
+and Polo bindings.
+
+Every command is timed in four phases: ``encode`` (serialization of the
+command), ``send`` (system call), ``wait`` (until the last chunk of the
+response arrives) and ``decode`` (parsing of the response and building of
+the result). Failed commands are counted by exception type.
+
+The figures can be read with :meth:`Metrics.snapshot`, rendered in the
+Prometheus text format with :meth:`Metrics.prometheus`, or forwarded as they
+are recorded to exporters such as :class:`StatsDExporter`.
+"""
+from __future__ import division
+from __future__ import absolute_import
+import re, socket, threading, logging
+
+ENCODE, SEND, WAIT, DECODE = "encode", "send", "wait", "decode"
+PHASES = (ENCODE, SEND, WAIT, DECODE)
+
+SUB_BUCKET_BITS = 5 # 32 sub-buckets per power of 2, about 3% of relative error
+
+class Histogram(object):
+    """
+    Log-linear histogram of durations (in the style of HdrHistogram).
+    Values are stored in microseconds in buckets whose width grows with the
+    value, so the memory used does not depend on the number of samples and
+    the relative error of the percentiles is bounded.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    @staticmethod
+    def _index(value):
+        # The leading bit is always set, so one more bit is kept to get 2 ** SUB_BUCKET_BITS sub-buckets
+        shift = value.bit_length() - SUB_BUCKET_BITS - 1
+        if shift <= 0:
+            return value
+        return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+    @staticmethod
+    def _value(index):
+        """
+        :returns: The middle of the bucket ``index``, in microseconds.
+        """
+        shift = (index >> SUB_BUCKET_BITS) - 1
+        if shift <= 0:
+            return index
+        low = ((index & ((1 << SUB_BUCKET_BITS) - 1)) | (1 << SUB_BUCKET_BITS)) << shift
+        return low + ((1 << shift) - 1) / 2
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1e6))
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def percentile(self, p):
+        """
+        :returns: The ``p`` percentile of the recorded values, in seconds, or ``None`` if there are none.
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(round(p / 100.0 * self.count)))
+        if rank >= self.count:
+            return self.max
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(max(self._value(index) / 1e6, self.min), self.max)
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count,
+                "sum": self.total,
+                "min": self.min,
+                "max": self.max,
+                "mean": self.total / self.count if self.count else None,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "p999": self.percentile(99.9)}
+
+class Metrics(object):
+    """
+    Collects the timings and errors of the commands. An instance can be
+    shared by several :class:`marcopolo.bindings.marco.Marco` and
+    :class:`marcopolo.bindings.polo.Polo` instances.
+
+    :param list exporters: Objects with ``timing(command, phase, seconds)`` and ``error(command, error)`` methods, called every time a value is recorded.
+    """
+    def __init__(self, exporters=()):
+        self.exporters = list(exporters)
+        self._histograms = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    def _export(self, method, *args):
+        for exporter in self.exporters:
+            try:
+                getattr(exporter, method)(*args)
+            except Exception:
+                logging.exception("Error in the metrics exporter %r", exporter)
+
+    def record(self, command, phase, seconds):
+        """
+        Records the duration (in seconds) of a phase of ``command``.
+        """
+        with self._lock:
+            histogram = self._histograms.get((command, phase))
+            if histogram is None:
+                histogram = self._histograms[(command, phase)] = Histogram()
+            histogram.record(seconds)
+        self._export("timing", command, phase, seconds)
+
+    def error(self, command, exception):
+        """
+        Counts a failure of ``command``, by the type of ``exception``.
+        """
+        name = type(exception).__name__
+        with self._lock:
+            errors = self._errors.setdefault(command, {})
+            errors[name] = errors.get(name, 0) + 1
+        self._export("error", command, name)
+
+    def snapshot(self):
+        """
+        :returns: A dictionary with, for each command, the statistics of every phase (``count``, ``sum``, ``min``, ``max``, ``mean`` and percentiles, in seconds) and the number of ``errors`` of each type.
+
+        :rvalue: dict
+        """
+        result = {}
+        with self._lock:
+            for (command, phase), histogram in self._histograms.items():
+                result.setdefault(command, {"errors": {}})[phase] = histogram.snapshot()
+            for command, errors in self._errors.items():
+                result.setdefault(command, {"errors": {}})["errors"] = dict(errors)
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._errors.clear()
+
+    def prometheus(self, prefix="marcopolo"):
+        """
+        :returns: The metrics in the Prometheus text exposition format, as a summary of the durations and a counter of the errors.
+
+        :rvalue: str
+        """
+        snapshot = self.snapshot()
+        lines = ["# TYPE %s_command_seconds summary" % prefix]
+        for command in sorted(snapshot):
+            for phase in PHASES:
+                stats = snapshot[command].get(phase)
+                if stats is None:
+                    continue
+                labels = 'command="%s",phase="%s"' % (command, phase)
+                for quantile, key in (("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99"), ("0.999", "p999")):
+                    lines.append('%s_command_seconds{%s,quantile="%s"} %r' % (prefix, labels, quantile, stats[key]))
+                lines.append("%s_command_seconds_sum{%s} %r" % (prefix, labels, stats["sum"]))
+                lines.append("%s_command_seconds_count{%s} %d" % (prefix, labels, stats["count"]))
+        lines.append("# TYPE %s_command_errors_total counter" % prefix)
+        for command in sorted(snapshot):
+            for error, count in sorted(snapshot[command]["errors"].items()):
+                lines.append('%s_command_errors_total{command="%s",error="%s"} %d' % (prefix, command, error, count))
+        return "\n".join(lines) + "\n"
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name).lower()
+
+class StatsDExporter(object):
+    """
+    Sends every timing and error to a StatsD daemon over UDP.
+
+    :param tuple address: Address of the daemon.
+
+    :param str prefix: Prefix of the names of the metrics.
+    """
+    def __init__(self, address=("127.0.0.1", 8125), prefix="marcopolo"):
+        self.address = address
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, line):
+        try:
+            self.socket.sendto(line.encode('utf-8'), self.address)
+        except socket.error:
+            pass
+
+    def timing(self, command, phase, seconds):
+        self._send("%s.%s.%s:%.3f|ms" % (self.prefix, _metric_name(command), phase, seconds * 1000))
+
+    def error(self, command, error):
+        self._send("%s.%s.errors.%s:1|c" % (self.prefix, _metric_name(command), _metric_name(error)))
+
+    def close(self):
+        self.socket.close()
@@ -1,42 +1,168 @@
 from __future__ import division
 from __future__ import absolute_import
-import json, socket, sys, os
-import socket, ssl, re # Address validation
-import pwd
+import socket, sys, os, time, functools
+import re # Address validation
 
-from marcopolo.polo import conf
 import six
 
 from marcopolo.bindings.utils import verify_ip
 from marcopolo.bindings.types import Service
-
-BINDING_PORT = conf.POLO_BINDING_PORT
+from marcopolo.bindings import codec
+from marcopolo.bindings import buffers
+from marcopolo.bindings import metrics as _metrics
 
 TIMEOUT = 4000
 
-HOST, PORT = "127.0.0.1", BINDING_PORT
+BINDING_PORT = None # The port of the configuration of Polo, once it has been read
+
+HOST, PORT = "127.0.0.1", None # If PORT is None, BINDING_PORT is used
+
+def _conf():
+    """
+    Loads the configuration of Polo on first use. Reading it opens the
+    configuration file of the daemon, so importing the binding does not.
+    """
+    from marcopolo.polo import conf
+    return conf
+
+def _port():
+    """
+    :returns: The port of the Polo daemon: ``PORT`` if it is set, or the port of its configuration.
+    """
+    global BINDING_PORT
+    if PORT is not None:
+        return PORT
+    if BINDING_PORT is None:
+        BINDING_PORT = _conf().POLO_BINDING_PORT
+    return BINDING_PORT
+
+JSON = codec.JSONCodec(allow_nan=False) # https://docs.python.org/2/library/json.html#infinite-and-nan-number-values
+
+def _instrumented(command):
+    """
+    Counts the exceptions raised by the decorated method as errors of ``command`` if the instance has metrics.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return method(self, *args, **kwargs)
+            except Exception as e:
+                if self.metrics is not None:
+                    self.metrics.error(command, e)
+                raise
+        return wrapper
+    return decorator
 
 class Polo(object):
-    def __init__(self, testing=False):
+    """
+    :param bool testing: If set, the connection to the Polo daemon is not opened.
+
+    :param codecs: If set, the names of the wire codecs to negotiate with the daemon after connecting, in order of preference (see :mod:`marcopolo.bindings.codec`). Otherwise, JSON is used.
+
+    :param timeouts: If set, a :class:`marcopolo.bindings.timeouts.RTTEstimator` from which the timeout of each command is derived. Otherwise, every command waits up to ``TIMEOUT`` milliseconds.
+
+    :param metrics: If set, a :class:`marcopolo.bindings.metrics.Metrics` where the duration of every phase of the commands and their errors are recorded.
+    """
+    def __init__(self, testing=False, codecs=None, timeouts=None, metrics=None):
+        self._buffer = buffers.get_pool().acquire()
+        self.codec = JSON
+        self.timeouts = timeouts
+        self.metrics = metrics
         self.polo_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.polo_socket.settimeout(TIMEOUT/1000.0)
+        import ssl
         self.wrappedSocket = ssl.wrap_socket(self.polo_socket, ssl_version=ssl.PROTOCOL_SSLv23)#, ciphers="ADH-AES256-SHA")
         error = False
         error_reason = ""
         if not testing:
             try:
-                self.wrappedSocket.connect((HOST, PORT))
+                self.wrappedSocket.connect((HOST, _port()))
             except Exception as e:
                 error = True
                 error_reason = e
             if error is True:
                 raise PoloInternalException(str(error_reason))
 
+            if codecs is not None:
+                self.negotiate_codec(codecs)
+
+    def negotiate_codec(self, codecs=codec.PREFERENCES):
+        """
+        Agrees on a wire codec with the Polo daemon. If the daemon does not
+        support the negotiation, JSON is kept.
+
+        :param list codecs: The names of the codecs, in order of preference.
+
+        :returns: The name of the codec in use.
+        """
+        self.codec = JSON
+        try:
+            self.wrappedSocket.send(self.codec.encode(codec.hello(codecs)))
+            response = codec.decode(self._read(), self.codec)
+        except (socket.error, ValueError):
+            return self.codec.name
+
+        if isinstance(response, dict) and response.get("OK") is not None:
+            picked = codec.negotiated(response.get("OK"))
+            if picked is not codec.JSON:
+                self.codec = picked
+        return self.codec.name
+
+    def _decode(self, data, command=None):
+        """
+        Decodes a response of the daemon to ``command``.
+
+        :raise:
+            :ValueError: If the response is not a valid message.
+        """
+        start = time.time()
+        response = codec.decode(data, self.codec)
+        if command is not None:
+            self._observe(command, _metrics.DECODE, start)
+        if not isinstance(response, dict):
+            raise ValueError("The response is not a dictionary")
+        return response
+
+    def _observe(self, command, phase, start):
+        """
+        Records the time since ``start`` as the duration of ``phase`` of ``command``, if the instance has metrics.
+        """
+        if self.metrics is not None:
+            self.metrics.record(command, phase, time.time() - start)
+
+    def _recv(self, command, sent):
+        """
+        Receives the response to ``command``, sent at ``sent``. If the
+        instance has an estimator, the socket timeout is derived from it and
+        the round-trip time is recorded.
+        """
+        if self.timeouts is not None:
+            self.wrappedSocket.settimeout(self.timeouts.timeout(command, TIMEOUT/1000.0))
+        start = time.time()
+        data = self._read()
+        self._observe(command, _metrics.WAIT, start)
+        if self.timeouts is not None:
+            self.timeouts.observe(command, time.time() - sent)
+        return data
+
+    def _read(self):
+        """
+        Receives a response of the daemon into the buffer of the instance.
+
+        :returns: A memoryview of the response, valid until the next read.
+        """
+        return memoryview(self._buffer)[:self.wrappedSocket.recv_into(self._buffer)]
+
     def __del__(self):
+        if getattr(self, "_buffer", None) is not None:
+            buffers.get_pool().release(self._buffer)
+            self._buffer = None
         self.wrappedSocket.close()
 
 
     def get_token(self):
+        import pwd
         pw_user = pwd.getpwuid(os.geteuid())
 
         if not os.path.isfile(os.path.join(pw_user.pw_dir, ".polo/token")):
@@ -57,12 +183,12 @@ class Polo(object):
             message_dict = {}
             message_dict["Command"] = "Request-token"
             message_dict["Args"] = {"uid":os.geteuid()}
-            json_str = json.dumps(message_dict)
-            self.wrappedSocket.send(json_str.encode('utf-8'))
-            data = self.wrappedSocket.recv()
+            sent = time.time()
+            self.wrappedSocket.send(self.codec.encode(message_dict))
+            data = self._recv("Request-token", sent)
             
 
-            data_dic = json.loads(data.decode('utf-8'))
+            data_dic = self._decode(data, "Request-token")
 
             ok = data_dic.get("OK", None)
             error = data_dic.get("Error", None)
@@ -71,7 +197,8 @@ class Polo(object):
         else:
             return ("", None)
 
-    def publish_service(self, service, params={}, multicast_groups=conf.MULTICAST_ADDRS, permanent=False, root=False):
+    @_instrumented("Register")
+    def publish_service(self, service, params={}, multicast_groups=None, permanent=False, root=False):
         """
         Registers a service during execution time. See :doc:`/services/intro/`.
         
@@ -79,7 +206,7 @@ class Polo(object):
         
             If `root` is true, the published service will have the same identifier as the value of the parameter. Otherwise, the name of the user will be prepended (`<user>:<service>`).
         
-        :param set multicast_groups: Indicates the groups where the service shall be published.
+        :param set multicast_groups: Indicates the groups where the service shall be published. By default, the groups of the configuration of Polo.
         
             Note that the groups must be defined in the polo.conf file, or otherwise the method will throw an exception.
         
@@ -101,6 +228,8 @@ class Polo(object):
 
         token = self.get_token()
 
+        if multicast_groups is None:
+            multicast_groups = _conf().MULTICAST_ADDRS
         
         error = False
         if not isinstance(service, six.string_types):
@@ -159,24 +288,18 @@ class Polo(object):
                                 "root":root}
         
         error = False
+        start = time.time()
         try:
-            message_str = json.JSONEncoder(allow_nan=False).encode(message_dict) # https://docs.python.org/2/library/json.html#infinite-and-nan-number-values
+            unicode_msg = self.codec.encode(message_dict)
         except Exception:
             error = True
+        self._observe(message_dict["Command"], _metrics.ENCODE, start)
 
         if error:
-            raise PoloInternalException("Error in JSON Encoder")
-        
-        error = False
-        try:
-            unicode_msg = message_str.encode('utf-8')
-        except UnicodeError:
-            error = True
-        
-        if error:
-            raise PoloInternalException("Error in codification")
+            raise PoloInternalException("Error in %s Encoder" % self.codec.name.upper())
 
         error = False
+        sent = time.time()
         try:
             if -1 == self.wrappedSocket.send(unicode_msg):
                 error = True
@@ -184,13 +307,14 @@ class Polo(object):
         except Exception as e:
             error = True
             reason = e
+        self._observe(message_dict["Command"], _metrics.SEND, sent)
 
         if error:
             raise PoloInternalException("Error during internal communication %s " % reason)
 
         error = False
         try:
-            data = self.wrappedSocket.recv()
+            data = self._recv("Register", sent)
         except socket.timeout:
             error = True
 
@@ -200,16 +324,7 @@ class Polo(object):
         error = False
         
         try:
-            data_dec = data.decode('utf-8')
-        except Exception:
-            error = True
-
-        if error:
-            reason = "Error on decoding"
-            raise PoloInternalException("Error during internal communication. %s" % reason)
-
-        try:
-            parsed_data = json.loads(data_dec)#json.JSONDecoder(parse_constant=False).decode(data)
+            parsed_data = self._decode(data, message_dict["Command"])
         except ValueError:
             error = True
 
@@ -287,7 +402,8 @@ class Polo(object):
             raise PoloException("Invalid multicast group address '%s'" % str(faulty_ip))
 
 
-    def unpublish_service(self, service, multicast_groups=conf.MULTICAST_ADDRS, delete_file=False):
+    @_instrumented("Unpublish")
+    def unpublish_service(self, service, multicast_groups=None, delete_file=False):
         """
         Removes a service. If the service is permanent, the file is only deleted if `delete_file` is set to `True`.\
         Please note that it is required to have the "ownership" of the service (that is, the only user which can remove \
@@ -303,6 +419,9 @@ class Polo(object):
         """
         token = self.get_token()
 
+        if multicast_groups is None:
+            multicast_groups = _conf().MULTICAST_ADDRS
+
         self.verify_parameters(service, multicast_groups)
 
         if type(delete_file) is not bool:
@@ -316,36 +435,32 @@ class Polo(object):
                                 "delete_file": delete_file,
                                 "uid": os.geteuid()}
         error = False
+        start = time.time()
         try:
-            message_str = json.JSONEncoder(allow_nan=False).encode(message_dict) # https://docs.python.org/2/library/json.html#infinite-and-nan-number-values
+            unicode_msg = self.codec.encode(message_dict)
         except Exception:
             error = True
+        self._observe(message_dict["Command"], _metrics.ENCODE, start)
 
         if error:
-            raise PoloInternalException("Error in JSON Encoder")
-        error  = False
-        try:
-            unicode_msg = message_str.encode('utf-8')
-        except UnicodeError:
-            error = True
-
-        if error:
-            raise PoloInternalException("Error in codification")
+            raise PoloInternalException("Error in %s Encoder" % self.codec.name.upper())
 
         error = False
         
+        sent = time.time()
         try:
             if -1 == self.wrappedSocket.send(unicode_msg):
                 error = True
         except Exception:
             error = True
+        self._observe(message_dict["Command"], _metrics.SEND, sent)
 
         if error:
             raise PoloInternalException("Error during internal communication")
 
         error = False
         try:
-            data = self.wrappedSocket.recv()
+            data = self._recv("Unpublish", sent)
         except socket.timeout:
             error = True
 
@@ -353,15 +468,7 @@ class Polo(object):
             raise PoloInternalException("Error during internal communication")
 
         try:
-            data_dec = data.decode('utf-8')
-        except Exception:
-            error = True
-
-        if error:
-            raise PoloInternalException("Error during internal communication")
-
-        try:
-            parsed_data = json.loads(data_dec)#json.JSONDecoder(parse_constant=False).decode(data)
+            parsed_data = self._decode(data, message_dict["Command"])
         except ValueError:
             error = True
 
@@ -380,6 +487,7 @@ class Polo(object):
         return 0
 
 
+    @_instrumented("Service-info")
     def service_info(self, service):
         """
         Returns a dictionary with all the information from a service
@@ -392,30 +500,32 @@ class Polo(object):
         message_dict = {}
         message_dict["Command"] = "Service-info"
         message_dict["Args"] = {"service":service}
-        encoder = json.JSONEncoder(allow_nan=False)
-        
         error = False
+        start = time.time()
         try:
-            message_str = encoder.encode(message_dict) # https://docs.python.org/2/library/json.html#infinite-and-nan-number-values
+            unicode_msg = self.codec.encode(message_dict)
         except Exception:
             error = True
+        self._observe(message_dict["Command"], _metrics.ENCODE, start)
 
         if error:
-            raise PoloInternalException("Error in JSON Encoder")
+            raise PoloInternalException("Error in %s Encoder" % self.codec.name.upper())
         
         error  = False
+        sent = time.time()
         try:
             if -1 == self.wrappedSocket.send(unicode_msg):
                 error = True
         except Exception:
             error = True
+        self._observe(message_dict["Command"], _metrics.SEND, sent)
 
         if error:
             raise PoloInternalException("Error on send")
 
         error = False
         try:
-            data = self.wrappedSocket.recv()
+            data = self._recv("Service-info", sent)
         except socket.timeout:
             error = True
 
@@ -423,15 +533,7 @@ class Polo(object):
             raise PoloInternalException("Timeout for reception")
 
         try:
-            data_dec = data.decode('utf-8')
-        except Exception:
-            error = True
-
-        if error:
-            raise PoloInternalException("Error on decoding")
-
-        try:
-            parsed_data = json.loads(data_dec)
+            parsed_data = self._decode(data, message_dict["Command"])
         except ValueError:
             error = True
 
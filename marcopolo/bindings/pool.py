@@ -0,0 +1,279 @@
+"""
+Pool of :class:`marcopolo.bindings.marco.Marco` instances shared by the
+threads of a process.
+
+A single instance can already carry overlapping queries from several
+threads, but applications which need several sockets (for example, to
+spread the load of many workers, or because they change the options of
+the instance) would otherwise open and close one per request. The pool
+keeps a bounded number of instances open, either leased to a caller for
+the duration of a block or bound to the calling thread, closes the ones
+which stay idle and starts afresh after a ``fork`` (the sockets and the
+receiver threads of the parent cannot be used by the child).
+"""
+from __future__ import absolute_import
+import os, time, threading
+from contextlib import contextmanager
+
+from marcopolo.bindings import marco
+
+POOL_SIZE = 8
+IDLE_TIMEOUT = 60.0
+
+class _Entry(object):
+    def __init__(self, instance, thread=None):
+        self.instance = instance
+        self.thread = thread
+        self.used = time.time()
+        self.leases = 1 # Nested leases of the same thread, in per thread mode
+
+    @property
+    def in_use(self):
+        return self.leases > 0
+
+class MarcoPool(object):
+    """
+    :param int size: Maximum number of instances open at the same time.
+
+    :param float idle_timeout: Seconds after which an instance which has not been used is closed.
+
+    :param bool per_thread: If set, each thread is always given the same instance, which is closed once the thread ends or it stays idle. Otherwise, instances are leased to any thread.
+
+    :param options: Keyword arguments of :class:`marcopolo.bindings.marco.Marco` used to create the instances.
+    """
+    def __init__(self, size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT, per_thread=False, **options):
+        if size < 1:
+            raise ValueError("size must be greater than 0")
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.per_thread = per_thread
+        self.options = options
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._condition = threading.Condition()
+        self._idle = [] # Entries available for lease, the most recently used last
+        self._bound = {} # Entries bound to a thread, by thread identifier
+        self._leased = set() # Instances leased to a caller
+        self._inherited = {} # Leases made before a fork, by instance, which is closed once they are all released
+
+    def _check_fork(self):
+        """
+        Discards every instance if the process has forked since they were created.
+        """
+        if self._pid == os.getpid():
+            return
+        entries = self._idle + [entry for entry in self._bound.values() if not entry.in_use]
+        leased = dict(self._inherited) # Including the leases inherited from an earlier fork
+        leased.update((instance, 1) for instance in self._leased)
+        leased.update((entry.instance, entry.leases) for entry in self._bound.values() if entry.in_use)
+        self._reset()
+        self._inherited = leased
+        for entry in entries:
+            entry.instance.close()
+
+    def __len__(self):
+        """
+        :returns: The number of open instances.
+        """
+        return len(self._idle) + len(self._bound) + len(self._leased)
+
+    def _evict(self, now):
+        """
+        Removes the instances which have been idle for too long or whose
+        thread has ended. Must be called with the lock held.
+
+        :returns: The removed instances, which must be closed by the caller.
+        """
+        evicted = []
+        while self._idle and now - self._idle[0].used >= self.idle_timeout:
+            evicted.append(self._idle.pop(0).instance)
+        for ident, entry in list(self._bound.items()):
+            if not entry.thread.is_alive() or (not entry.in_use and now - entry.used >= self.idle_timeout):
+                evicted.append(self._bound.pop(ident).instance)
+        return evicted
+
+    def _next_eviction(self, now):
+        """
+        :returns: The seconds until an idle instance can be evicted, or ``None`` if there are none. Must be called with the lock held.
+        """
+        used = [entry.used for entry in self._idle]
+        used.extend(entry.used for entry in self._bound.values() if not entry.in_use)
+        if not used:
+            return None
+        return max(0, min(used) + self.idle_timeout - now)
+
+    def acquire(self, timeout=None):
+        """
+        Takes an instance from the pool, creating it if there is none
+        available. If ``size`` instances are already in use, waits until one
+        is released. In per thread mode, an idle instance bound to another
+        thread is given to the calling thread when the pool is full.
+
+        :param float timeout: Maximum number of seconds to wait. If ``None``, waits indefinitely.
+
+        :returns: The instance, which must be given back with :meth:`release`.
+
+        :rvalue: marcopolo.bindings.marco.Marco
+
+        :raise:
+            :MarcoTimeOutException: If no instance is released before the timeout.
+        """
+        self._check_fork()
+        end = time.time() + timeout if timeout is not None else None
+        evicted = []
+        with self._condition:
+            while True:
+                now = time.time()
+                evicted.extend(self._evict(now))
+                entry = self._take()
+                if entry is not None or len(self) < self.size:
+                    break
+                wait = end - now if end is not None else None
+                if wait is not None and wait <= 0:
+                    break
+                # Wake up when an idle instance expires, to evict it even if nothing is released
+                eviction = self._next_eviction(now)
+                if eviction is not None and (wait is None or eviction < wait):
+                    wait = eviction
+                self._condition.wait(wait)
+
+            if entry is None and len(self) < self.size:
+                entry = self._create()
+
+        for instance in evicted:
+            instance.close()
+
+        if entry is None:
+            raise marco.MarcoTimeOutException("No instance available in the pool")
+        return entry.instance
+
+    def _take(self):
+        """
+        :returns: The entry available for the calling thread, or ``None``. Must be called with the lock held.
+        """
+        if self.per_thread:
+            thread = threading.current_thread()
+            entry = self._bound.get(thread.ident)
+            if entry is None and len(self) >= self.size:
+                entry = self._reclaim(thread)
+            if entry is not None:
+                entry.leases += 1
+            return entry
+        if not self._idle:
+            return None
+        entry = self._idle.pop()
+        self._leased.add(entry.instance)
+        return entry
+
+    def _reclaim(self, thread):
+        """
+        Binds to ``thread`` the least recently used instance which is not in
+        use by its thread. Must be called with the lock held.
+
+        :returns: The entry, with no leases, or ``None`` if every instance is in use.
+        """
+        idle = [(entry.used, ident) for ident, entry in self._bound.items() if not entry.in_use]
+        if not idle:
+            return None
+        entry = self._bound.pop(min(idle)[1])
+        entry.thread = thread
+        self._bound[thread.ident] = entry
+        return entry
+
+    def _create(self):
+        """
+        Opens a new instance for the calling thread. Must be called with the lock held.
+        """
+        if self.per_thread:
+            thread = threading.current_thread()
+            entry = self._bound[thread.ident] = _Entry(marco.Marco(**self.options), thread)
+        else:
+            entry = _Entry(marco.Marco(**self.options))
+            self._leased.add(entry.instance)
+        return entry
+
+    def release(self, instance):
+        """
+        Gives back an instance obtained with :meth:`acquire`. An instance
+        acquired before the process forked is closed instead.
+        """
+        self._check_fork()
+        with self._condition:
+            if instance in self._inherited:
+                evicted = self._release_inherited(instance)
+            else:
+                if self.per_thread:
+                    entry = self._bound.get(threading.current_thread().ident)
+                    if entry is None or entry.instance is not instance:
+                        raise ValueError("The instance is not bound to this thread")
+                else:
+                    if instance not in self._leased:
+                        raise ValueError("The instance was not leased from this pool")
+                    self._leased.remove(instance)
+                    entry = _Entry(instance)
+                    self._idle.append(entry)
+                entry.used = time.time()
+                entry.leases = max(0, entry.leases - 1) if self.per_thread else 0
+                evicted = self._evict(entry.used)
+                self._condition.notify()
+
+        for evicted_instance in evicted:
+            evicted_instance.close()
+
+    def _release_inherited(self, instance):
+        """
+        Releases a lease made before the fork. Must be called with the lock held.
+
+        :returns: The instance if it has no more leases, so that the caller closes it.
+        """
+        self._inherited[instance] -= 1
+        if self._inherited[instance] > 0:
+            return []
+        del self._inherited[instance]
+        return [instance]
+
+    @contextmanager
+    def lease(self, timeout=None):
+        """
+        Context manager which acquires an instance and releases it at the end of the block::
+
+            with pool.lease() as m:
+                nodes = m.request_for("service")
+
+        :param float timeout: See :meth:`acquire`.
+        """
+        instance = self.acquire(timeout)
+        try:
+            yield instance
+        finally:
+            self.release(instance)
+
+    def close(self):
+        """
+        Closes the instances which are not in use.
+        """
+        with self._condition:
+            entries = self._idle + [entry for entry in self._bound.values() if not entry.in_use]
+            self._idle = []
+            for ident, entry in list(self._bound.items()):
+                if not entry.in_use:
+                    del self._bound[ident]
+        for entry in entries:
+            entry.instance.close()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    Returns the pool shared by the whole process, which is created with the default options on first use.
+
+    :rvalue: MarcoPool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = MarcoPool()
+        return _pool
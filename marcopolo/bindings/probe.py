@@ -0,0 +1,153 @@
+"""
+Reachability and latency probing of the nodes returned by the discovery.
+
+A :class:`Prober` opens a TCP connection to every node, at most
+``concurrency`` at a time, all of them driven by ``select`` from the
+calling thread. The time to establish the connection is the latency of the
+node. Nodes which refuse the connection or do not accept it before the
+timeout are unreachable. Results are cached for ``ttl`` seconds, so probing
+the same nodes again shortly after is free.
+"""
+from __future__ import division
+from __future__ import absolute_import
+import socket, select, errno, time
+
+from marcopolo.bindings.cache import ResultCache, FRESH
+
+PROBE_TIMEOUT = 500
+PROBE_CONCURRENCY = 32
+
+UNREACHABLE = -1 # Cached latency of the unreachable nodes
+
+class Prober(object):
+    """
+    :param int port: Port probed in every node. If ``None``, the value of the ``port_param`` parameter of each node is used.
+
+    :param str port_param: Name of the parameter of the nodes with the port to probe.
+
+    :param int timeout: Milliseconds after which a node which has not accepted the connection is unreachable.
+
+    :param int concurrency: Maximum number of connections in progress at the same time.
+
+    :param float ttl: Seconds the result of a probe is reused.
+    """
+    def __init__(self, port=None, port_param="port", timeout=PROBE_TIMEOUT, concurrency=PROBE_CONCURRENCY, ttl=5.0):
+        if concurrency < 1:
+            raise ValueError("concurrency must be greater than 0")
+        self.port = port
+        self.port_param = port_param
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.cache = ResultCache(ttl=ttl, max_size=4096)
+
+    def _target(self, node):
+        port = self.port
+        if port is None and node.params:
+            port = node.params.get(self.port_param)
+        try:
+            return (node.address, int(port)) if port is not None else None
+        except (TypeError, ValueError):
+            return None
+
+    def _start(self, target):
+        """
+        Starts a non-blocking connection to ``target``.
+
+        :returns: The socket, or ``None`` if the connection failed immediately.
+        """
+        family = socket.AF_INET6 if ":" in target[0] else socket.AF_INET
+        probe = socket.socket(family, socket.SOCK_STREAM)
+        probe.setblocking(False)
+        error = None
+        try:
+            code = probe.connect_ex(target)
+        except (socket.error, socket.gaierror, OverflowError):
+            error = True
+        if error or code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            probe.close()
+            return None
+        return probe
+
+    def _run(self, targets):
+        """
+        Connects to every target.
+
+        :returns: The latency (in seconds) of each target, or ``UNREACHABLE``.
+        """
+        results = dict((target, UNREACHABLE) for target in targets)
+        waiting = list(targets)
+        in_progress = {} # Socket -> (target, start)
+        timeout = self.timeout / 1000.0
+        while waiting or in_progress:
+            while waiting and len(in_progress) < self.concurrency:
+                target = waiting.pop()
+                probe = self._start(target)
+                if probe is not None:
+                    in_progress[probe] = (target, time.time())
+
+            if not in_progress:
+                continue
+            now = time.time()
+            wait = max(0, min(start for _, start in in_progress.values()) + timeout - now)
+            _, writable, failed = select.select([], list(in_progress), list(in_progress), wait)
+            now = time.time()
+            for probe in set(writable) | set(failed):
+                target, start = in_progress.pop(probe)
+                if probe.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    results[target] = now - start
+                probe.close()
+            for probe, (target, start) in list(in_progress.items()):
+                if now - start >= timeout:
+                    del in_progress[probe]
+                    probe.close()
+        return results
+
+    def probe(self, nodes):
+        """
+        Measures the latency of ``nodes``. Nodes without a port to probe are
+        kept with an unknown latency (``None``).
+
+        :returns: A list of tuples ``(node, latency)`` sorted by latency (in seconds), without the unreachable nodes.
+
+        :rvalue: list
+        """
+        nodes = list(nodes)
+        latencies = {}
+        pending = set()
+        for node in nodes:
+            target = self._target(node)
+            if target is None:
+                continue
+            latency, state = self.cache.lookup(target)
+            if state == FRESH:
+                latencies[target] = latency
+            else:
+                pending.add(target)
+
+        if pending:
+            for target, latency in self._run(list(pending)).items():
+                self.cache.store(target, latency)
+                latencies[target] = latency
+
+        ranked = []
+        for node in nodes:
+            target = self._target(node)
+            latency = latencies.get(target) if target is not None else None
+            if latency != UNREACHABLE:
+                ranked.append((node, latency))
+        ranked.sort(key=lambda result: (result[1] is None, result[1]))
+        return ranked
+
+    def rank(self, nodes):
+        """
+        :returns: The reachable ``nodes``, the fastest first.
+
+        :rvalue: list
+        """
+        return [node for node, _ in self.probe(nodes)]
+
+def probe(nodes, port=None, timeout=PROBE_TIMEOUT, concurrency=PROBE_CONCURRENCY):
+    """
+    Probes ``nodes`` once, without caching. See :meth:`Prober.probe`.
+    """
+    return Prober(port, timeout=timeout, concurrency=concurrency, ttl=0).probe(nodes)
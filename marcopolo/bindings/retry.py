@@ -0,0 +1,138 @@
+"""
+Retry policies for the requests sent to the Marco resolver.
+"""
+from __future__ import division
+from __future__ import absolute_import
+import time, random, threading, heapq, itertools, logging, copy
+from collections import deque
+
+class RetryPolicy(object):
+    """
+    Describes how a request which timed out is retried.
+
+    The delay before the n-th retry is ``backoff * 2**(n-1)`` milliseconds,
+    capped at ``max_backoff`` and reduced by a random fraction of up to
+    ``jitter`` so that clients which failed together do not retry together.
+
+    :param int max_attempts: Maximum number of times the request is sent, including the first one.
+
+    :param int backoff: Delay (in milliseconds) before the first retry.
+
+    :param int max_backoff: Maximum delay (in milliseconds) between two attempts.
+
+    :param float jitter: Fraction (between 0 and 1) of the delay which is randomized.
+
+    :param int deadline: If set, overall time budget (in milliseconds) of the request, including all the attempts.
+
+    :param bool hedge: If set, a duplicate request is sent when the first one takes longer than the ``hedge_percentile`` of the observed response times, and the first reply is used.
+
+    :param float hedge_percentile: Percentile of the response times after which the hedged request is sent.
+
+    :param int hedge_min_samples: Number of response times which must be observed before hedging.
+    """
+    def __init__(self, max_attempts=3, backoff=100, max_backoff=2000, jitter=0.5, deadline=None,
+                 hedge=False, hedge_percentile=95, hedge_min_samples=20):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        if not 0 <= jitter <= 1:
+            raise ValueError("jitter must be between 0 and 1")
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+
+    def copy(self, **changes):
+        """
+        :returns: A copy of the policy with the given attributes changed.
+
+        :rvalue: RetryPolicy
+        """
+        policy = copy.copy(self)
+        for name, value in changes.items():
+            setattr(policy, name, value)
+        return policy
+
+    def delay(self, retry):
+        """
+        :param int retry: Number of the retry, starting at 1.
+
+        :returns: Seconds to wait before the retry.
+
+        :rvalue: float
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** (retry - 1))
+        return delay * (1 - self.jitter * random.random()) / 1000.0
+
+class LatencyWindow(object):
+    """
+    Keeps the last ``size`` response times (in seconds) of a command.
+    """
+    def __init__(self, size=256):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        with self._lock:
+            self._samples.append(value)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, p):
+        """
+        :returns: The ``p`` percentile of the samples, or ``None`` if there are none.
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))
+        return samples[index]
+
+class _Scheduler(object):
+    """
+    Runs delayed callbacks from a single background thread, which only lives while there are callbacks pending.
+    """
+    def __init__(self):
+        self._timers = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, delay, callback):
+        with self._condition:
+            heapq.heappush(self._timers, (time.time() + delay, next(self._counter), callback))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="marco-scheduler")
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._timers:
+                    self._thread = None
+                    return
+                when, _, callback = self._timers[0]
+                wait = when - time.time()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                heapq.heappop(self._timers)
+            try:
+                callback()
+            except Exception:
+                logging.exception("Error in a scheduled callback")
+
+_scheduler = _Scheduler()
+
+def schedule(delay, callback):
+    """
+    Calls ``callback`` after ``delay`` seconds from the scheduler thread.
+    """
+    _scheduler.schedule(delay, callback)
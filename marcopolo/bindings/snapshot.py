@@ -0,0 +1,192 @@
+"""
+Persistent snapshot of the last discovery results, used to warm start the
+processes.
+
+A :class:`Snapshot` keeps the nodes returned by ``request_for`` in a file.
+A new process loads the file and serves the last known nodes of each query
+immediately, while the discovery runs in the background (see the
+``snapshot`` parameter of :class:`marcopolo.bindings.marco.Marco`). Every
+entry records when it was stored, so snapshots older than ``max_age`` are
+ignored.
+
+The file is compact JSON, replaced atomically (written to a temporary file
+in the same directory and renamed), so readers never see a partial write.
+The changes are written by a background thread, at most once every
+``flush_delay`` seconds, so storing a result never waits for the disk.
+Pending changes are written when the process exits or :meth:`Snapshot.flush`
+is called.
+"""
+from __future__ import absolute_import
+import json, os, tempfile, threading, time, logging, atexit, weakref
+
+from marcopolo.bindings.types import Node
+from marcopolo.bindings.cache import ResultCache
+
+SNAPSHOT_VERSION = 1
+
+_replace = getattr(os, "replace", os.rename) # os.rename does not overwrite on Windows
+
+class Snapshot(object):
+    """
+    :param str path: Path of the snapshot file. It is created on the first write.
+
+    :param float max_age: If set, seconds after which an entry is too stale to be served.
+
+    :param float write_interval: Minimum seconds between two writes of an entry whose nodes have not changed. Changes are always written.
+
+    :param float flush_delay: Seconds the changes wait before being written, so that the changes of several queries are written together.
+
+    :param int max_entries: Maximum number of queries kept. The entries stored longest ago are dropped first.
+    """
+    key = staticmethod(ResultCache.key)
+
+    def __init__(self, path, max_age=None, write_interval=30.0, flush_delay=1.0, max_entries=1024):
+        self.path = path
+        self.max_age = max_age
+        self.write_interval = write_interval
+        self.flush_delay = flush_delay
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock() # Held while the file is written
+        self._dirty = False
+        self._writer = None
+        self._entries = self._load()
+        self._trim()
+        _snapshots.add(self)
+
+    def _load(self):
+        error = None
+        try:
+            with open(self.path, "rb") as f:
+                data = json.loads(f.read().decode("utf-8"))
+            if data.get("version") != SNAPSHOT_VERSION:
+                raise ValueError("Unknown version %r" % data.get("version"))
+            return dict((key, (entry["stored"], entry["nodes"])) for key, entry in data["entries"].items())
+        except (IOError, OSError) as e: # No snapshot yet
+            error = None if not os.path.exists(self.path) else e
+        except (ValueError, KeyError, TypeError, AttributeError, UnicodeDecodeError) as e:
+            error = e
+        if error:
+            logging.warning("Ignoring the discovery snapshot %s: %s", self.path, error)
+        return {}
+
+    def get(self, key):
+        """
+        :returns: A tuple ``(nodes, age)`` with the nodes stored under ``key`` and the seconds since they were stored, or ``(None, None)`` if there is no entry or it is older than ``max_age``.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None, None
+        stored, nodes = entry
+        age = max(0, time.time() - stored)
+        if self.max_age is not None and age > self.max_age:
+            return None, None
+        return set(Node(node[0], node[3] if len(node) > 3 else (), multicast_group=node[1], params=node[2])
+                   for node in nodes), age
+
+    def age(self, key):
+        """
+        :returns: The seconds since the entry under ``key`` was stored, or ``None`` if there is no entry.
+        """
+        entry = self._entries.get(key)
+        return max(0, time.time() - entry[0]) if entry is not None else None
+
+    def put(self, key, nodes):
+        """
+        Stores ``nodes`` under ``key``. The file is written in the background
+        if they changed or the entry is older than ``write_interval``.
+        """
+        nodes = sorted(([node.address, node.multicast_group, node.params, list(node.services)] for node in nodes),
+                       key=lambda node: (node[0], node[1] or ""))
+        error = None
+        try:
+            json.dumps(nodes) # Checked here, so that a single entry does not prevent writing the others
+        except (TypeError, ValueError) as e:
+            error = e
+        if error:
+            logging.warning("Cannot store the nodes of %s in the discovery snapshot: %s", key, error)
+            return
+        now = time.time()
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is not None and previous[1] == nodes and now - previous[0] < self.write_interval:
+                return
+            self._entries[key] = (now, nodes)
+            self._trim()
+            self._dirty = True
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name="marco-snapshot")
+                self._writer.daemon = True
+                self._writer.start()
+
+    def _trim(self):
+        """
+        Drops the oldest entries beyond ``max_entries``.
+        """
+        excess = len(self._entries) - self.max_entries
+        if excess > 0:
+            for key in sorted(self._entries, key=lambda key: self._entries[key][0])[:excess]:
+                del self._entries[key]
+
+    def _run(self):
+        try:
+            while True:
+                time.sleep(self.flush_delay)
+                try:
+                    self.flush()
+                except Exception:
+                    logging.exception("Cannot write the discovery snapshot %s", self.path)
+                with self._lock:
+                    if not self._dirty:
+                        self._writer = None
+                        return
+        finally:
+            with self._lock:
+                if self._writer is threading.current_thread(): # Ended by an error: the next put starts a writer
+                    self._writer = None
+
+    def flush(self):
+        """
+        Writes the pending changes now.
+        """
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._dirty = False
+                entries = dict(self._entries)
+            self._write(entries)
+
+    def _write(self, entries):
+        entries = dict((key, {"stored": stored, "nodes": nodes}) for key, (stored, nodes) in entries.items())
+        data = json.dumps({"version": SNAPSHOT_VERSION, "entries": entries}, separators=(",", ":"))
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temporary = tempfile.mkstemp(prefix=".snapshot-", dir=directory)
+        error = None
+        try:
+            with os.fdopen(descriptor, "wb") as f:
+                f.write(data.encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+            _replace(temporary, self.path)
+        except (IOError, OSError) as e:
+            error = e
+        if error:
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+            logging.warning("Cannot write the discovery snapshot %s: %s", self.path, error)
+
+    def __len__(self):
+        return len(self._entries)
+
+_snapshots = weakref.WeakSet()
+
+@atexit.register
+def _flush_all():
+    for snapshot in list(_snapshots):
+        try:
+            snapshot.flush()
+        except Exception:
+            logging.exception("Cannot write the discovery snapshot %s", snapshot.path)
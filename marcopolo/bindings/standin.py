@@ -0,0 +1,353 @@
+"""
+Local stand-ins for the Marco resolver and the Polo daemon, which let the
+bindings be exercised (and load-tested) over real sockets on a single
+machine, without a multicast network.
+
+:class:`StandInResolver` answers the commands of
+:class:`marcopolo.bindings.marco.Marco` on behalf of a set of
+:class:`VirtualNode`, each one with its own services, parameters and reply
+delay. :class:`StandInPolo` accepts the TLS connections of
+:class:`marcopolo.bindings.polo.Polo` and keeps the published services in
+memory. Both can be used as context managers, in which case the bindings are
+pointed to them for the duration of the block::
+
+    nodes = [VirtualNode("10.0.0.%d" % i, {"web": {}}, delay=0.01) for i in range(1, 101)]
+    with StandInResolver(nodes):
+        Marco().request_for("web")
+"""
+from __future__ import division
+from __future__ import absolute_import
+import socket, ssl, threading, logging, time, hashlib
+from collections import OrderedDict
+
+from marcopolo.bindings import marco
+from marcopolo.bindings import codec as _codec
+from marcopolo.bindings import filters
+from marcopolo.bindings.retry import schedule
+
+CHUNK_SIZE = 256 # Nodes per datagram
+VERSIONS = 1024 # Versions of the results kept to answer delta queries
+
+class VirtualNode(object):
+    """
+    A node simulated by :class:`StandInResolver`.
+
+    :param str address: The address of the node.
+
+    :param dict services: The parameters of each service offered by the node, by name.
+
+    :param dict params: The parameters of the node, returned by ``marco``.
+
+    :param float delay: Seconds the node takes to reply.
+
+    :param str group: The multicast group of the node.
+    """
+    def __init__(self, address, services=None, params=None, delay=0, group=marco.MULTICAST_GROUP):
+        self.address = address
+        self.services = services if services is not None else {}
+        self.params = params if params is not None else {}
+        self.delay = delay
+        self.group = group
+
+    def to_dict(self, params, service=None):
+        node = {"Address": self.address, "Params": params, "Group": self.group}
+        if service is not None:
+            node["Service"] = service
+        return node
+
+class StandInResolver(object):
+    """
+    Answers the resolver commands (``Marco``, ``Request-for``,
+    ``Request-multi``, ``Services`` and ``Hello``) over UDP.
+
+    As the real resolver, the nodes which reply within the timeout of the
+    command are sent once the timeout is over, unless the command asks for a
+    stream, in which case each node is sent as soon as its delay is over.
+    Delta queries (commands with ``Since``) are answered with the changes
+    since the version the client has, and the filters of the commands are
+    evaluated before replying.
+
+    :param list nodes: The :class:`VirtualNode` simulated.
+
+    :param tuple address: Address to listen on. By default, a free port of the loopback interface.
+
+    :param int timeout: Timeout (in milliseconds) of the commands which do not set one.
+
+    :param int chunk_size: Maximum number of nodes sent in each datagram.
+    """
+    def __init__(self, nodes=(), address=('127.0.0.1', 0), timeout=marco.TIMEOUT, chunk_size=CHUNK_SIZE):
+        self.nodes = list(nodes)
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.commands = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(address)
+        self.address = self.socket.getsockname()
+        self._previous = None
+        self._lock = threading.Lock()
+        self._versions = OrderedDict() # Nodes of each version of a result, by address
+        self._thread = threading.Thread(target=self._serve, name="standin-resolver")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        self._previous = marco.RESOLVER_ADDRESS
+        marco.RESOLVER_ADDRESS = self.address
+        return self
+
+    def __exit__(self, *exc_info):
+        marco.RESOLVER_ADDRESS = self._previous
+        self.close()
+
+    def _serve(self):
+        while True:
+            try:
+                data, client = self.socket.recvfrom(marco.FRAME_SIZE)
+            except socket.error:
+                return
+            try:
+                command = _codec.JSON.decode(data)
+                self.commands += 1
+                self._handle(command, client)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                logging.warning("Invalid command received by the stand-in resolver: %s", e)
+
+    def _send(self, client, message):
+        try:
+            self.socket.sendto(_codec.JSON.encode(message), client)
+        except socket.error:
+            pass
+
+    def _reply(self, command, client, nodes):
+        """
+        Sends ``nodes`` split in chunks.
+        """
+        chunks = [nodes[i:i + self.chunk_size] for i in range(0, len(nodes), self.chunk_size)] or [[]]
+        for seq, chunk in enumerate(chunks):
+            self._send(client, {"Id": command.get("Id"), "Response": chunk, "Seq": seq,
+                                "More": seq < len(chunks) - 1})
+
+    def _version(self, nodes):
+        """
+        :returns: The version of a result, which is kept to answer the delta queries based on it.
+        """
+        nodes = dict((node["Address"], node) for node in nodes)
+        version = hashlib.sha1(_codec.JSON.encode(sorted(nodes.items()))).hexdigest()[:16]
+        with self._lock:
+            self._versions.pop(version, None)
+            self._versions[version] = nodes
+            while len(self._versions) > VERSIONS:
+                self._versions.popitem(last=False)
+        return version, nodes
+
+    def _reply_versioned(self, command, client, nodes):
+        """
+        Answers a delta query with the changes since the version the client has.
+        """
+        version, current = self._version(nodes)
+        with self._lock:
+            base = self._versions.get(command["Since"])
+        if command["Since"] == version:
+            self._send(client, {"Id": command.get("Id"), "Response": {"Version": version, "NotModified": True}})
+            return
+        if base is None:
+            payload = {"Version": version, "Nodes": nodes}
+        else:
+            payload = {"Version": version,
+                       "Added": [node for address, node in current.items() if address not in base],
+                       "Changed": [node for address, node in current.items()
+                                   if address in base and base[address] != node],
+                       "Removed": [address for address in base if address not in current]}
+        chunks = []
+        for field in ("Nodes", "Added", "Changed", "Removed"):
+            values = payload.get(field, [])
+            for i in range(0, len(values), self.chunk_size):
+                chunks.append({"Version": version, field: values[i:i + self.chunk_size]})
+        chunks = chunks or [{"Version": version, "Nodes" if base is None else "Added": []}]
+        for seq, chunk in enumerate(chunks):
+            self._send(client, {"Id": command.get("Id"), "Response": chunk, "Seq": seq,
+                                "More": seq < len(chunks) - 1})
+
+    def _replying(self, command, timeout):
+        """
+        :returns: The tuples ``(node, params, service)`` of the nodes which reply to ``command`` within ``timeout`` seconds.
+        """
+        exclude = set(command.get("exclude") or [])
+        name = command["Command"]
+        if name == "Marco":
+            candidates = [(node, node.params, None) for node in self.nodes if node.group == command.get("group", node.group)]
+        elif name == "Request-for":
+            service = command["Params"]
+            candidates = [(node, node.services[service], None) for node in self.nodes if service in node.services
+                          and command.get("node") in (None, node.address)]
+        else:
+            candidates = [(node, node.services[service], service) for service in command["Services"]
+                          for node in self.nodes if service in node.services]
+        candidates = [c for c in candidates if c[0].address not in exclude and c[0].delay <= timeout]
+        if command.get("Filter") is not None:
+            where = filters.Filter(command["Filter"])
+            candidates = [c for c in candidates if where.matches(c[1])]
+        candidates.sort(key=lambda c: c[0].delay)
+        if command.get("max_nodes"):
+            # The limit applies to each service of a Request-multi, as if they were requested one by one
+            counts = {}
+            limited = []
+            for candidate in candidates:
+                counts[candidate[2]] = counts.get(candidate[2], 0) + 1
+                if counts[candidate[2]] <= command["max_nodes"]:
+                    limited.append(candidate)
+            candidates = limited
+        return candidates
+
+    def _handle(self, command, client):
+        name = command["Command"]
+        if name == "Hello":
+            self._send(client, {"Id": command.get("Id"), "Response": {"Codec": _codec.JSON.name}})
+            return
+        if name == "Services":
+            services = [sorted(node.services) for node in self.nodes if node.address == command.get("node")]
+            if services:
+                self._send(client, {"Id": command.get("Id"), "Response": services[0]})
+            else:
+                self._send(client, {"Id": command.get("Id"), "Error": "Unknown node"})
+            return
+        if name not in ("Marco", "Request-for", "Request-multi"):
+            self._send(client, {"Id": command.get("Id"), "Error": "Unknown command %s" % name})
+            return
+
+        timeout = (command.get("timeout") or self.timeout) / 1000.0
+        try:
+            replying = self._replying(command, timeout)
+        except filters.FilterError as e:
+            self._send(client, {"Id": command.get("Id"), "Error": "Invalid filter: %s" % e})
+            return
+        if not command.get("Stream"):
+            nodes = [node.to_dict(params, service) for node, params, service in replying]
+            if "Since" in command and name != "Request-multi":
+                schedule(timeout, lambda: self._reply_versioned(command, client, nodes))
+            else:
+                schedule(timeout, lambda: self._reply(command, client, nodes))
+            return
+
+        for seq, (node, params, service) in enumerate(replying):
+            message = {"Id": command.get("Id"), "Response": [node.to_dict(params, service)], "Seq": seq, "More": True}
+            schedule(node.delay, lambda message=message: self._send(client, message))
+        schedule(timeout, lambda: self._send(client, {"Id": command.get("Id"), "Response": [],
+                                                      "Seq": len(replying), "More": False}))
+
+class StandInPolo(object):
+    """
+    Answers the commands of the Polo binding over TLS, keeping the
+    published services in memory. Each connection is served by its own
+    thread.
+
+    :param str certfile: Certificate of the server (PEM).
+
+    :param str keyfile: Private key of the certificate. If ``None``, it must be included in ``certfile``.
+
+    :param tuple address: Address to listen on. By default, a free port of the loopback interface.
+
+    :param float delay: Seconds the daemon takes to reply to each command.
+    """
+    def __init__(self, certfile, keyfile=None, address=('127.0.0.1', 0), delay=0):
+        self.delay = delay
+        self.services = {}
+        self.commands = 0
+        self._lock = threading.Lock()
+        self._context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        self._context.load_cert_chain(certfile, keyfile)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.listen(128)
+        self.address = self.socket.getsockname()
+        self._previous = None
+        self._thread = threading.Thread(target=self._accept, name="standin-polo")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        from marcopolo.bindings import polo
+        self._previous = (polo.HOST, polo.PORT)
+        polo.HOST, polo.PORT = self.address
+        return self
+
+    def __exit__(self, *exc_info):
+        from marcopolo.bindings import polo
+        polo.HOST, polo.PORT = self._previous
+        self.close()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._serve, args=(connection,), name="standin-polo-connection")
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, connection):
+        try:
+            connection = self._context.wrap_socket(connection, server_side=True)
+        except (ssl.SSLError, socket.error) as e:
+            logging.warning("TLS handshake with the stand-in Polo daemon failed: %s", e)
+            connection.close()
+            return
+
+        try:
+            while True:
+                try:
+                    data = connection.recv(65536)
+                except (ssl.SSLError, socket.error):
+                    return
+                if not data:
+                    return
+                try:
+                    response = self._handle(_codec.JSON.decode(data))
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    response = {"Error": "Invalid command: %s" % e}
+                if self.delay:
+                    time.sleep(self.delay)
+                try:
+                    connection.sendall(_codec.JSON.encode(response))
+                except (ssl.SSLError, socket.error):
+                    return
+        finally:
+            connection.close()
+
+    def _handle(self, command):
+        name = command["Command"]
+        args = command.get("Args", {})
+        with self._lock:
+            self.commands += 1
+            if name == "Hello":
+                return {"OK": {"Codec": _codec.JSON.name}}
+            if name == "Request-token":
+                return {"OK": "standin-token"}
+            if name == "Register":
+                service = args["service"]
+                if service in self.services:
+                    return {"Error": "Service already exists"}
+                self.services[service] = {"identifier": service,
+                                          "params": args.get("params", {}),
+                                          "multicast_groups": args.get("multicast_groups", []),
+                                          "permanent": args.get("permanent", False),
+                                          "disabled": False}
+                return {"OK": service}
+            if name == "Unpublish":
+                if self.services.pop(args["service"], None) is None:
+                    return {"Error": "Service not found"}
+                return {"OK": 0}
+            if name == "Service-info":
+                info = self.services.get(args["service"])
+                if info is None:
+                    return {"Error": "Service not found"}
+                return {"OK": info}
+        return {"Error": "Unknown command %s" % name}
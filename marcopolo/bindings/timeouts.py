@@ -0,0 +1,110 @@
+"""
+Timeouts derived from the observed round-trip times of each command.
+"""
+from __future__ import division
+from __future__ import absolute_import
+import threading
+
+from marcopolo.bindings.retry import LatencyWindow
+
+class _CommandStats(object):
+    def __init__(self, window_size):
+        self.srtt = None
+        self.rttvar = None
+        self.window = LatencyWindow(window_size)
+
+class RTTEstimator(object):
+    """
+    Tracks the round-trip time of every command and derives timeouts from
+    it. The mean and the deviation are smoothed as in TCP (RFC 6298) and the
+    timeout is the largest of ``srtt + k * rttvar`` and the ``percentile``
+    of the recent samples, clamped between ``floor`` and ``ceiling``.
+
+    :param int floor: Minimum timeout, in milliseconds.
+
+    :param int ceiling: Maximum timeout, in milliseconds. If ``None``, the default timeout of the caller is the maximum.
+
+    :param float alpha: Smoothing factor of the mean.
+
+    :param float beta: Smoothing factor of the deviation.
+
+    :param float k: Weight of the deviation in the timeout.
+
+    :param float percentile: Percentile of the recent samples the timeout never goes below.
+
+    :param int min_samples: Number of samples required before the timeouts are derived. Until then, the default timeout is used.
+    """
+    def __init__(self, floor=50, ceiling=None, alpha=0.125, beta=0.25, k=4, percentile=99, min_samples=10,
+                 window_size=256):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.alpha = alpha
+        self.beta = beta
+        self.k = k
+        self.percentile_limit = percentile
+        self.min_samples = min_samples
+        self._window_size = window_size
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _get(self, command):
+        stats = self._stats.get(command)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(command, _CommandStats(self._window_size))
+        return stats
+
+    def observe(self, command, rtt):
+        """
+        Records a round-trip time (in seconds) of ``command``.
+        """
+        stats = self._get(command)
+        with self._lock:
+            if stats.srtt is None:
+                stats.srtt = rtt
+                stats.rttvar = rtt / 2
+            else:
+                stats.rttvar = (1 - self.beta) * stats.rttvar + self.beta * abs(stats.srtt - rtt)
+                stats.srtt = (1 - self.alpha) * stats.srtt + self.alpha * rtt
+        stats.window.add(rtt)
+
+    def samples(self, command):
+        stats = self._stats.get(command)
+        return len(stats.window) if stats is not None else 0
+
+    def percentile(self, command, p):
+        """
+        :returns: The ``p`` percentile of the recent round-trip times of ``command``, or ``None`` without samples.
+        """
+        stats = self._stats.get(command)
+        return stats.window.percentile(p) if stats is not None else None
+
+    def timeout(self, command, default):
+        """
+        :param float default: Timeout (in seconds) used until enough samples are available, and the maximum if no ``ceiling`` is set.
+
+        :returns: The timeout of ``command``, in seconds.
+
+        :rvalue: float
+        """
+        stats = self._stats.get(command)
+        if stats is None or len(stats.window) < self.min_samples:
+            return default
+        timeout = max(stats.srtt + self.k * stats.rttvar, stats.window.percentile(self.percentile_limit))
+        ceiling = self.ceiling / 1000.0 if self.ceiling is not None else default
+        return min(max(timeout, self.floor / 1000.0), ceiling)
+
+    def snapshot(self):
+        """
+        :returns: The smoothed mean, deviation, median and 99th percentile (in seconds) and the number of samples of each command.
+
+        :rvalue: dict
+        """
+        result = {}
+        for command, stats in list(self._stats.items()):
+            result[command] = {"ewma": stats.srtt,
+                               "deviation": stats.rttvar,
+                               "p50": stats.window.percentile(50),
+                               "p99": stats.window.percentile(99),
+                               "samples": len(stats.window)}
+        return result
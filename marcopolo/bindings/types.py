@@ -1,3 +1,8 @@
+import numbers
+from bisect import bisect_left, bisect_right
+
+from six.moves import intern
+
 class Service(object):
     def __init__(self):
         pass
@@ -7,7 +12,7 @@ class Service(object):
         return self._id
 
     @identifier.setter
-    def id(self, value):
+    def identifier(self, value):
         self._id = value
 
     @property
@@ -34,41 +39,345 @@ class Service(object):
     def disabled(self, value):
         self._disabled = value
     
-class Node:
-    def __init__(self, address=None, services=[], multicast_group = None):
-        self._address = address
-        self._services = services
-        self._multicast_group = multicast_group
+class Node(object):
+    """
+    A node of the MarcoPolo network, as returned by the discovery functions.
+
+    Nodes are immutable and two nodes are equal if they have the same
+    address and multicast group, so they can be used in sets and as
+    dictionary keys. The address and group strings are interned, so large
+    result sets share a single copy of each of them.
+    """
+    __slots__ = ('_address', '_services', '_multicast_group', '_params')
+
+    def __init__(self, address=None, services=(), multicast_group=None, params=None):
+        self._address = intern(address) if isinstance(address, str) else address
+        self._services = tuple(services)
+        self._multicast_group = intern(multicast_group) if isinstance(multicast_group, str) else multicast_group
+        self._params = params if params is not None else {}
 
     @property
     def address(self):
         return self._address
 
-    @address.setter
-    def address(self, value):
-        self._address = value
-
     @property
     def services(self):
         return self._services
 
-    @services.setter
-    def services(self, value):
-        self._services = value
-
-
     @property
     def multicast_group(self):
         return self._multicast_group
 
-    @multicast_group.setter
-    def multicast_group(self, value):
-        self._multicast_group = value
-
     @property
     def params(self):
         return self._params
 
-    @params.setter
-    def params(self, value):
-        self._params = value
+    def __eq__(self, other):
+        if not isinstance(other, Node):
+            return NotImplemented
+        return self._address == other._address and self._multicast_group == other._multicast_group
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash((self._address, self._multicast_group))
+
+    def __reduce__(self):
+        return (Node, (self._address, self._services, self._multicast_group, self._params))
+
+    def __repr__(self):
+        return "Node(%r, multicast_group=%r, params=%r)" % (self._address, self._multicast_group, self._params)
+
+_ADDRESS, _GROUP, _SERVICE = "address", "group", "service"
+
+_UNINDEXED = object()
+
+def _keys(index, node):
+    """
+    :returns: The keys of ``node`` in ``index``.
+    """
+    if index == _ADDRESS:
+        return (node.address,)
+    if index == _GROUP:
+        return (node.multicast_group,)
+    if index == _SERVICE:
+        return node.services
+    value = node.params.get(index[1], _UNINDEXED) if isinstance(node.params, dict) else _UNINDEXED
+    try:
+        hash(value)
+    except TypeError: # Lists and dictionaries are looked up by scanning
+        value = _UNINDEXED
+    return (value,)
+
+class _SortedIndex(object):
+    """
+    The nodes with a numeric value of the parameter ``name``, sorted by that
+    value, so that ranges are found by bisection.
+    """
+    def __init__(self, name, nodes):
+        self.name = name
+        entries = sorted(((self._value(node), node) for node in nodes if self._value(node) is not None),
+                         key=lambda entry: entry[0])
+        self.values = [value for value, _ in entries]
+        self.nodes = [node for _, node in entries]
+
+    def _value(self, node):
+        value = node.params.get(self.name) if isinstance(node.params, dict) else None
+        if isinstance(value, bool) or not isinstance(value, numbers.Real) or value != value: # Booleans and NaN do not order
+            return None
+        return value
+
+    def add(self, node):
+        value = self._value(node)
+        if value is not None:
+            position = bisect_right(self.values, value)
+            self.values.insert(position, value)
+            self.nodes.insert(position, node)
+
+    def discard(self, node):
+        value = self._value(node)
+        if value is None:
+            return
+        for position in range(bisect_left(self.values, value), bisect_right(self.values, value)):
+            if self.nodes[position] == node:
+                del self.values[position]
+                del self.nodes[position]
+                return
+
+    def between(self, low, high):
+        start = bisect_left(self.values, low) if low is not None else 0
+        end = bisect_right(self.values, high) if high is not None else len(self.values)
+        return self.nodes[start:end]
+
+class NodeSet(set):
+    """
+    A set of :class:`Node` with secondary indexes by address, multicast
+    group, service and the values of the parameters.
+
+    Each index is built the first time it is used and is then kept up to
+    date as nodes are added or removed, so lookups take constant time no
+    matter how many nodes there are. Since it is a ``set``, it can be used
+    wherever the discovery functions used to return one, and the set
+    operations return a ``NodeSet`` as well.
+
+    The parameter indexes of :meth:`where` only answer equality. Ranges of
+    numeric parameters are looked up with :meth:`between`, which keeps its
+    own sorted index; other comparisons (such as the ones of :meth:`filter`)
+    scan the nodes.
+    """
+    def __init__(self, nodes=()):
+        set.__init__(self, nodes)
+        self._indexes = {}
+        self._sorted = {}
+
+    def _index(self, name):
+        index = self._indexes.get(name)
+        if index is None:
+            index = {}
+            for node in self:
+                for key in _keys(name, node):
+                    index.setdefault(key, set()).add(node)
+            self._indexes[name] = index
+        return index
+
+    def _indexed(self, node):
+        for name, index in self._indexes.items():
+            for key in _keys(name, node):
+                index.setdefault(key, set()).add(node)
+        for index in self._sorted.values():
+            index.add(node)
+
+    def _unindexed(self, node):
+        for name, index in self._indexes.items():
+            for key in _keys(name, node):
+                nodes = index.get(key)
+                if nodes is not None:
+                    nodes.discard(node)
+                    if not nodes:
+                        del index[key]
+        for index in self._sorted.values():
+            index.discard(node)
+
+    def by_address(self, address):
+        """
+        :returns: The nodes with ``address`` (one per multicast group).
+
+        :rvalue: NodeSet
+        """
+        return NodeSet(self._index(_ADDRESS).get(address, ()))
+
+    def get(self, address, default=None):
+        """
+        :returns: A node with ``address``, or ``default`` if there is none.
+        """
+        return next(iter(self._index(_ADDRESS).get(address, ())), default)
+
+    def by_group(self, group):
+        """
+        :rvalue: NodeSet
+        """
+        return NodeSet(self._index(_GROUP).get(group, ()))
+
+    def by_service(self, service):
+        """
+        :returns: The nodes whose ``services`` include ``service``.
+
+        :rvalue: NodeSet
+        """
+        return NodeSet(self._index(_SERVICE).get(service, ()))
+
+    def where(self, **params):
+        """
+        :returns: The nodes whose parameters have the given values, for example ``nodes.where(zone="eu", tier=1)``. The parameters used are indexed from then on.
+
+        :rvalue: NodeSet
+        """
+        indexed = []
+        scan = []
+        for name, value in params.items():
+            try:
+                hash(value)
+            except TypeError:
+                scan.append((name, value))
+                continue
+            indexed.append(self._index(("param", name)).get(value, set()))
+        indexed.sort(key=len)
+        candidates = indexed[0] if indexed else self
+        for nodes in indexed[1:]:
+            candidates = candidates & nodes
+        return NodeSet(node for node in candidates
+                       if all(name in node.params and node.params[name] == value for name, value in scan))
+
+    def between(self, name, low=None, high=None):
+        """
+        :returns: The nodes whose parameter ``name`` is a number between ``low`` and ``high`` (both included), for example ``nodes.between("load", high=0.5)``. The parameter is indexed from then on.
+
+        :param low: The lower bound, or ``None`` for no lower bound.
+
+        :param high: The upper bound, or ``None`` for no upper bound.
+
+        :rvalue: NodeSet
+        """
+        index = self._sorted.get(name)
+        if index is None:
+            index = self._sorted[name] = _SortedIndex(name, self)
+        return NodeSet(index.between(low, high))
+
+    def filter(self, expression):
+        """
+        :returns: The nodes which match a filter expression (see :mod:`marcopolo.bindings.filters`).
+
+        :rvalue: NodeSet
+        """
+        from marcopolo.bindings import filters
+        return filters.compile(expression).filter(self)
+
+    def add(self, node):
+        if node not in self:
+            set.add(self, node)
+            self._indexed(node)
+
+    def discard(self, node):
+        if node in self:
+            for existing in self._index(_ADDRESS).get(node.address, ()):
+                if existing == node: # The stored node, which may have other parameters
+                    node = existing
+                    break
+            set.discard(self, node)
+            self._unindexed(node)
+
+    def remove(self, node):
+        if node not in self:
+            raise KeyError(node)
+        self.discard(node)
+
+    def pop(self):
+        node = set.pop(self)
+        self._unindexed(node)
+        return node
+
+    def clear(self):
+        set.clear(self)
+        self._indexes = {}
+        self._sorted = {}
+
+    def update(self, *others):
+        for other in others:
+            for node in other:
+                self.add(node)
+
+    def difference_update(self, *others):
+        for other in others:
+            for node in list(other):
+                self.discard(node)
+
+    def intersection_update(self, *others):
+        for node in [node for node in self if not all(node in other for other in others)]:
+            self.discard(node)
+
+    def symmetric_difference_update(self, other):
+        for node in set(other):
+            if node in self:
+                self.discard(node)
+            else:
+                self.add(node)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+
+    def copy(self):
+        return NodeSet(self)
+
+    def union(self, *others):
+        return NodeSet(set.union(self, *others))
+
+    def intersection(self, *others):
+        return NodeSet(set.intersection(self, *others))
+
+    def difference(self, *others):
+        return NodeSet(set.difference(self, *others))
+
+    def symmetric_difference(self, other):
+        return NodeSet(set.symmetric_difference(self, other))
+
+    def __or__(self, other):
+        return NodeSet(set.__or__(self, other)) if isinstance(other, (set, frozenset)) else NotImplemented
+
+    __ror__ = __or__
+
+    def __and__(self, other):
+        return NodeSet(set.__and__(self, other)) if isinstance(other, (set, frozenset)) else NotImplemented
+
+    __rand__ = __and__
+
+    def __sub__(self, other):
+        return NodeSet(set.__sub__(self, other)) if isinstance(other, (set, frozenset)) else NotImplemented
+
+    def __rsub__(self, other):
+        return NodeSet(set.__sub__(set(other), self)) if isinstance(other, (set, frozenset)) else NotImplemented
+
+    def __xor__(self, other):
+        return NodeSet(set.__xor__(self, other)) if isinstance(other, (set, frozenset)) else NotImplemented
+
+    __rxor__ = __xor__
+
+    def __reduce__(self):
+        return (NodeSet, (list(self),))
+
+    def __repr__(self):
+        return "NodeSet(%r)" % (list(self),)
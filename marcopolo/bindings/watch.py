@@ -0,0 +1,194 @@
+"""
+Continuous discovery of services.
+
+A :class:`Watcher` runs the discovery of every watched service in a single
+background thread (one ``request_multi`` round trip per interval) and
+notifies its subscribers only of the differences between two successive
+rounds.
+"""
+from __future__ import absolute_import
+import threading, logging
+from collections import namedtuple
+
+from six.moves import queue
+
+from marcopolo.bindings import marco
+
+ADDED = "added"
+REMOVED = "removed"
+PARAMS_CHANGED = "params_changed"
+
+WATCH_INTERVAL = 5.0
+
+WatchEvent = namedtuple("WatchEvent", ["type", "service", "node"])
+"""
+A change in the set of nodes offering ``service``. ``type`` is one of
+``ADDED``, ``REMOVED`` or ``PARAMS_CHANGED``. For ``REMOVED`` events,
+``node`` is the last known state of the node.
+"""
+
+class Subscription(object):
+    """
+    A subscription to the changes of a service. If no callback was given,
+    the events are queued and can be consumed by iterating over the
+    subscription, which blocks until new events arrive and ends when the
+    subscription is cancelled.
+    """
+    def __init__(self, watcher, service, callback=None):
+        self.watcher = watcher
+        self.service = service
+        self.callback = callback
+        self._events = queue.Queue() if callback is None else None
+
+    def _emit(self, event):
+        if self.callback is None:
+            self._events.put(event)
+            return
+        try:
+            self.callback(event)
+        except Exception:
+            logging.exception("Error in the callback of the watch of %s", self.service)
+
+    def cancel(self):
+        """
+        Stops receiving events.
+        """
+        self.watcher.unsubscribe(self)
+        if self._events is not None:
+            self._events.put(None)
+
+    def __iter__(self):
+        if self._events is None:
+            raise TypeError("Subscriptions with a callback are not iterable")
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            yield event
+
+class Watcher(object):
+    """
+    Polls the resolver for all the watched services and dispatches the
+    changes to the subscribers. The background thread only runs while there
+    are subscriptions.
+
+    :param float interval: Seconds between two discovery rounds.
+
+    :param int timeout: Timeout (in milliseconds) of each discovery round.
+
+    :param options: Other keyword arguments of :class:`marcopolo.bindings.marco.Marco` (such as ``address`` or ``unix_socket``) used to reach the resolver.
+    """
+    def __init__(self, interval=WATCH_INTERVAL, timeout=marco.TIMEOUT, **options):
+        self.interval = interval
+        self.marco = marco.Marco(timeout=timeout, **options)
+        self._subscriptions = {}
+        self._nodes = {}
+        self._lock = threading.Lock()
+        self._delivery = threading.RLock() # Held while events are delivered, so that they reach the subscribers in order
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def subscribe(self, service, callback=None):
+        """
+        Subscribes to the changes of ``service``. The nodes already known to
+        offer the service are notified as ``ADDED`` events.
+
+        :param str service: The name of the service.
+
+        :param callback: If set, called from the watcher thread with each :class:`WatchEvent`.
+
+        :rvalue: Subscription
+        """
+        subscription = Subscription(self, service, callback)
+        with self._delivery:
+            with self._lock:
+                self._subscriptions.setdefault(service, []).append(subscription)
+                known = list(self._nodes.get(service, {}).values())
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="marco-watcher")
+                    self._thread.daemon = True
+                    self._thread.start()
+                else:
+                    self._wakeup.set()
+
+            # The changes found meanwhile are only delivered after the known nodes
+            for node in known:
+                subscription._emit(WatchEvent(ADDED, service, node))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.service, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.service, None)
+                self._nodes.pop(subscription.service, None)
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.clear() # Before reading the subscriptions, so that a later change is not missed
+            with self._lock:
+                services = list(self._subscriptions.keys())
+                if not services:
+                    self._thread = None
+                    return
+
+            try:
+                results = self.marco.request_multi(services)
+            except (marco.MarcoTimeOutException, marco.MarcoInternalError) as e:
+                logging.warning("Error while watching %s: %s", ", ".join(services), e)
+                results = None
+
+            if results is not None:
+                for service, nodes in results.items():
+                    self._update(service, nodes)
+
+            self._wakeup.wait(self.interval)
+
+    def _update(self, service, nodes):
+        """
+        Compares ``nodes`` with the previous result of ``service`` and notifies the differences.
+        """
+        current = dict((node.address, node) for node in nodes)
+        events = []
+        with self._delivery:
+            with self._lock:
+                if service not in self._subscriptions:
+                    return
+                previous = self._nodes.get(service, {})
+                for address, node in current.items():
+                    if address not in previous:
+                        events.append(WatchEvent(ADDED, service, node))
+                    elif previous[address].params != node.params:
+                        events.append(WatchEvent(PARAMS_CHANGED, service, node))
+                for address, node in previous.items():
+                    if address not in current:
+                        events.append(WatchEvent(REMOVED, service, node))
+                self._nodes[service] = current
+                subscriptions = list(self._subscriptions[service])
+
+            for event in events:
+                for subscription in subscriptions:
+                    subscription._emit(event)
+
+_watchers = {}
+_watcher_lock = threading.Lock()
+
+def get_watcher(**options):
+    """
+    Returns the watcher shared by the whole process for the resolver
+    configuration given by ``options`` (the keyword arguments of
+    :class:`Watcher`). Every configuration has its own watcher.
+
+    :rvalue: Watcher
+    """
+    options = dict({"timeout": marco.TIMEOUT, "group": marco.MULTICAST_GROUP}, **options)
+    key = tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                       for name, value in options.items() if value is not None))
+    with _watcher_lock:
+        watcher = _watchers.get(key)
+        if watcher is None:
+            watcher = _watchers[key] = Watcher(**options)
+        return watcher
@@ -24,7 +24,6 @@ if __name__ == "__main__":
 
     setup(
         name='marcopolo.bindings',
-        namespace_packages=['marcopolo'],
         provides=["marcopolo.bindings"],
         version='0.1.3',
 
@@ -60,6 +59,11 @@ if __name__ == "__main__":
         packages=find_packages(),
         install_requires=[
             'marcopolo>=0.0.1',
-            'six>=1.6.0'
+            'six>=1.6.0',
+            'futures>=3.0.0; python_version < "3"'
         ],
+        extras_require={
+            'msgpack': ['msgpack>=0.6.0'],
+            'cbor': ['cbor2>=4.0.0'],
+        },
     ) 
@@ -0,0 +1,88 @@
+import unittest
+import asyncio
+import json
+
+from mock import patch
+
+from marcopolo.bindings import marco, aiomarco
+
+
+class FakeResolver(asyncio.DatagramProtocol):
+    def __init__(self, replies):
+        self.replies = replies
+        self.commands = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        command = json.loads(data.decode('utf-8'))
+        self.commands.append(command)
+        reply = self.replies.get(command["Command"], lambda c: {"Error": True})
+        if reply is not None:
+            self.transport.sendto(json.dumps(reply(command)).encode('utf-8'), addr)
+
+
+class TestAsyncMarco(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.replies = {
+            "Marco": lambda c: [{"Address": "1.1.1.1", "Params": {}}],
+            "Request-for": lambda c: [{"Address": "2.2.2.2", "Params": {"service": c["Params"]}}],
+            "Services": lambda c: ["dummy"],
+        }
+        self.resolver = FakeResolver(self.replies)
+        self.transport, _ = self.loop.run_until_complete(
+            self.loop.create_datagram_endpoint(lambda: self.resolver, local_addr=('127.0.0.1', 0)))
+        self.patcher = patch.object(marco, 'RESOLVER_ADDRESS', self.transport.get_extra_info('sockname'))
+        self.patcher.start()
+        self.marco = aiomarco.AsyncMarco(timeout=100, loop=self.loop)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.transport.close()
+        self.loop.close()
+
+    def test_marco(self):
+        nodes = self.loop.run_until_complete(self.marco.marco())
+        self.assertEqual(["1.1.1.1"], [n.address for n in nodes])
+
+    def test_request_for(self):
+        nodes = self.loop.run_until_complete(self.marco.request_for("dummy"))
+        self.assertEqual([{"service": "dummy"}], [n.params for n in nodes])
+
+    def test_services(self):
+        self.assertEqual(["dummy"], self.loop.run_until_complete(self.marco.services("1.1.1.1")))
+
+    def test_concurrent_requests(self):
+        services = ["service%d" % i for i in range(50)]
+        results = self.loop.run_until_complete(self.marco.request_multi(services))
+        self.assertEqual(set(services), set(results.keys()))
+        for service, nodes in results.items():
+            self.assertEqual([{"service": service}], [n.params for n in nodes])
+
+    def test_request_multi(self):
+        self.replies["Request-multi"] = lambda c: [{"Address": "3.3.3.3", "Params": {}, "Service": s}
+                                                   for s in c["Services"]]
+        results = self.loop.run_until_complete(self.marco.request_multi(["a", "b"]))
+        self.assertEqual({"a": ["3.3.3.3"], "b": ["3.3.3.3"]},
+                         dict((s, [n.address for n in nodes]) for s, nodes in results.items()))
+        self.assertEqual(1, len(self.resolver.commands))
+
+    def test_timeout(self):
+        self.replies["Services"] = None
+        self.assertRaises(marco.MarcoTimeOutException,
+                          self.loop.run_until_complete, self.marco.services("1.1.1.1"))
+
+    def test_malformed_response(self):
+        self.resolver.datagram_received = lambda data, addr: self.resolver.transport.sendto(b"[", addr)
+        self.assertRaisesRegexp(marco.MarcoInternalError, "Internal parsing error",
+                                self.loop.run_until_complete, self.marco.marco())
+
+    def test_malformed_nodes(self):
+        self.replies["Request-for"] = lambda c: [{"Params": {}}]
+        self.replies["Request-multi"] = lambda c: [{"Address": "3.3.3.3", "Params": {}, "Service": ["a"]}]
+        self.assertRaisesRegexp(marco.MarcoInternalError, "Internal parsing error",
+                                self.loop.run_until_complete, self.marco.request_for("dummy"))
+        self.assertRaisesRegexp(marco.MarcoInternalError, "Internal parsing error",
+                                self.loop.run_until_complete, self.marco.request_multi(["a"]))
@@ -0,0 +1,84 @@
+import unittest
+import random
+from collections import Counter
+
+from marcopolo.bindings import balancer, watch
+from marcopolo.bindings.types import Node
+
+
+def nodes(count, **params):
+    return [Node("10.0.0.%d" % i, params=dict(params, index=i)) for i in range(count)]
+
+
+class TestBalancer(unittest.TestCase):
+    def setUp(self):
+        random.seed(1)
+
+    def test_empty(self):
+        for strategy in balancer.STRATEGIES:
+            b = balancer.Balancer(strategy=strategy)
+            self.assertEqual(None, b.pick())
+            with b.lease() as node:
+                self.assertEqual(None, node)
+
+    def test_unknown_strategy(self):
+        self.assertRaises(ValueError, balancer.Balancer, strategy="random")
+
+    def test_round_robin(self):
+        b = balancer.Balancer(nodes(3))
+        picked = [b.pick().address for _ in range(6)]
+        self.assertEqual(3, len(set(picked[:3])))
+        self.assertEqual(picked[:3], picked[3:])
+
+    def test_incremental_update(self):
+        b = balancer.Balancer(nodes(3), strategy=balancer.LEAST_OUTSTANDING)
+        busy = b.acquire()
+        b.update(nodes(5)[1:]) # 10.0.0.0 leaves, 10.0.0.3 and 10.0.0.4 join
+        self.assertEqual(set("10.0.0.%d" % i for i in range(1, 5)), set(n.address for n in b))
+        if busy.address != "10.0.0.0":
+            self.assertEqual(1, b.outstanding(busy))
+        b.remove(Node("10.0.0.4"))
+        self.assertEqual(3, len(b))
+
+    def test_params_changed(self):
+        b = balancer.Balancer(nodes(1))
+        b.add(Node("10.0.0.0", params={"weight": 5}))
+        self.assertEqual(1, len(b))
+        self.assertEqual({"weight": 5}, b.pick().params)
+
+    def test_weighted(self):
+        b = balancer.Balancer([Node("1.1.1.1", params={"capacity": 3}), Node("2.2.2.2", params={"capacity": 1}),
+                               Node("3.3.3.3", params={"capacity": 0})],
+                              strategy=balancer.WEIGHTED, weight="capacity")
+        counts = Counter(b.pick().address for _ in range(4000))
+        self.assertEqual(0, counts["3.3.3.3"])
+        self.assertAlmostEqual(3, counts["1.1.1.1"] / float(counts["2.2.2.2"]), delta=0.5)
+
+    def test_weighted_invalid_values(self):
+        b = balancer.Balancer([Node("1.1.1.1", params={"weight": "high"}), Node("2.2.2.2", params={"weight": 0})],
+                              strategy=balancer.WEIGHTED)
+        self.assertEqual(set(["1.1.1.1"]), set(b.pick().address for _ in range(100)))
+
+    def test_least_outstanding(self):
+        b = balancer.Balancer(nodes(3), strategy=balancer.LEAST_OUTSTANDING)
+        acquired = [b.acquire() for _ in range(3)]
+        self.assertEqual(3, len(set(acquired)))
+        b.release(acquired[1])
+        self.assertEqual(acquired[1], b.acquire())
+        self.assertEqual(2, b.outstanding(acquired[1]) + b.outstanding(acquired[0]))
+
+    def test_power_of_two(self):
+        b = balancer.Balancer(nodes(2), strategy=balancer.POWER_OF_TWO)
+        busy = b.acquire()
+        for _ in range(5):
+            b.acquire()
+        idle = [n for n in b if n != busy][0]
+        self.assertTrue(b.outstanding(idle) > b.outstanding(busy) or b.outstanding(busy) <= 3)
+
+    def test_watch_events(self):
+        b = balancer.Balancer()
+        node = Node("1.1.1.1")
+        b._on_event(watch.WatchEvent(watch.ADDED, "dummy", node))
+        self.assertEqual(1, len(b))
+        b._on_event(watch.WatchEvent(watch.REMOVED, "dummy", node))
+        self.assertEqual(0, len(b))
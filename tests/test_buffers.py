@@ -0,0 +1,34 @@
+import unittest
+
+from marcopolo.bindings import buffers
+
+
+class TestBufferPool(unittest.TestCase):
+    def test_reuse(self):
+        pool = buffers.BufferPool(size=16, max_buffers=1)
+        first = pool.acquire()
+        self.assertEqual(16, len(first))
+        pool.release(first)
+        self.assertIs(first, pool.acquire())
+        self.assertEqual(1, pool.allocated)
+
+    def test_limits(self):
+        pool = buffers.BufferPool(size=16, max_buffers=1)
+        first, second = pool.acquire(), pool.acquire()
+        pool.release(first)
+        pool.release(second)
+        self.assertEqual(1, len(pool))
+        pool.acquire()
+        pool.release(bytearray(32)) # Another size
+        self.assertEqual(0, len(pool))
+
+    def test_borrow(self):
+        pool = buffers.BufferPool(size=16)
+        with pool.borrow() as buffer:
+            self.assertEqual(0, len(pool))
+        self.assertEqual(1, len(pool))
+        self.assertIs(buffer, pool.acquire())
+
+    def test_shared_pool(self):
+        self.assertIs(buffers.get_pool(), buffers.get_pool())
+        self.assertEqual(buffers.BUFFER_SIZE, buffers.get_pool().size)
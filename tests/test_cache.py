@@ -0,0 +1,55 @@
+import unittest
+
+from mock import patch
+
+from marcopolo.bindings import cache
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.time = 1000.0
+        self.patcher = patch.object(cache.time, 'time', lambda: self.time)
+        self.patcher.start()
+        self.cache = cache.ResultCache(ttl=5, max_size=2, stale_ttl=10)
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_miss_and_hit(self):
+        self.assertEqual((None, cache.MISS), self.cache.lookup("a"))
+        self.cache.store("a", 1)
+        self.assertEqual((1, cache.FRESH), self.cache.lookup("a"))
+        self.assertEqual({"hits": 1, "stale_hits": 0, "misses": 1, "size": 1}, self.cache.stats())
+
+    def test_uncounted_lookup(self):
+        self.cache.store("a", 1)
+        self.assertEqual((None, cache.MISS), self.cache.lookup("b", count=False))
+        self.assertEqual((1, cache.FRESH), self.cache.lookup("a", count=False))
+        self.cache.record(cache.FRESH)
+        self.assertEqual({"hits": 1, "stale_hits": 0, "misses": 0, "size": 1}, self.cache.stats())
+
+    def test_expiration(self):
+        self.cache.store("a", 1)
+        self.time += 6
+        self.assertEqual((1, cache.STALE), self.cache.lookup("a"))
+        self.time += 10
+        self.assertEqual((None, cache.MISS), self.cache.lookup("a"))
+        self.assertEqual(0, len(self.cache))
+
+    def test_lru_eviction(self):
+        self.cache.store("a", 1)
+        self.cache.store("b", 2)
+        self.cache.lookup("a")
+        self.cache.store("c", 3)
+        self.assertEqual(cache.FRESH, self.cache.lookup("a")[1])
+        self.assertEqual(cache.MISS, self.cache.lookup("b")[1])
+
+    def test_single_refresh(self):
+        self.assertTrue(self.cache.start_refresh("a"))
+        self.assertFalse(self.cache.start_refresh("a"))
+        self.cache.store("a", 1)
+        self.assertTrue(self.cache.start_refresh("a"))
+
+    def test_key(self):
+        self.assertEqual(cache.ResultCache.key("s", {"a": 1, "b": 2}),
+                         cache.ResultCache.key("s", {"b": 2, "a": 1}))
@@ -0,0 +1,42 @@
+import unittest
+
+from marcopolo.bindings import codec
+
+
+class TestJSONCodec(unittest.TestCase):
+    def test_round_trip(self):
+        message = {"Command": "Marco", "params": {"a": [1, 2]}}
+        self.assertEqual(message, codec.JSON.decode(codec.JSON.encode(message)))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, codec.JSON.decode, b"[")
+        self.assertRaises(ValueError, codec.JSON.decode, b"\xff")
+        self.assertRaises(ValueError, codec.JSON.encode, {"a": object()})
+        self.assertRaises(ValueError, codec.JSONCodec(allow_nan=False).encode, {"a": float("nan")})
+
+
+class TestNegotiation(unittest.TestCase):
+    def test_hello(self):
+        hello = codec.hello(("unknown", "json"))
+        self.assertEqual("Hello", hello["Command"])
+        self.assertEqual(["json"], hello["Codecs"])
+
+    def test_negotiated(self):
+        self.assertIs(codec.JSON, codec.negotiated({"Codec": "unknown"}))
+        self.assertIs(codec.JSON, codec.negotiated(True))
+
+
+@unittest.skipUnless("msgpack" in codec.available_codecs(), "msgpack is not installed")
+class TestMsgPackCodec(unittest.TestCase):
+    def setUp(self):
+        self.codec = codec.get_codec("msgpack")
+
+    def test_round_trip(self):
+        message = [{"Address": "1.1.1.1", "Params": {"load": 0.5}}]
+        self.assertEqual(message, codec.decode(self.codec.encode(message), self.codec))
+
+    def test_json_fallback(self):
+        self.assertEqual({"Error": True}, codec.decode(b'{"Error": true}', self.codec))
+
+    def test_negotiated(self):
+        self.assertIs(self.codec, codec.negotiated({"Codec": "msgpack"}))
@@ -0,0 +1,100 @@
+import unittest
+
+from marcopolo.bindings import filters, marco, standin, cache
+from marcopolo.bindings.filters import FilterError
+from marcopolo.bindings.types import Node
+
+
+PARAMS = {"zone": "eu", "cpus": 8, "load": 0.5, "gpu": False, "tags": {"tier": "gold"}, "owner": None}
+
+
+class TestParse(unittest.TestCase):
+    def test_tree(self):
+        f = filters.compile('zone == "eu" and (cpus >= 4 or not exists(gpu)) and role in (\'a\', "b", 3)')
+        self.assertEqual(["and", ["eq", "zone", "eu"], ["or", ["ge", "cpus", 4], ["not", ["exists", "gpu"]]],
+                          ["in", "role", ["a", "b", 3]]], f.tree)
+
+    def test_values(self):
+        self.assertEqual(["eq", "a", True], filters.compile("a == true").tree)
+        self.assertEqual(["ne", "a", None], filters.compile("a != null").tree)
+        self.assertEqual(["lt", "a", -1.5], filters.compile("a<-1.5").tree)
+        self.assertEqual(["eq", "a", 'say "hi"'], filters.compile(r'a == "say \"hi\""').tree)
+
+    def test_invalid(self):
+        for expression in ("", "zone", "zone ==", "zone == eu", "zone = 1", "(a == 1", "a == 1 b == 2",
+                           "a in ()", "exists(1)", "a == 1 and", "a == @", 42):
+            self.assertRaises(FilterError, filters.compile, expression)
+        for tree in ([], ["xor", "a"], ["eq", "a"], ["and"], ["in", "a", 1], ["eq", 1, 2]):
+            self.assertRaises(FilterError, filters.compile, tree)
+
+    def test_compiled_once(self):
+        self.assertIs(filters.compile("a == 1"), filters.compile("a == 1"))
+        f = filters.compile("a == 1")
+        self.assertIs(f, filters.compile(f))
+        self.assertEqual(f, filters.compile(["eq", "a", 1]))
+
+
+class TestEvaluate(unittest.TestCase):
+    def check(self, expression, expected):
+        self.assertEqual(expected, filters.compile(expression).matches(PARAMS), expression)
+
+    def test_comparisons(self):
+        self.check('zone == "eu"', True)
+        self.check('zone != "eu"', False)
+        self.check("cpus > 4 and cpus <= 8 and load < 1", True)
+        self.check('zone in ("us", "eu")', True)
+        self.check("tags.tier == 'gold'", True)
+        self.check("owner == null", True)
+
+    def test_missing_fields_and_types(self):
+        self.check("missing == 1", False)
+        self.check("missing != 1", False)
+        self.check("not exists(missing)", True)
+        self.check("exists(owner)", True)
+        self.check("tags.missing.x == 1", False)
+        self.check('zone > 1', False)
+        self.check("gpu == 0", False) # Booleans are not numbers
+        self.check("gpu < 1", False)
+
+    def test_filter_nodes(self):
+        nodes = [Node("10.0.0.%d" % i, params={"cpus": i}) for i in range(8)]
+        f = filters.compile("cpus >= 6")
+        self.assertEqual(set(["10.0.0.6", "10.0.0.7"]), set(n.address for n in f.filter(nodes)))
+        self.assertTrue(f(nodes[7]))
+
+
+class TestPushDown(unittest.TestCase):
+    def setUp(self):
+        nodes = [standin.VirtualNode("10.0.0.%d" % i, {"web": {"zone": "eu" if i % 2 else "us", "cpus": i}},
+                                     params={"cpus": i}) for i in range(1, 11)]
+        self.resolver = standin.StandInResolver(nodes).__enter__()
+        self.marco = marco.Marco(timeout=50)
+
+    def tearDown(self):
+        self.marco.close()
+        self.resolver.__exit__(None, None, None)
+
+    def test_request_for(self):
+        nodes = self.marco.request_for("web", where='zone == "eu" and cpus >= 5')
+        self.assertEqual(set(["10.0.0.5", "10.0.0.7", "10.0.0.9"]), set(n.address for n in nodes))
+        self.assertEqual(2, len(self.marco.marco(where="cpus > 8")))
+        self.assertRaises(FilterError, self.marco.request_for, "web", where="zone ==")
+
+    def test_resolver_without_filters(self):
+        # The filter is applied by the client anyway
+        replying = self.resolver._replying
+        def ignore_filter(command, timeout):
+            return replying(dict(command, Filter=None), timeout)
+        self.resolver._replying = ignore_filter
+        self.assertEqual(1, len(self.marco.request_for("web", where="cpus == 10")))
+
+    def test_cached_result_is_filtered(self):
+        m = marco.Marco(timeout=50, cache=cache.ResultCache(ttl=60))
+        try:
+            self.assertEqual(10, len(m.request_for("web")))
+            commands = self.resolver.commands
+            self.assertEqual(5, len(m.request_for("web", where='zone == "us"')))
+            self.assertEqual(commands, self.resolver.commands)
+            self.assertEqual({"hits": 1, "stale_hits": 0, "misses": 1, "size": 1}, m.cache.stats())
+        finally:
+            m.close()
@@ -0,0 +1,15 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"))
+
+import import_time
+
+
+class TestDeferredImports(unittest.TestCase):
+    # The import time budgets are checked by benchmarks/import_time.py, not here: they depend on the load of the machine
+    def test_deferred_modules(self):
+        for module in ("marcopolo.bindings.marco", "marcopolo.bindings.polo", "marcopolo.bindings.pool",
+                       "marcopolo.bindings.watch"):
+            self.assertEqual([], import_time.measure(module, runs=1)[1])
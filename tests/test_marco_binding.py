@@ -0,0 +1,755 @@
+import unittest
+import os
+import shutil
+import socket
+import struct
+import json
+import tempfile
+import threading
+import time
+
+from mock import patch
+
+from marcopolo.bindings import marco, cache, codec, retry, timeouts, metrics
+from marcopolo.bindings.types import NodeSet
+
+
+class FakeResolver(object):
+    """
+    Replies to every command with the result of ``handler``, a function which
+    receives the command and returns the list of datagrams to send back.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.address = self.socket.getsockname()
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                data, address = self.socket.recvfrom(65536)
+            except socket.error:
+                return
+            for reply in self.handler(json.loads(data.decode('utf-8'))):
+                if not isinstance(reply, bytes):
+                    reply = json.dumps(reply).encode('utf-8')
+                self.socket.sendto(reply, address)
+
+    def close(self):
+        self.socket.close()
+
+
+def reply(command, payload):
+    return {"Id": command["Id"], "Response": payload}
+
+
+class TestMarco(unittest.TestCase):
+    def setUp(self):
+        self.handler = lambda command: [reply(command, [{"Address": "1.1.1.1", "Params": {}}])]
+        self.resolver = FakeResolver(lambda command: self.handler(command))
+        self.patcher = patch.object(marco, 'RESOLVER_ADDRESS', self.resolver.address)
+        self.patcher.start()
+        self.marco = marco.Marco(timeout=100)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.marco.close()
+        self.resolver.close()
+
+    def test_marco(self):
+        self.assertEqual(["1.1.1.1"], [n.address for n in self.marco.marco()])
+        self.assertIsInstance(self.marco.request_for("dummy"), NodeSet)
+        self.assertEqual("1.1.1.1", self.marco.marco().get("1.1.1.1").address)
+
+    def test_request_id(self):
+        commands = []
+        def handler(command):
+            commands.append(command)
+            return [reply(command, [])]
+        self.handler = handler
+        self.marco.request_for("dummy")
+        self.marco.request_for("dummy")
+        self.assertEqual(2, len(set(c["Id"] for c in commands)))
+
+    def test_legacy_resolver(self):
+        self.handler = lambda command: [["dummy"]]
+        self.assertEqual(["dummy"], self.marco.services("1.1.1.1"))
+
+    def test_untagged_replies_are_not_misrouted(self):
+        held = []
+        def handler(command):
+            held.append(command)
+            return [["late"]] if len(held) == 2 else [] # Untagged, while two requests are in flight
+        self.handler = handler
+        first = self.marco.submit_services("1.1.1.1", timeout=200)
+        self.assertRaises(marco.MarcoTimeOutException, self.marco.services, "1.1.1.1", timeout=50)
+        self.assertRaises(marco.MarcoTimeOutException, first.result)
+
+        self.handler = lambda command: [reply(command, ["web"])]
+        self.assertEqual(["web"], self.marco.services("1.1.1.1"))
+        self.handler = lambda command: [["dummy"]] # Once identifiers are echoed, untagged replies are dropped
+        self.assertRaises(marco.MarcoTimeOutException, self.marco.services, "1.1.1.1", timeout=50)
+
+    def test_timeout(self):
+        self.handler = lambda command: []
+        self.assertRaises(marco.MarcoTimeOutException, self.marco.marco)
+
+    def test_short_request_after_long_one(self):
+        self.handler = lambda command: []
+        pending = self.marco.submit_services("1.1.1.1", timeout=3000)
+        start = time.time()
+        self.assertRaises(marco.MarcoTimeOutException, self.marco.services, "1.1.1.1", timeout=100)
+        self.assertLess(time.time() - start, 1)
+        self.assertFalse(pending.done())
+
+    def test_short_request_after_long_one_without_waker(self):
+        self.marco._waker = None # The deadlines are checked every tick
+        self.test_short_request_after_long_one()
+
+    def test_malformed_response(self):
+        self.handler = lambda command: [b"["]
+        self.assertRaisesRegexp(marco.MarcoInternalError, "Internal parsing error", self.marco.marco)
+
+    def test_resolver_error(self):
+        self.handler = lambda command: [{"Id": command["Id"], "Error": "Unknown command"}]
+        self.assertRaisesRegexp(marco.MarcoInternalError, "Unknown command", self.marco.marco)
+
+    def test_out_of_order_replies(self):
+        held = []
+        def handler(command):
+            held.append(command)
+            if len(held) < 2:
+                return []
+            return [reply(c, [{"Address": c["Params"], "Params": {}}]) for c in reversed(held)]
+        self.handler = handler
+
+        first = self.marco.submit_request_for("1.1.1.1")
+        second = self.marco.submit_request_for("2.2.2.2")
+        self.assertEqual(["1.1.1.1"], [n.address for n in first.result()])
+        self.assertEqual(["2.2.2.2"], [n.address for n in second.result()])
+
+    def test_shared_between_threads(self):
+        self.handler = lambda command: [reply(command, [{"Address": command["Params"], "Params": {}}])]
+        errors = []
+        def worker(address):
+            for _ in range(20):
+                nodes = self.marco.request_for(address)
+                if [n.address for n in nodes] != [address]:
+                    errors.append(address)
+        threads = [threading.Thread(target=worker, args=("10.0.0.%d" % i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+
+    def test_services_many(self):
+        commands = []
+        def handler(command):
+            commands.append(command)
+            if command["node"] == "10.0.0.3": # Does not reply
+                return []
+            if command["node"] == "10.0.0.4":
+                return [{"Id": command["Id"], "Error": "Unknown node"}]
+            return [reply(command, ["service-" + command["node"]])]
+        self.handler = handler
+        nodes = ["10.0.0.%d" % i for i in range(10)]
+        start = time.time()
+        services, errors = self.marco.services_many(nodes, concurrency=4)
+        self.assertLess(time.time() - start, 0.5) # Only the silent node waits for the timeout
+        self.assertEqual(set(nodes) - set(["10.0.0.3", "10.0.0.4"]), set(services))
+        self.assertEqual(["service-10.0.0.0"], services["10.0.0.0"])
+        self.assertIsInstance(errors["10.0.0.3"], marco.MarcoTimeOutException)
+        self.assertIsInstance(errors["10.0.0.4"], marco.MarcoInternalError)
+        self.assertEqual(10, len(commands))
+        self.assertRaises(ValueError, self.marco.services_many, nodes, concurrency=0)
+
+    def test_services_many_nodes(self):
+        node = list(self.marco.marco())[0]
+        self.handler = lambda command: [reply(command, [command["node"]])]
+        services, errors = self.marco.services_many([node])
+        self.assertEqual({node: ["1.1.1.1"]}, services)
+        self.assertEqual({}, errors)
+
+    def test_delta_legacy_resolver(self):
+        commands = []
+        def handler(command):
+            commands.append(command)
+            return [reply(command, [{"Address": "1.1.1.1", "Params": {}}])]
+        self.handler = handler
+        m = marco.Marco(timeout=100, delta=True)
+        try:
+            self.assertEqual(1, len(m.request_for("dummy")))
+            self.assertEqual(1, len(m.request_for("dummy")))
+        finally:
+            m.close()
+        self.assertEqual([None, None], [c["Since"] for c in commands])
+
+    def test_delta(self):
+        commands = []
+        def handler(command):
+            commands.append(command)
+            if command["Since"] is None:
+                return [{"Id": command["Id"], "Response": {"Version": "v1", "Nodes": [{"Address": "1.1.1.1", "Params": {}}]},
+                         "Seq": 0, "More": True},
+                        {"Id": command["Id"], "Response": {"Version": "v1", "Nodes": [{"Address": "2.2.2.2", "Params": {}}]},
+                         "Seq": 1, "More": False}]
+            if command["Since"] == "v1":
+                return [reply(command, {"Version": "v2", "Removed": ["1.1.1.1"],
+                                        "Added": [{"Address": "3.3.3.3", "Params": {}}]})]
+            return [reply(command, {"Version": "v2", "NotModified": True})]
+        self.handler = handler
+        m = marco.Marco(timeout=100, delta=True)
+        try:
+            self.assertEqual(set(["1.1.1.1", "2.2.2.2"]), set(n.address for n in m.request_for("dummy")))
+            self.assertEqual(set(["2.2.2.2", "3.3.3.3"]), set(n.address for n in m.request_for("dummy")))
+            self.assertEqual(set(["2.2.2.2", "3.3.3.3"]), set(n.address for n in m.request_for("dummy")))
+            self.assertEqual(set(["1.1.1.1", "2.2.2.2"]), set(n.address for n in m.marco())) # Another query
+        finally:
+            m.close()
+        self.assertEqual([None, "v1", "v2", None], [c["Since"] for c in commands])
+
+    def test_delta_without_base(self):
+        self.handler = lambda command: [reply(command, {"Version": "v2", "NotModified": True})]
+        m = marco.Marco(timeout=100, delta=True)
+        try:
+            self.assertRaises(marco.MarcoInternalError, m.request_for, "dummy")
+        finally:
+            m.close()
+
+
+class TestMarcoCache(unittest.TestCase):
+    def setUp(self):
+        self.commands = []
+        def handler(command):
+            self.commands.append(command)
+            return [reply(command, [{"Address": "1.1.1.1", "Params": {}}])]
+        self.resolver = FakeResolver(handler)
+        self.patcher = patch.object(marco, 'RESOLVER_ADDRESS', self.resolver.address)
+        self.patcher.start()
+        self.cache = cache.ResultCache(ttl=60, stale_ttl=60)
+        self.marco = marco.Marco(timeout=100, cache=self.cache)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.marco.close()
+        self.resolver.close()
+
+    def test_hit(self):
+        first = self.marco.request_for("dummy")
+        second = self.marco.request_for("dummy")
+        self.assertEqual(first, second)
+        self.assertEqual(1, len(self.commands))
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    def test_different_params(self):
+        self.marco.request_for("dummy", params={"a": 1})
+        self.marco.request_for("dummy", params={"a": 2})
+        self.assertEqual(2, len(self.commands))
+
+    def test_stale_while_revalidate(self):
+        self.marco.request_for("dummy")
+        self.cache.ttl = 0
+        self.assertEqual(["1.1.1.1"], [n.address for n in self.marco.request_for("dummy")])
+        self.assertEqual(1, self.cache.stale_hits)
+        self.marco.submit_request_for("other").result()
+        self.assertEqual(3, len(self.commands))
+
+
+def chunked(command, nodes, size):
+    chunks = [nodes[i:i+size] for i in range(0, len(nodes), size)]
+    return [{"Id": command["Id"], "Seq": seq, "More": seq < len(chunks) - 1, "Response": chunk}
+            for seq, chunk in enumerate(chunks)]
+
+
+class TestChunkedResponses(unittest.TestCase):
+    def setUp(self):
+        self.nodes = [{"Address": "10.0.%d.%d" % (i // 256, i % 256), "Params": {"pad": "x" * 64}}
+                      for i in range(1000)]
+        self.handler = lambda command: chunked(command, self.nodes, 100)
+        self.resolver = FakeResolver(lambda command: self.handler(command))
+        self.patcher = patch.object(marco, 'RESOLVER_ADDRESS', self.resolver.address)
+        self.patcher.start()
+        self.marco = marco.Marco(timeout=200)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.marco.close()
+        self.resolver.close()
+
+    def test_reassembly(self):
+        nodes = self.marco.request_for("dummy")
+        self.assertEqual(1000, len(nodes))
+
+    def test_out_of_order_and_duplicated(self):
+        self.handler = lambda command: list(reversed(chunked(command, self.nodes, 100))) + chunked(command, self.nodes, 100)[:1]
+        self.assertEqual(1000, len(self.marco.marco()))
+
+    def test_missing_chunk(self):
+        self.handler = lambda command: chunked(command, self.nodes, 100)[1:]
+        self.assertRaises(marco.MarcoTimeOutException, self.marco.request_for, "dummy")
+
+    def test_iter_request_for(self):
+        addresses = [node.address for node in self.marco.iter_request_for("dummy")]
+        self.assertEqual(sorted(n["Address"] for n in self.nodes), sorted(addresses))
+
+    def test_iter_marco_legacy(self):
+        self.handler = lambda command: [self.nodes[:3]]
+        self.assertEqual(3, len(list(self.marco.iter_marco())))
+
+    def test_iter_timeout(self):
+        self.handler = lambda command: chunked(command, self.nodes, 100)[:-1]
+        iterator = self.marco.iter_request_for("dummy")
+        self.assertRaises(marco.MarcoTimeOutException, list, iterator)
+
+
+class TestRequestMulti(unittest.TestCase):
+    def setUp(self):
+        self.commands = []
+        def handler(command):
+            self.commands.append(command)
+            if command["Command"] == "Request-multi":
+                return [reply(command, [{"Address": "1.1.1.1", "Params": {}, "Service": "a"},
+                                        {"Address": "2.2.2.2", "Params": {}, "Service": "a"}])]
+            if command["Command"] == "Request-for":
+                return [reply(command, [{"Address": "3.3.3.3", "Params": {}}])]
+            return [{"Id": command["Id"], "Error": True}]
+        self.handler = handler
+        self.resolver = FakeResolver(lambda command: self.handler(command))
+        self.patcher = patch.object(marco, 'RESOLVER_ADDRESS', self.resolver.address)
+        self.patcher.start()
+        self.marco = marco.Marco(timeout=100)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.marco.close()
+        self.resolver.close()
+
+    def test_single_round_trip(self):
+        result = self.marco.request_multi(["a", "b"])
+        self.assertEqual(1, len(self.commands))
+        self.assertEqual(["a", "b"], self.commands[0]["Services"])
+        self.assertEqual(set(["1.1.1.1", "2.2.2.2"]), set(n.address for n in result["a"]))
+        self.assertEqual(set(), result["b"])
+
+    def test_fallback(self):
+        handler = self.handler
+        def legacy(command):
+            if command["Command"] == "Request-multi":
+                self.commands.append(command)
+                return [{"Error": True}]
+            return handler(command)
+        self.handler = legacy
+        result = self.marco.request_multi(["a", "b"])
+        self.assertEqual(["3.3.3.3"], [n.address for n in result["b"]])
+        self.assertEqual(3, len(self.commands))
+
+
+class TestEarlyCompletion(unittest.TestCase):
+    def setUp(self):
+        self.commands = []
+        def handler(command):
+            self.commands.append(command)
+            # The first replies are forwarded at once, the rest never arrive
+            return [{"Id": command["Id"], "Seq": 0, "More": True,
+                     "Response": [{"Address": "1.1.1.1", "Params": {}}]},
+                    {"Id": command["Id"], "Seq": 1, "More": True,
+                     "Response": [{"Address": "2.2.2.2", "Params": {}}]}]
+        self.resolver = FakeResolver(handler)
+        self.patcher = patch.object(marco, 'RESOLVER_ADDRESS', self.resolver.address)
+        self.patcher.start()
+        self.marco = marco.Marco(timeout=5000)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.marco.close()
+        self.resolver.close()
+
+    def test_request_one_for(self):
+        node = self.marco.request_one_for("dummy")
+        self.assertEqual("1.1.1.1", node.address)
+        self.assertTrue(self.commands[0]["Stream"])
+        self.assertEqual(1, self.commands[0]["max_nodes"])
+
+    def test_max_nodes(self):
+        nodes = self.marco.request_for("dummy", max_nodes=2, stream=True)
+        self.assertEqual(set(["1.1.1.1", "2.2.2.2"]), set(n.address for n in nodes))
+
+    def test_iter_max_nodes(self):
+        self.assertEqual(1, len(list(self.marco.iter_marco(max_nodes=1, stream=True))))
+
+
+@unittest.skipUnless("msgpack" in codec.available_codecs(), "msgpack is not installed")
+class TestCodecNegotiation(unittest.TestCase):
+    def setUp(self):
+        self.msgpack = codec.get_codec("msgpack")
+        self.received = []
+        self.resolver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.resolver.bind(('127.0.0.1', 0))
+        self.resolver.settimeout(1)
+        self.patcher = patch.object(marco, 'RESOLVER_ADDRESS', self.resolver.getsockname())
+        self.patcher.start()
+        self.marco = marco.Marco(timeout=500, codecs=["msgpack", "json"])
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.marco.close()
+        self.resolver.close()
+
+    def serve(self, supported):
+        def run():
+            data, address = self.resolver.recvfrom(65536)
+            hello = json.loads(data.decode('utf-8'))
+            self.received.append(hello)
+            if supported:
+                self.resolver.sendto(json.dumps(reply(hello, {"Codec": "msgpack"})).encode('utf-8'), address)
+            else:
+                self.resolver.sendto(b'{"Error": true}', address)
+            data, address = self.resolver.recvfrom(65536)
+            command = codec.decode(data, self.msgpack if supported else codec.JSON)
+            self.received.append(command)
+            response = reply(command, ["dummy"])
+            self.resolver.sendto(self.msgpack.encode(response) if supported else json.dumps(response).encode('utf-8'),
+                                 address)
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_binary_codec(self):
+        thread = self.serve(True)
+        self.assertEqual(["dummy"], self.marco.services("1.1.1.1"))
+        thread.join()
+        self.assertEqual(["msgpack", "json"], self.received[0]["Codecs"])
+        self.assertEqual("Services", self.received[1]["Command"])
+        self.assertEqual("msgpack", self.marco.codec.name)
+
+    def test_submit_does_not_wait_for_the_negotiation(self):
+        start = time.time()
+        future = self.marco.submit_services("1.1.1.1", timeout=50) # The resolver never answers
+        self.assertLess(time.time() - start, 0.05)
+        self.assertFalse(future.done())
+        self.assertRaises(marco.MarcoTimeOutException, future.result)
+        self.assertEqual("json", self.marco.codec.name)
+
+    def test_fallback(self):
+        thread = self.serve(False)
+        self.assertEqual(["dummy"], self.marco.services("1.1.1.1"))
+        thread.join()
+        self.assertEqual("json", self.marco.codec.name)
+
+
+class TestRetries(unittest.TestCase):
+    def setUp(self):
+        self.commands = []
+        self.lost = 0
+        def handler(command):
+            self.commands.append(command)
+            if len(self.commands) <= self.lost:
+                return []
+            return [reply(command, [{"Address": "1.1.1.1", "Params": {}}])]
+        self.resolver = FakeResolver(handler)
+        self.patcher = patch.object(marco, 'RESOLVER_ADDRESS', self.resolver.address)
+        self.patcher.start()
+        self.policy = retry.RetryPolicy(max_attempts=3, backoff=10, jitter=0)
+        self.marco = marco.Marco(timeout=50, retry=self.policy)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.marco.close()
+        self.resolver.close()
+
+    def test_retry_after_timeout(self):
+        self.lost = 2
+        self.assertEqual(["1.1.1.1"], [n.address for n in self.marco.request_for("dummy")])
+        self.assertEqual(3, len(self.commands))
+        self.assertNotEqual(self.commands[0]["Id"], self.commands[1]["Id"])
+
+    def test_attempts_exhausted(self):
+        self.lost = 3
+        self.assertRaises(marco.MarcoTimeOutException, self.marco.request_for, "dummy")
+        self.assertEqual(3, len(self.commands))
+
+    def test_bad_parameters_not_retried(self):
+        self.policy.backoff = 200
+        start = time.time()
+        self.assertRaises(marco.MarcoParameterError, self.marco.request_for, "dummy", params={"x": object()})
+        self.assertLess(time.time() - start, 0.1)
+        self.assertEqual([], self.commands)
+
+    def test_deadline(self):
+        self.lost = 3
+        self.policy.deadline = 120
+        self.assertRaises(marco.MarcoTimeOutException, self.marco.services, "1.1.1.1")
+        self.assertEqual(2, len(self.commands))
+
+    def test_marco_retries_argument(self):
+        self.marco.retry = None
+        self.lost = 1
+        self.assertEqual(1, len(self.marco.marco(retries=1)))
+        self.assertEqual(2, len(self.commands))
+
+    def test_backoff(self):
+        policy = retry.RetryPolicy(backoff=100, max_backoff=300, jitter=0)
+        self.assertEqual([0.1, 0.2, 0.3], [policy.delay(n) for n in (1, 2, 3)])
+
+
+class TestHedging(unittest.TestCase):
+    def setUp(self):
+        self.commands = []
+        def handler(command):
+            self.commands.append(command)
+            if len(self.commands) == 21: # The first reply of the hedged request is lost
+                return []
+            time.sleep(command["timeout"]/1000.0) # The resolver replies once the discovery is over
+            return [reply(command, [{"Address": "1.1.1.1", "Params": {}}])]
+        self.resolver = FakeResolver(handler)
+        self.patcher = patch.object(marco, 'RESOLVER_ADDRESS', self.resolver.address)
+        self.patcher.start()
+        self.marco = marco.Marco(timeout=20, retry=retry.RetryPolicy(max_attempts=2, backoff=1000, hedge=True))
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.marco.close()
+        self.resolver.close()
+
+    def test_hedged_request(self):
+        for _ in range(20):
+            self.marco.request_for("dummy")
+        start = time.time()
+        self.assertEqual(1, len(self.marco.request_for("dummy")))
+        self.assertTrue(time.time() - start < 1) # Less than the backoff of a retry
+        self.assertEqual(22, len(self.commands))
+
+
+class TestAdaptiveTimeouts(unittest.TestCase):
+    def setUp(self):
+        self.delay = 0
+        self.commands = []
+        def handler(command):
+            self.commands.append(command)
+            time.sleep(command["timeout"]/1000.0 + self.delay) # The discovery, and then the delay of the reply
+            return [reply(command, [{"Address": "1.1.1.1", "Params": {}}])]
+        self.resolver = FakeResolver(handler)
+        self.patcher = patch.object(marco, 'RESOLVER_ADDRESS', self.resolver.address)
+        self.patcher.start()
+        self.marco = marco.Marco(timeout=100, timeouts=timeouts.RTTEstimator(floor=50, min_samples=5))
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.marco.close()
+        self.resolver.close()
+
+    def test_derived_deadline(self):
+        for _ in range(5):
+            self.marco.request_for("dummy")
+        self.assertEqual(5, self.marco.rtt.samples("Request-for"))
+
+        self.delay = 0.08 # Within twice the timeout, but far beyond the observed round trips
+        start = time.time()
+        self.assertRaises(marco.MarcoTimeOutException, self.marco.request_for, "dummy")
+        self.assertTrue(time.time() - start < 0.18)
+
+    def test_default_until_enough_samples(self):
+        self.delay = 0.08
+        self.assertEqual(1, len(self.marco.request_for("dummy")))
+
+    def test_early_replies_are_not_observed(self):
+        self.resolver.handler = lambda command: [reply(command, [])] # Before the end of the discovery
+        for _ in range(5):
+            self.marco.request_for("dummy")
+            self.marco.services("1.1.1.1")
+        self.assertEqual(0, self.marco.rtt.samples("Request-for"))
+        self.assertEqual(0, self.marco.rtt.samples("Services"))
+
+    def test_deadline_budget(self):
+        self.delay = 0.2
+        self.marco.timeout = 300
+        start = time.time()
+        self.assertRaises(marco.MarcoTimeOutException, self.marco.request_for, "dummy", deadline=100)
+        self.assertTrue(time.time() - start < 0.2)
+
+    def test_deadline_spans_retries(self):
+        self.marco.retry = retry.RetryPolicy(max_attempts=5, backoff=10, jitter=0)
+        self.marco.timeout = 50
+        self.delay = 0.2
+        self.assertRaises(marco.MarcoTimeOutException, self.marco.services, "1.1.1.1", deadline=150)
+        self.assertTrue(len(self.commands) < 5)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.handler = lambda command: [reply(command, [{"Address": "1.1.1.1", "Params": {}}])]
+        self.resolver = FakeResolver(lambda command: self.handler(command))
+        self.patcher = patch.object(marco, 'RESOLVER_ADDRESS', self.resolver.address)
+        self.patcher.start()
+        self.metrics = metrics.Metrics()
+        self.marco = marco.Marco(timeout=50, metrics=self.metrics)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.marco.close()
+        self.resolver.close()
+
+    def test_phases(self):
+        self.marco.request_for("dummy")
+        snapshot = self.metrics.snapshot()["Request-for"]
+        for phase in metrics.PHASES:
+            self.assertEqual(1, snapshot[phase]["count"])
+        self.assertEqual({}, snapshot["errors"])
+
+    def test_errors(self):
+        self.handler = lambda command: []
+        self.assertRaises(marco.MarcoTimeOutException, self.marco.marco)
+        self.handler = lambda command: [b"{]"]
+        self.assertRaises(marco.MarcoInternalError, self.marco.marco)
+        self.assertEqual({"MarcoTimeOutException": 1, "MarcoInternalError": 1},
+                         self.metrics.snapshot()["Marco"]["errors"])
+
+
+class UnixResolver(object):
+    """
+    Serves length-prefixed commands on a Unix socket, writing the replies in small pieces.
+    """
+    def __init__(self, path, handler):
+        self.handler = handler
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(1)
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                self.connection, _ = self.socket.accept()
+            except socket.error:
+                return
+            self.serve_connection(self.connection)
+
+    def serve_connection(self, connection):
+        data = b""
+        while True:
+            try:
+                chunk = connection.recv(65536)
+            except socket.error:
+                return
+            if not chunk:
+                return
+            data += chunk
+            while len(data) >= 4 and len(data) >= 4 + struct.unpack("!I", data[:4])[0]:
+                length = struct.unpack("!I", data[:4])[0]
+                command, data = json.loads(data[4:4 + length].decode('utf-8')), data[4 + length:]
+                message = json.dumps(self.handler(command)).encode('utf-8')
+                frame = struct.pack("!I", len(message)) + message
+                for i in range(0, len(frame), 1000):
+                    connection.sendall(frame[i:i + 1000])
+
+    def drop(self):
+        """
+        Closes the connection of the client.
+        """
+        self.connection.shutdown(socket.SHUT_RDWR)
+        self.connection.close()
+
+    def close(self):
+        self.socket.close()
+
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "Unix sockets are not available")
+class TestUnixSocket(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "marco.sock")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_large_response(self):
+        nodes = [{"Address": "10.0.%d.%d" % (i // 256, i % 256), "Params": {"padding": "x" * 100}}
+                 for i in range(2000)] # Larger than a datagram
+        resolver = UnixResolver(self.path, lambda command: reply(command, nodes))
+        m = marco.Marco(timeout=100, unix_socket=self.path)
+        try:
+            self.assertEqual(self.path, m.unix_socket)
+            self.assertEqual(2000, len(m.request_for("dummy")))
+            self.assertEqual(2000, len(m.marco()))
+        finally:
+            m.close()
+            resolver.close()
+
+    def test_partial_message_is_kept_across_timeouts(self):
+        m = marco.Marco(timeout=100)
+        ours, theirs = socket.socketpair()
+        m.marco_socket.close()
+        m.marco_socket, m.unix_socket = ours, self.path
+        try:
+            frame = bytearray(16)
+            message = json.dumps({"Id": 1, "Response": ["x" * 100]}).encode('utf-8')
+            data = struct.pack("!I", len(message)) + message
+            theirs.sendall(data[:2])
+            self.assertRaises(socket.timeout, m._read, 0.01, frame)
+            theirs.sendall(data[2:50])
+            self.assertRaises(socket.timeout, m._read, 0.01, frame)
+            theirs.sendall(data[50:] + data) # The rest, and the next message
+            self.assertEqual(message, m._read(0.01, frame).tobytes()) # Larger than the frame
+            self.assertEqual(message, m._read(0.01, frame).tobytes())
+        finally:
+            m.close()
+            theirs.close()
+
+    def test_socket_timeout_unchanged(self):
+        resolver = UnixResolver(self.path, lambda command: reply(command, [{"Address": "1.1.1.1", "Params": {}}]))
+        m = marco.Marco(timeout=100, unix_socket=self.path)
+        try:
+            m.request_for("dummy")
+            self.assertIsNone(m.marco_socket.gettimeout()) # Senders are never interrupted by a receive timeout
+        finally:
+            m.close()
+            resolver.close()
+
+    def test_reconnect(self):
+        resolver = UnixResolver(self.path, lambda command: reply(command, [{"Address": "1.1.1.1", "Params": {}}]))
+        m = marco.Marco(timeout=100, unix_socket=self.path)
+        try:
+            self.assertEqual(1, len(m.request_for("dummy")))
+            first = m.marco_socket
+            resolver.drop()
+            time.sleep(0.05)
+            self.assertEqual(1, len(m.request_for("dummy")))
+            self.assertIsNot(first, m.marco_socket)
+            self.assertEqual(self.path, m.unix_socket)
+        finally:
+            m.close()
+            resolver.close()
+
+    def test_fallback_to_udp_when_the_connection_is_lost(self):
+        resolver = UnixResolver(self.path, lambda command: reply(command, [{"Address": "1.1.1.1", "Params": {}}]))
+        udp = FakeResolver(lambda command: [reply(command, [{"Address": "2.2.2.2", "Params": {}}])])
+        m = marco.Marco(timeout=100, unix_socket=self.path, address=udp.address)
+        try:
+            self.assertEqual(["1.1.1.1"], [n.address for n in m.request_for("dummy")])
+            resolver.close()
+            os.unlink(self.path)
+            resolver.drop()
+            time.sleep(0.05)
+            self.assertEqual(["2.2.2.2"], [n.address for n in m.request_for("dummy")])
+            self.assertIsNone(m.unix_socket)
+        finally:
+            m.close()
+            udp.close()
+
+    def test_fallback_to_udp(self):
+        resolver = FakeResolver(lambda command: [reply(command, [{"Address": "1.1.1.1", "Params": {}}])])
+        m = marco.Marco(timeout=100, unix_socket=self.path, address=resolver.address)
+        try:
+            self.assertEqual(None, m.unix_socket)
+            self.assertEqual(1, len(m.request_for("dummy")))
+        finally:
+            m.close()
+            resolver.close()
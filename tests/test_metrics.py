@@ -0,0 +1,90 @@
+import unittest
+import socket
+
+from marcopolo.bindings import metrics
+
+
+class TestHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = metrics.Histogram()
+        for ms in range(1, 1001):
+            histogram.record(ms / 1000.0)
+        self.assertEqual(1000, histogram.count)
+        self.assertAlmostEqual(0.5, histogram.percentile(50), delta=0.5 * 0.04)
+        self.assertAlmostEqual(0.99, histogram.percentile(99), delta=0.99 * 0.04)
+        self.assertEqual(1.0, histogram.percentile(100))
+        self.assertEqual(0.001, histogram.min)
+
+    def test_empty(self):
+        histogram = metrics.Histogram()
+        self.assertEqual(None, histogram.percentile(50))
+        self.assertEqual(None, histogram.snapshot()["mean"])
+
+    def test_bounded_buckets(self):
+        histogram = metrics.Histogram()
+        for us in range(100000):
+            histogram.record(us / 1e6)
+        self.assertTrue(len(histogram.counts) < 500)
+
+    def test_relative_error(self):
+        for us in (100, 1234, 56789, 3456789):
+            histogram = metrics.Histogram()
+            histogram.record(us / 1e6)
+            self.assertAlmostEqual(us / 1e6, histogram.percentile(50), delta=us / 1e6 / (1 << metrics.SUB_BUCKET_BITS))
+
+
+class RecordingExporter(object):
+    def __init__(self):
+        self.events = []
+
+    def timing(self, command, phase, seconds):
+        self.events.append(("timing", command, phase))
+
+    def error(self, command, error):
+        self.events.append(("error", command, error))
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.exporter = RecordingExporter()
+        self.metrics = metrics.Metrics([self.exporter])
+
+    def test_snapshot(self):
+        self.metrics.record("Marco", metrics.WAIT, 0.1)
+        self.metrics.record("Marco", metrics.WAIT, 0.3)
+        self.metrics.error("Marco", ValueError())
+        self.metrics.error("Marco", ValueError())
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(2, snapshot["Marco"]["wait"]["count"])
+        self.assertAlmostEqual(0.4, snapshot["Marco"]["wait"]["sum"])
+        self.assertEqual({"ValueError": 2}, snapshot["Marco"]["errors"])
+        self.assertEqual(("timing", "Marco", "wait"), self.exporter.events[0])
+        self.assertEqual(("error", "Marco", "ValueError"), self.exporter.events[-1])
+
+    def test_failing_exporter(self):
+        self.metrics.add_exporter(object())
+        self.metrics.record("Marco", metrics.SEND, 0.1)
+        self.assertEqual(1, self.metrics.snapshot()["Marco"]["send"]["count"])
+
+    def test_prometheus(self):
+        self.metrics.record("Request-for", metrics.DECODE, 0.5)
+        self.metrics.error("Request-for", KeyError())
+        text = self.metrics.prometheus()
+        self.assertIn('marcopolo_command_seconds_count{command="Request-for",phase="decode"} 1', text)
+        self.assertIn('marcopolo_command_errors_total{command="Request-for",error="KeyError"} 1', text)
+
+
+class TestStatsDExporter(unittest.TestCase):
+    def test_lines(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(1)
+        exporter = metrics.StatsDExporter(server.getsockname())
+        try:
+            exporter.timing("Request-for", metrics.WAIT, 0.25)
+            self.assertEqual(b"marcopolo.request_for.wait:250.000|ms", server.recv(1024))
+            exporter.error("Request-for", "MarcoTimeOutException")
+            self.assertEqual(b"marcopolo.request_for.errors.marcotimeoutexception:1|c", server.recv(1024))
+        finally:
+            exporter.close()
+            server.close()
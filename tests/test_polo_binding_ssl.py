@@ -6,6 +6,18 @@ from mock import MagicMock, patch
 from marcopolo.bindings import polo
 from ssl import SSLSocket
 
+def receive_from_recv(wrapped_socket):
+    """
+    Makes ``recv_into`` of the mocked socket deliver what its ``recv`` mock returns.
+    """
+    def recv_into(buffer, nbytes=0):
+        data = wrapped_socket.recv()
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        buffer[:len(data)] = data
+        return len(data)
+    wrapped_socket.recv_into.side_effect = recv_into
+
 class TestValidation(unittest.TestCase):
     def setUp(self):
         self.polo = polo.Polo(True)
@@ -18,6 +30,7 @@ class TestValidation(unittest.TestCase):
         
         self.polo.wrappedSocket.send.return_value = 1
         self.polo.wrappedSocket.recv.return_value = "{\"OK\": \"dummy\"}"
+        receive_from_recv(self.polo.wrappedSocket)
         self.polo.wrappedSocket.connect = MagicMock(name="SSLSocket.connect", spec=SSLSocket.connect)
         self.polo.wrappedSocket.connect.return_value = 1
 
@@ -171,6 +184,7 @@ class TestDeleteValidation(unittest.TestCase):
             self.polo.wrappedSocket = MagicMock(name="SSLSocket", spec=SSLSocket)
             self.polo.wrappedSocket.send.return_value = 1
             self.polo.wrappedSocket.recv.return_value = "{\"OK\": \"dummy\"}"
+            receive_from_recv(self.polo.wrappedSocket)
             self.polo.wrappedSocket.connect = MagicMock(name="SSLSocket.connect", spec=SSLSocket.connect)
             self.polo.wrappedSocket.connect.return_value = 1
 
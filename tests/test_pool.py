@@ -0,0 +1,128 @@
+import unittest
+import threading
+import time
+
+from mock import patch
+
+from marcopolo.bindings import marco, pool
+
+
+class TestMarcoPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = pool.MarcoPool(size=2, idle_timeout=60, timeout=100)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_reuse(self):
+        with self.pool.lease() as first:
+            pass
+        with self.pool.lease() as second:
+            self.assertIs(first, second)
+            self.assertEqual(100, second.timeout)
+        self.assertEqual(1, len(self.pool))
+
+    def test_size_limit(self):
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+        self.assertIsNot(first, second)
+        self.assertRaises(marco.MarcoTimeOutException, self.pool.acquire, 0.05)
+
+        threading.Timer(0.05, self.pool.release, [first]).start()
+        self.assertIs(first, self.pool.acquire(1))
+
+    def test_release_unknown_instance(self):
+        self.assertRaises(ValueError, self.pool.release, marco.Marco())
+
+    def test_idle_eviction(self):
+        instance = self.pool.acquire()
+        self.pool.release(instance)
+        self.pool.idle_timeout = 0
+        with patch.object(instance, 'close') as close:
+            self.assertIsNot(instance, self.pool.acquire())
+            close.assert_called_once_with()
+
+    def test_per_thread(self):
+        per_thread = pool.MarcoPool(size=2, per_thread=True)
+        instances = []
+        def worker():
+            with per_thread.lease() as m:
+                instances.append(m)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+
+        with per_thread.lease() as m:
+            self.assertIsNot(instances[0], m)
+            with per_thread.lease() as again:
+                self.assertIs(m, again)
+        self.assertEqual(1, len(per_thread)) # The instance of the finished thread was evicted
+
+    def test_per_thread_more_threads_than_size(self):
+        per_thread = pool.MarcoPool(size=1, idle_timeout=60, per_thread=True)
+        instances = []
+        def worker():
+            with per_thread.lease(timeout=1) as m:
+                instances.append(m)
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+            thread.join(2)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(4, len(instances))
+        self.assertEqual(1, len(per_thread))
+        per_thread.close()
+
+    def test_per_thread_waits_for_idle_instance(self):
+        per_thread = pool.MarcoPool(size=1, idle_timeout=0.1, per_thread=True)
+        per_thread.acquire() # Kept by this thread, which is still alive
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(per_thread.acquire(timeout=0.05)))
+        thread.start()
+        thread.join(2)
+        self.assertEqual([], acquired)
+
+        nested = per_thread.acquire()
+        per_thread.release(nested) # Still leased once by this thread
+        thread = threading.Thread(target=lambda: acquired.append(per_thread.acquire(timeout=0.05)))
+        thread.start()
+        thread.join(2)
+        self.assertEqual([], acquired)
+
+        per_thread.release(nested)
+        start = time.time()
+        thread = threading.Thread(target=lambda: acquired.append(per_thread.acquire()))
+        thread.start()
+        thread.join(2)
+        self.assertEqual([nested], acquired)
+        self.assertLess(time.time() - start, 1)
+        per_thread.close()
+
+    def test_fork(self):
+        instance = self.pool.acquire()
+        self.pool.release(instance)
+        with patch.object(pool.os, 'getpid', lambda: -1):
+            with patch.object(instance, 'close') as close:
+                self.assertIsNot(instance, self.pool.acquire())
+                close.assert_called_once_with()
+
+    def test_release_after_fork(self):
+        leased = self.pool.acquire()
+        idle = self.pool.acquire()
+        self.pool.release(idle)
+        per_thread = pool.MarcoPool(size=1, per_thread=True)
+        bound = per_thread.acquire()
+        per_thread.acquire() # Nested lease of the same instance
+        with patch.object(pool.os, 'getpid', lambda: -1):
+            with patch.object(leased, 'close') as close:
+                self.assertIsNot(leased, self.pool.acquire()) # The child starts afresh
+                close.assert_not_called()
+                self.pool.release(leased)
+                close.assert_called_once_with()
+            with patch.object(bound, 'close') as close:
+                per_thread.release(bound)
+                close.assert_not_called()
+                per_thread.release(bound)
+                close.assert_called_once_with()
+            self.assertRaises(ValueError, self.pool.release, leased)
+        per_thread.close()
@@ -0,0 +1,81 @@
+import unittest
+import socket
+
+from marcopolo.bindings import marco, probe, standin
+from marcopolo.bindings.types import Node
+
+
+def listener():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    s.listen(16)
+    return s
+
+def closed_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class TestProber(unittest.TestCase):
+    def setUp(self):
+        self.listeners = [listener() for _ in range(3)]
+        self.ports = [s.getsockname()[1] for s in self.listeners]
+
+    def tearDown(self):
+        for s in self.listeners:
+            s.close()
+
+    def test_ranks_and_drops_unreachable(self):
+        nodes = [Node("127.0.0.1", params={"port": port, "index": i}) for i, port in enumerate(self.ports)]
+        nodes.append(Node("127.0.0.1", params={"port": closed_port(), "index": 3}))
+        results = probe.Prober(concurrency=2).probe(nodes)
+        self.assertEqual([0, 1, 2], sorted(node.params["index"] for node, _ in results))
+        latencies = [latency for _, latency in results]
+        self.assertEqual(sorted(latencies), latencies)
+        self.assertTrue(all(latency >= 0 for latency in latencies))
+
+    def test_nodes_without_port_go_last(self):
+        nodes = [Node("127.0.0.2", params={}), Node("127.0.0.1", params={"port": self.ports[0]})]
+        results = probe.Prober().probe(nodes)
+        self.assertEqual(["127.0.0.1", "127.0.0.2"], [node.address for node, _ in results])
+        self.assertEqual(None, results[1][1])
+
+    def test_fixed_port(self):
+        nodes = [Node("127.0.0.1"), Node("invalid address")]
+        self.assertEqual(["127.0.0.1"], [node.address for node in probe.Prober(port=self.ports[0]).rank(nodes)])
+
+    def test_cache(self):
+        prober = probe.Prober(port=self.ports[0], ttl=60)
+        prober.rank([Node("127.0.0.1")])
+        self.listeners[0].close()
+        self.assertEqual(1, len(prober.rank([Node("127.0.0.1")])))
+        self.assertEqual(1, prober.cache.hits)
+
+        self.assertEqual([], probe.probe([Node("127.0.0.1")], port=self.ports[0]))
+
+    def test_invalid_concurrency(self):
+        self.assertRaises(ValueError, probe.Prober, concurrency=0)
+
+
+class TestRequestForProbe(unittest.TestCase):
+    def test_request_for_probe(self):
+        server = listener()
+        port = server.getsockname()[1]
+        nodes = [standin.VirtualNode("127.0.0.1", {"web": {"port": port}}),
+                 standin.VirtualNode("127.0.0.2", {"web": {"port": closed_port()}})]
+        try:
+            with standin.StandInResolver(nodes):
+                client = marco.Marco(timeout=50)
+                try:
+                    self.assertEqual(2, len(client.request_for("web")))
+                    ranked = client.request_for("web", probe=True)
+                    self.assertEqual(["127.0.0.1"], [node.address for node in ranked])
+                    ranked = client.request_for("web", probe=probe.Prober(port=port))
+                    self.assertEqual(["127.0.0.1"], [node.address for node in ranked])
+                finally:
+                    client.close()
+        finally:
+            server.close()
@@ -0,0 +1,137 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+import time
+
+from mock import patch
+
+from marcopolo.bindings import marco, snapshot, standin
+from marcopolo.bindings.types import Node
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "snapshot.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        s = snapshot.Snapshot(self.path)
+        self.assertEqual(0, len(s))
+        self.assertEqual((None, None), s.get("web"))
+        s.put("web", [Node("10.0.0.1", multicast_group="224.0.0.112", params={"port": 80}), Node("10.0.0.2")])
+        s.flush()
+
+        loaded = snapshot.Snapshot(self.path)
+        nodes, age = loaded.get("web")
+        self.assertEqual(set(["10.0.0.1", "10.0.0.2"]), set(n.address for n in nodes))
+        self.assertEqual({"port": 80}, [n for n in nodes if n.address == "10.0.0.1"][0].params)
+        self.assertLess(age, 5)
+        self.assertEqual([], [f for f in os.listdir(self.directory) if f != "snapshot.json"]) # No temporary files left
+
+    def test_max_age(self):
+        s = snapshot.Snapshot(self.path)
+        s.put("web", [Node("10.0.0.1")])
+        s.flush()
+        with open(self.path) as f:
+            data = json.load(f)
+        data["entries"]["web"]["stored"] -= 120
+        with open(self.path, "w") as f:
+            json.dump(data, f)
+
+        self.assertEqual((None, None), snapshot.Snapshot(self.path, max_age=60).get("web"))
+        self.assertGreaterEqual(snapshot.Snapshot(self.path, max_age=60).age("web"), 120)
+        self.assertEqual(1, len(snapshot.Snapshot(self.path, max_age=600).get("web")[0]))
+
+    def test_write_interval(self):
+        s = snapshot.Snapshot(self.path, write_interval=60)
+        s.put("web", [Node("10.0.0.1")])
+        s.flush()
+        modified = os.stat(self.path).st_mtime
+        os.utime(self.path, (modified - 10, modified - 10))
+        s.put("web", [Node("10.0.0.1")]) # Unchanged: not written
+        s.flush()
+        self.assertEqual(modified - 10, os.stat(self.path).st_mtime)
+        s.put("web", [Node("10.0.0.2")])
+        s.flush()
+        self.assertEqual(["10.0.0.2"], [n.address for n in snapshot.Snapshot(self.path).get("web")[0]])
+
+    def test_background_writes(self):
+        s = snapshot.Snapshot(self.path, flush_delay=0.1)
+        s.put("web", [Node("10.0.0.1")])
+        s.put("api", [Node("10.0.0.2")])
+        self.assertFalse(os.path.exists(self.path)) # Not written by put
+        time.sleep(0.5)
+        self.assertEqual(2, len(snapshot.Snapshot(self.path)))
+        self.assertIsNone(s._writer) # The writer ends when there are no more changes
+
+    def test_max_entries(self):
+        s = snapshot.Snapshot(self.path, max_entries=2)
+        for name in ("a", "b", "c"):
+            s.put(name, [Node("10.0.0.1")])
+            time.sleep(0.01)
+        self.assertEqual((None, None), s.get("a"))
+        self.assertEqual(2, len(s))
+
+    def test_writer_survives_errors(self):
+        s = snapshot.Snapshot(self.path, flush_delay=0.05)
+        s.put("bad", [Node("10.0.0.1", params={"x": object()})]) # Not stored
+        self.assertEqual(0, len(s))
+        with patch.object(s, '_write', side_effect=OSError("disk full")):
+            s.put("web", [Node("10.0.0.1")])
+            time.sleep(0.3)
+        self.assertIsNone(s._writer)
+        s.put("web", [Node("10.0.0.2")])
+        time.sleep(0.3)
+        self.assertEqual(["10.0.0.2"], [n.address for n in snapshot.Snapshot(self.path).get("web")[0]])
+
+    def test_invalid_file(self):
+        for content in (b"", b"{", b'{"version": 0, "entries": {}}'):
+            with open(self.path, "wb") as f:
+                f.write(content)
+            self.assertEqual(0, len(snapshot.Snapshot(self.path)))
+
+
+class TestWarmStart(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "snapshot.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_warm_start(self):
+        with standin.StandInResolver([standin.VirtualNode("10.0.0.1", {"web": {}}),
+                                      standin.VirtualNode("10.0.0.2", {"web": {}})]) as resolver:
+            first = marco.Marco(timeout=200, snapshot=snapshot.Snapshot(self.path))
+            try:
+                self.assertEqual(2, len(first.request_for("web"))) # Nothing stored: waits for the resolver
+            finally:
+                first.close()
+
+            resolver.nodes.pop()
+            second = marco.Marco(timeout=200, snapshot=snapshot.Snapshot(self.path))
+            try:
+                start = time.time()
+                self.assertEqual(2, len(second.request_for("web"))) # Served from the snapshot
+                self.assertLess(time.time() - start, 0.1)
+                time.sleep(0.3) # The background discovery ends
+                self.assertEqual(["10.0.0.1"], [n.address for n in second.request_for("web")])
+            finally:
+                second.close()
+        self.assertEqual(["10.0.0.1"], [n.address for n in snapshot.Snapshot(self.path).get(
+            snapshot.Snapshot.key("web", None, None, [], {}))[0]])
+
+    def test_error_reaches_the_caller(self):
+        with standin.StandInResolver([standin.VirtualNode("10.0.0.1", {"web": {}})]):
+            s = snapshot.Snapshot(self.path)
+            m = marco.Marco(timeout=200, snapshot=s)
+            try:
+                with patch.object(s, 'put', side_effect=RuntimeError("broken")):
+                    self.assertRaises(RuntimeError, m.submit_request_for("web").result, 1)
+            finally:
+                m.close()
@@ -0,0 +1,103 @@
+import unittest
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from marcopolo.bindings import marco, standin
+
+
+class TestStandInResolver(unittest.TestCase):
+    def setUp(self):
+        nodes = [standin.VirtualNode("10.0.0.%d" % i, {"web": {"port": i}}, delay=i / 1000.0) for i in range(1, 11)]
+        nodes.append(standin.VirtualNode("10.0.1.1", {"db": {}}, params={"role": "primary"}, delay=0.5))
+        self.resolver = standin.StandInResolver(nodes, chunk_size=3).__enter__()
+        self.marco = marco.Marco(timeout=100)
+
+    def tearDown(self):
+        self.marco.close()
+        self.resolver.__exit__(None, None, None)
+
+    def test_request_for(self):
+        nodes = self.marco.request_for("web")
+        self.assertEqual(10, len(nodes))
+        self.assertEqual(set(range(1, 11)), set(node.params["port"] for node in nodes))
+
+    def test_slow_nodes_are_left_out(self):
+        self.assertEqual(set(), self.marco.request_for("db"))
+        self.assertEqual(10, len(self.marco.marco()))
+
+    def test_exclude_and_max_nodes(self):
+        nodes = self.marco.request_for("web", exclude=["10.0.0.1"], max_nodes=2)
+        self.assertEqual(set(["10.0.0.2", "10.0.0.3"]), set(node.address for node in nodes))
+
+    def test_stream(self):
+        start = time.time()
+        self.assertEqual("10.0.0.1", self.marco.request_one_for("web").address)
+        self.assertTrue(time.time() - start < 0.1)
+
+    def test_services_and_multi(self):
+        self.assertEqual(["web"], self.marco.services("10.0.0.1"))
+        self.assertRaises(marco.MarcoResolverError, self.marco.services, "10.0.0.99")
+        results = self.marco.request_multi(["web", "db"], timeout=600)
+        self.assertEqual(10, len(results["web"]))
+        self.assertEqual(1, len(results["db"]))
+        self.assertEqual(10, len(results["web"].by_service("web")))
+        results = self.marco.request_multi(["web", "db"], max_nodes=2, timeout=600)
+        self.assertEqual(set(["10.0.0.1", "10.0.0.2"]), set(node.address for node in results["web"]))
+        self.assertEqual(1, len(results["db"]))
+
+    def test_services_index(self):
+        self.assertEqual(10, len(self.marco.request_for("web").by_service("web")))
+        delta = marco.Marco(timeout=100, delta=True)
+        try:
+            delta.request_for("web")
+            self.assertEqual(10, len(delta.request_for("web").by_service("web")))
+        finally:
+            delta.close()
+
+    def test_delta(self):
+        client = marco.Marco(timeout=100, delta=True)
+        try:
+            first = dict((node.address, node) for node in client.request_for("web"))
+            self.assertEqual(10, len(first))
+            self.assertEqual(set(first.values()), client.request_for("web")) # Not modified
+
+            self.resolver.nodes[0].services["web"] = {"port": 100}
+            del self.resolver.nodes[1]
+            self.resolver.nodes.append(standin.VirtualNode("10.0.0.11", {"web": {"port": 11}}))
+            second = dict((node.address, node) for node in client.request_for("web"))
+            self.assertEqual(set(first) - set(["10.0.0.2"]) | set(["10.0.0.11"]), set(second))
+            self.assertEqual({"port": 100}, second["10.0.0.1"].params)
+            self.assertIs(first["10.0.0.3"], second["10.0.0.3"]) # Unchanged nodes are not decoded again
+            self.assertEqual(10, len(client.marco()))
+        finally:
+            client.close()
+
+
+class TestStandInPolo(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.certfile = os.path.join(cls.directory, "cert.pem")
+        try:
+            subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                                   "-subj", "/CN=localhost", "-keyout", cls.certfile, "-out", cls.certfile],
+                                  stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            raise unittest.SkipTest("openssl is required to create the certificate")
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_publish_and_unpublish(self):
+        from marcopolo.bindings import polo
+        with standin.StandInPolo(self.certfile) as daemon:
+            client = polo.Polo()
+            self.assertEqual("dummy", client.publish_service("dummy", params={"port": 80}))
+            self.assertEqual({"port": 80}, client.service_info("dummy").params)
+            self.assertRaises(polo.PoloException, client.publish_service, "dummy")
+            client.unpublish_service("dummy")
+            self.assertEqual({}, daemon.services)
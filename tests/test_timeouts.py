@@ -0,0 +1,44 @@
+import unittest
+
+from marcopolo.bindings import timeouts
+
+
+class TestRTTEstimator(unittest.TestCase):
+    def setUp(self):
+        self.estimator = timeouts.RTTEstimator(floor=10, ceiling=1000, min_samples=3)
+
+    def test_default_without_samples(self):
+        self.assertEqual(2.0, self.estimator.timeout("Marco", 2.0))
+        self.estimator.observe("Marco", 0.1)
+        self.assertEqual(2.0, self.estimator.timeout("Marco", 2.0))
+
+    def test_smoothing(self):
+        for rtt in (0.1, 0.1, 0.1):
+            self.estimator.observe("Marco", rtt)
+        self.assertAlmostEqual(0.1, self.estimator.snapshot()["Marco"]["ewma"])
+        self.assertTrue(0.1 <= self.estimator.timeout("Marco", 2.0) < 0.25)
+
+    def test_percentile_lower_bound(self):
+        estimator = timeouts.RTTEstimator(k=0, percentile=100, min_samples=3)
+        for rtt in (0.01, 0.01, 0.01, 0.01, 0.5):
+            estimator.observe("Marco", rtt)
+        self.assertEqual(0.5, estimator.timeout("Marco", 2.0))
+
+    def test_clamping(self):
+        for _ in range(3):
+            self.estimator.observe("Marco", 0)
+            self.estimator.observe("Services", 5)
+        self.assertEqual(0.01, self.estimator.timeout("Marco", 2.0))
+        self.assertEqual(1.0, self.estimator.timeout("Services", 2.0))
+
+    def test_default_ceiling(self):
+        estimator = timeouts.RTTEstimator(min_samples=1)
+        estimator.observe("Marco", 5)
+        self.assertEqual(2.0, estimator.timeout("Marco", 2.0))
+
+    def test_commands_are_independent(self):
+        for _ in range(3):
+            self.estimator.observe("Marco", 0.1)
+        self.assertEqual(3, self.estimator.samples("Marco"))
+        self.assertEqual(0, self.estimator.samples("Request-for"))
+        self.assertEqual(None, self.estimator.percentile("Request-for", 50))
@@ -0,0 +1,111 @@
+import unittest
+import pickle
+
+from marcopolo.bindings.types import Node, NodeSet
+
+
+class TestNode(unittest.TestCase):
+    def test_identity(self):
+        self.assertEqual(Node("1.1.1.1", params={"a": 1}), Node("1.1.1.1", params={"a": 2}))
+        self.assertNotEqual(Node("1.1.1.1", multicast_group="224.0.0.112"), Node("1.1.1.1"))
+        self.assertEqual(1, len(set([Node("1.1.1.1"), Node("1.1.1.1")])))
+
+    def test_immutable(self):
+        node = Node("1.1.1.1")
+        self.assertRaises(AttributeError, setattr, node, "address", "2.2.2.2")
+        self.assertRaises(AttributeError, setattr, node, "other", 1)
+
+    def test_interned_address(self):
+        first = Node("".join(["10.0.", "0.1"]))
+        second = Node("".join(["10.0.0", ".1"]))
+        self.assertTrue(first.address is second.address)
+
+    def test_default_services(self):
+        self.assertEqual((), Node().services)
+        self.assertEqual({}, Node().params)
+
+    def test_pickle(self):
+        node = Node("1.1.1.1", ["s"], "224.0.0.112", {"a": 1})
+        copy = pickle.loads(pickle.dumps(node))
+        self.assertEqual(node, copy)
+        self.assertEqual({"a": 1}, copy.params)
+
+
+def nodes(count):
+    return [Node("10.0.0.%d" % i, services=["web"] if i % 2 else ["db"],
+                 multicast_group="224.0.0.%d" % (112 + i % 3), params={"zone": "z%d" % (i % 4), "index": i, "tags": [i]})
+            for i in range(count)]
+
+
+class TestNodeSet(unittest.TestCase):
+    def test_is_a_set(self):
+        s = NodeSet(nodes(4))
+        self.assertEqual(set(nodes(4)), s)
+        self.assertEqual(s, set(nodes(4)))
+        self.assertEqual(set(), NodeSet())
+        self.assertIn(Node("10.0.0.1", multicast_group="224.0.0.113"), s)
+
+    def test_lookups(self):
+        s = NodeSet(nodes(12))
+        self.assertEqual(5, s.get("10.0.0.5").params["index"])
+        self.assertEqual(None, s.get("10.0.1.1"))
+        self.assertEqual(1, len(s.by_address("10.0.0.5")))
+        self.assertEqual(4, len(s.by_group("224.0.0.112")))
+        self.assertEqual(6, len(s.by_service("web")))
+        self.assertEqual(set([4, 8]), set(n.params["index"] for n in s.where(zone="z0", index=4) | s.where(index=8)))
+        self.assertEqual(3, len(s.where(zone="z1")))
+        self.assertEqual(0, len(s.where(zone="z1", index=2)))
+        self.assertEqual([3], [n.params["index"] for n in s.where(tags=[3])]) # Unhashable values are scanned
+        self.assertEqual(6, len(s.filter("index >= 6")))
+
+    def test_incremental_updates(self):
+        s = NodeSet(nodes(8))
+        self.assertEqual(2, len(s.where(zone="z0")))
+        extra = Node("10.0.1.1", multicast_group="224.0.0.112", params={"zone": "z0"})
+        s.add(extra)
+        self.assertEqual(3, len(s.where(zone="z0")))
+        self.assertEqual(extra, s.get("10.0.1.1"))
+        # Removing an equal node with other parameters removes the stored one from the indexes
+        s.discard(Node("10.0.1.1", multicast_group="224.0.0.112"))
+        self.assertEqual(2, len(s.where(zone="z0")))
+        self.assertEqual(None, s.get("10.0.1.1"))
+        s -= s.by_group("224.0.0.112")
+        self.assertEqual(0, len(s.by_group("224.0.0.112")))
+        self.assertEqual(1, len(s.where(zone="z0")))
+        s |= nodes(8)
+        self.assertEqual(2, len(s.where(zone="z0")))
+        s &= s.by_service("web")
+        self.assertEqual(4, len(s))
+        self.assertEqual(0, len(s.by_service("db")))
+        node = s.pop()
+        self.assertEqual(NodeSet(), s.by_address(node.address))
+        s.clear()
+        self.assertEqual(0, len(s.where(zone="z1")))
+        self.assertRaises(KeyError, s.remove, node)
+
+    def test_between(self):
+        s = NodeSet(nodes(10))
+        s.add(Node("10.0.1.1", params={"index": "high"})) # Not a number, never in a range
+        self.assertEqual([3, 4, 5], sorted(n.params["index"] for n in s.between("index", 3, 5)))
+        self.assertEqual([8, 9], sorted(n.params["index"] for n in s.between("index", low=8)))
+        self.assertEqual(10, len(s.between("index")))
+        s.discard(Node("10.0.0.4", multicast_group="224.0.0.113"))
+        s.add(Node("10.0.1.2", params={"index": 4.5}))
+        self.assertEqual([3, 4.5, 5], sorted(n.params["index"] for n in s.between("index", 3, 5)))
+        s.clear()
+        self.assertEqual(0, len(s.between("index", 3, 5)))
+
+    def test_set_algebra(self):
+        first, second = NodeSet(nodes(6)), NodeSet(nodes(10)[4:])
+        for result in (first | second, first & second, first - second, first ^ second, set(nodes(2)) | first,
+                       first.union(second), first.intersection(second), first.difference(second), first.copy()):
+            self.assertIsInstance(result, NodeSet)
+        self.assertEqual(2, len(first & second))
+        self.assertEqual(2, len((first - second).by_service("web")))
+
+    def test_pickle(self):
+        s = NodeSet(nodes(3))
+        copy = pickle.loads(pickle.dumps(s))
+        self.assertIsInstance(copy, NodeSet)
+        self.assertEqual(s, copy)
+        self.assertEqual(1, len(copy.where(zone="z1")))
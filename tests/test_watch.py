@@ -0,0 +1,127 @@
+import unittest
+import threading
+
+from mock import patch
+
+from marcopolo.bindings import marco, watch
+from test_marco_binding import FakeResolver, reply
+
+
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.nodes = {"1.1.1.1": {"load": 1}}
+        self.rounds = threading.Semaphore(0)
+        def handler(command):
+            self.rounds.release()
+            return [reply(command, [{"Address": address, "Params": params, "Service": "dummy"}
+                                    for address, params in self.nodes.items()])]
+        self.resolver = FakeResolver(handler)
+        self.patcher = patch.object(marco, 'RESOLVER_ADDRESS', self.resolver.address)
+        self.patcher.start()
+        self.watcher = watch.Watcher(interval=0.01, timeout=100)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.resolver.close()
+
+    def test_events(self):
+        subscription = self.watcher.subscribe("dummy")
+        events = iter(subscription)
+
+        event = next(events)
+        self.assertEqual((watch.ADDED, "dummy", "1.1.1.1"), (event.type, event.service, event.node.address))
+
+        self.nodes["1.1.1.1"] = {"load": 2}
+        event = next(events)
+        self.assertEqual(watch.PARAMS_CHANGED, event.type)
+        self.assertEqual({"load": 2}, event.node.params)
+
+        self.nodes = {"2.2.2.2": {}}
+        kinds = set()
+        kinds.add(next(events).type)
+        kinds.add(next(events).type)
+        self.assertEqual(set([watch.ADDED, watch.REMOVED]), kinds)
+
+        subscription.cancel()
+        self.assertEqual([], list(events))
+
+    def test_no_events_without_changes(self):
+        received = []
+        subscription = self.watcher.subscribe("dummy", received.append)
+        for _ in range(5):
+            self.rounds.acquire()
+        subscription.cancel()
+        self.assertEqual([watch.ADDED], [event.type for event in received])
+
+    def test_late_subscriber_gets_known_nodes(self):
+        first = self.watcher.subscribe("dummy")
+        next(iter(first))
+        received = []
+        second = self.watcher.subscribe("dummy", received.append)
+        self.assertEqual(["1.1.1.1"], [event.node.address for event in received])
+        first.cancel()
+        second.cancel()
+
+    def test_update_during_subscription(self):
+        self.watcher.interval = 60
+        first = self.watcher.subscribe("dummy")
+        next(iter(first))
+        self.nodes = {}
+        updater = threading.Thread(target=self.watcher._update, args=("dummy", []))
+        WatchEvent = watch.WatchEvent
+        def event(*args):
+            if args[0] == watch.ADDED and not updater.ident: # The known node of the second subscription
+                updater.start()
+                updater.join(0.2)
+            return WatchEvent(*args)
+        received = []
+        with patch.object(watch, 'WatchEvent', event):
+            second = self.watcher.subscribe("dummy", received.append)
+            updater.join(2)
+        self.assertEqual([watch.ADDED, watch.REMOVED], [e.type for e in received])
+        first.cancel()
+        second.cancel()
+
+    def test_subscription_wakes_up_the_watcher(self):
+        self.watcher.interval = 60
+        first = self.watcher.subscribe("dummy")
+        next(iter(first))
+        self.nodes = {}
+        second = self.watcher.subscribe("other") # Starts a new round, which notices the change
+        self.assertEqual(watch.REMOVED, next(iter(first)).type)
+        first.cancel()
+        second.cancel()
+
+
+class TestMarcoWatch(unittest.TestCase):
+    def setUp(self):
+        def handler(command):
+            return [reply(command, [{"Address": "1.1.1.1", "Params": {}, "Service": "dummy"}])]
+        self.resolver = FakeResolver(handler)
+
+    def tearDown(self):
+        self.resolver.close()
+
+    def test_watch_uses_the_resolver_of_the_instance(self):
+        m = marco.Marco(timeout=100, address=self.resolver.address)
+        subscription = m.watch("dummy")
+        try:
+            event = next(iter(subscription))
+            self.assertEqual((watch.ADDED, "1.1.1.1"), (event.type, event.node.address))
+            self.assertEqual(self.resolver.address, subscription.watcher.marco.address)
+            other = marco.Marco(timeout=100, address=self.resolver.address).watch("other")
+            self.assertIs(subscription.watcher, other.watcher)
+            other.cancel()
+            self.assertIsNot(subscription.watcher, watch.get_watcher())
+        finally:
+            subscription.cancel()
+            m.close()
+
+    def test_balancer_watch(self):
+        m = marco.Marco(timeout=100, address=self.resolver.address)
+        b = m.balancer("dummy", watch=True)
+        try:
+            self.assertEqual(self.resolver.address, b._subscription.watcher.marco.address)
+        finally:
+            b._subscription.cancel()
+            m.close()